@@ -0,0 +1,505 @@
+__author__ = 'Adrian Toral / Dario Llodra'
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import time
+import timeit
+import uuid
+from typing import Any, Callable
+
+import bson
+import pymongo
+import pymongo.monitoring
+import redis
+import yaml
+
+import practica1
+from practica1 import CacheCodec, JsonCodec, BsonCodec, Model, decodeCache
+
+# Documentos de ejemplo del proyecto
+RUTA_PERSONAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datos', 'persona.json')
+
+# Definiciones de los modelos del proyecto
+RUTA_MODELOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models.yml')
+
+
+def cargar_personas() -> list[dict]:
+    """
+    Carga los documentos de ejemplo de personas y les asigna un _id
+    y una fecha como los tendrian al leerlos de mongo.
+
+    Returns
+    -------
+        list[dict]
+            documentos de personas
+    """
+
+    with open(RUTA_PERSONAS, 'r') as fichero:
+        personas = json.load(fichero)
+
+    for persona in personas:
+        persona['_id'] = bson.ObjectId()
+        persona['fecha_alta'] = datetime.datetime(2023, 10, 1, 12, 30)
+
+    return personas
+
+
+def benchmark_codec(codec: CacheCodec, documentos: list[dict], repeticiones: int = 2000) -> dict[str, float]:
+    """
+    Mide el tamanio medio y el tiempo medio de codificacion y
+    decodificacion de los documentos con un formato de la cache.
+
+    Parameters
+    ----------
+        codec : CacheCodec
+            formato de la cache a medir
+        documentos : list[dict]
+            documentos a codificar
+        repeticiones : int
+            veces que se codifica y decodifica cada documento
+    Returns
+    -------
+        dict[str, float]
+            bytes por documento y microsegundos por codificacion y decodificacion
+    """
+
+    codificados = [codec.encode(documento) for documento in documentos]
+
+    codificar = timeit.timeit(lambda: [codec.encode(documento) for documento in documentos], number=repeticiones)
+    decodificar = timeit.timeit(lambda: [decodeCache(datos) for datos in codificados], number=repeticiones)
+
+    return {
+        'bytes': sum(map(len, codificados)) / len(codificados),
+        'encode_us': codificar / (repeticiones * len(documentos)) * 1e6,
+        'decode_us': decodificar / (repeticiones * len(documentos)) * 1e6
+    }
+
+
+class Contador(pymongo.monitoring.CommandListener):
+    """
+    Cuenta las peticiones que se hacen a mongo y a redis.
+    En mongo se registra como CommandListener del cliente, por lo que
+    cuenta cada comando enviado, incluidos los getMore de los cursores.
+    Con mongomock, que no admite listeners, se cuenta una peticion por
+    cada llamada a un metodo de la coleccion.
+    En redis cuenta cada comando suelto y cada pipeline ejecutado.
+
+    Attributes
+    ----------
+        mongo : int
+            peticiones a mongo
+        redis : int
+            peticiones a redis
+    """
+
+    def __init__(self):
+        self.mongo = 0
+        self.redis = 0
+
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        self.mongo += 1
+
+    def succeeded(self, event: pymongo.monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        pass
+
+    def contar_redis(self, cliente: redis.Redis) -> redis.Redis:
+        """
+        Envuelve los comandos y los pipelines del cliente de redis para
+        contar sus peticiones. Los pipelines vacios no llegan al servidor.
+        """
+
+        execute_command = cliente.execute_command
+        pipeline = cliente.pipeline
+
+        def comando(*args, **kwargs):
+            self.redis += 1
+            return execute_command(*args, **kwargs)
+
+        def pipeline_contado(*args, **kwargs):
+            nuevo = pipeline(*args, **kwargs)
+            execute = nuevo.execute
+
+            def ejecutar(*args, **kwargs):
+                if nuevo.command_stack: self.redis += 1
+                return execute(*args, **kwargs)
+
+            nuevo.execute = ejecutar
+            return nuevo
+
+        cliente.execute_command = comando
+        cliente.pipeline = pipeline_contado
+        return cliente
+
+
+class ColeccionContada:
+    """
+    Envuelve una coleccion de mongomock y cuenta una peticion a mongo
+    por cada llamada a sus metodos.
+    """
+
+    def __init__(self, coleccion: Any, contador: Contador):
+        self.coleccion = coleccion
+        self.contador = contador
+
+    def __getattr__(self, nombre: str) -> Any:
+        atributo = getattr(self.coleccion, nombre)
+        if not callable(atributo): return atributo
+
+        def llamada(*args, **kwargs):
+            self.contador.mongo += 1
+            return atributo(*args, **kwargs)
+
+        return llamada
+
+
+def crear_modelos(base_datos: Any, cliente_redis: redis.Redis, contador: Contador | None = None) -> dict[str, type[Model]]:
+    """
+    Crea los modelos de models.yml sobre las conexiones indicadas,
+    igual que initApp pero sin crear sus propias conexiones.
+
+    Parameters
+    ----------
+        base_datos : pymongo.database.Database
+            base de datos de mongo o de mongomock
+        cliente_redis : redis.Redis
+            cliente de redis o de fakeredis
+        contador : Contador | None
+            si se indica, las colecciones cuentan sus llamadas (mongomock)
+    Returns
+    -------
+        dict[str, type[Model]]
+            modelos por nombre
+    """
+
+    with open(RUTA_MODELOS, 'r') as fichero:
+        definiciones = yaml.safe_load(fichero)
+
+    modelos = {}
+    for nombre, atributos in definiciones.items():
+        campos = tuple(dict.fromkeys([*atributos['required_vars'], *atributos['admissible_vars']]))
+        coleccion = base_datos[nombre] if contador is None else ColeccionContada(base_datos[nombre], contador)
+
+        modelo = type(nombre, (Model,), {'__slots__': campos})
+        modelo.init_class(coleccion, cliente_redis, atributos['required_vars'], atributos['admissible_vars'])
+        modelo.sync_indexes(atributos.get('indexes', []))
+        for opcion, valor in atributos.get('cache', {}).items(): setattr(modelo, opcion, valor)
+
+        modelos[nombre] = modelo
+
+    return modelos
+
+
+def percentil(valores: list[float], fraccion: float) -> float:
+    """
+    Devuelve el percentil de los valores por el metodo del rango mas cercano.
+    """
+
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(fraccion * len(ordenados)))]
+
+
+def medir(operacion: Callable[[int], Any], repeticiones: int, contador: Contador,
+          preparar: Callable[[int], Any] | None = None) -> dict[str, float]:
+    """
+    Ejecuta una operacion varias veces y mide su latencia y sus peticiones
+    a mongo y redis. La preparacion no se incluye en las medidas.
+
+    Parameters
+    ----------
+        operacion : Callable[[int], Any]
+            operacion a medir, recibe el numero de repeticion
+        repeticiones : int
+            veces que se ejecuta la operacion
+        contador : Contador
+            contador de peticiones de las conexiones
+        preparar : Callable[[int], Any] | None
+            se ejecuta antes de cada repeticion, por ejemplo para vaciar la cache
+    Returns
+    -------
+        dict[str, float]
+            operaciones por segundo, latencias p50 y p99 en milisegundos
+            y peticiones a mongo y redis por operacion
+    """
+
+    latencias = []
+    mongo = redis_ = 0
+    for repeticion in range(repeticiones):
+        if preparar is not None: preparar(repeticion)
+
+        antes = (contador.mongo, contador.redis)
+        inicio = time.perf_counter()
+        operacion(repeticion)
+        latencias.append(time.perf_counter() - inicio)
+
+        mongo += contador.mongo - antes[0]
+        redis_ += contador.redis - antes[1]
+
+    return {
+        'operaciones': repeticiones,
+        'ops_por_segundo': repeticiones / sum(latencias),
+        'p50_ms': percentil(latencias, 0.5) * 1e3,
+        'p99_ms': percentil(latencias, 0.99) * 1e3,
+        'mongo_por_operacion': mongo / repeticiones,
+        'redis_por_operacion': redis_ / repeticiones
+    }
+
+
+def benchmark_odm(modelos: dict[str, type[Model]], contador: Contador, documentos: int = 1000, repeticiones: int = 20) -> dict[str, dict]:
+    """
+    Mide save, find con ModelCursor, find_by_id con la cache fria y
+    caliente y las consultas Q1-Q7 sobre el modelo Persona.
+
+    Parameters
+    ----------
+        modelos : dict[str, type[Model]]
+            modelos creados con crear_modelos
+        contador : Contador
+            contador de peticiones de las conexiones
+        documentos : int
+            personas que se guardan y se buscan por id
+        repeticiones : int
+            veces que se ejecutan find y cada consulta
+    Returns
+    -------
+        dict[str, dict]
+            resultados de medir por operacion
+    """
+
+    persona = modelos['Persona']
+    plantillas = cargar_personas()
+    guardadas: list[Model] = []
+
+    def guardar(repeticion: int) -> None:
+        datos = {clave: valor for clave, valor in plantillas[repeticion % len(plantillas)].items() if clave in persona._bits and clave != '_id'}
+        datos['dni'] = f'benchmark-{repeticion}'
+        modelo = persona(**datos)
+        modelo.save()
+        guardadas.append(modelo)
+
+    resultados = {'save': medir(guardar, documentos, contador)}
+    identificadores = [getattr(modelo, '_id') for modelo in guardadas]
+
+    resultados['find'] = medir(lambda _: list(persona.find({}, batch_size=100)), repeticiones, contador)
+    resultados['find_by_id_cold'] = medir(lambda repeticion: persona.find_by_id(identificadores[repeticion]), documentos, contador,
+                                          preparar=lambda repeticion: persona.redis.delete(persona._clave(identificadores[repeticion])))
+    resultados['find_by_id_hot'] = medir(lambda repeticion: persona.find_by_id(identificadores[repeticion]), documentos, contador)
+
+    for numero in range(1, 8):
+        consulta = getattr(practica1, f'Q{numero}')
+        try:
+            resultados[f'Q{numero}'] = medir(lambda _: list(persona.aggregate(consulta)), repeticiones, contador)
+        except Exception as error:
+            # Algunas etapas no existen en mongomock o en versiones antiguas de mongo
+            resultados[f'Q{numero}'] = {'error': str(error)}
+
+    return resultados
+
+
+def iniciar_sesion_secuencial(cliente: redis.Redis, nombre_usuario: str = None, contrasenia: str = None, token: str = None) -> dict | int:
+    """
+    Inicio de sesion de practica2 antes de hacerse en una sola operacion,
+    con hasta seis peticiones a redis, como referencia para benchmark_login.
+    """
+
+    import practica2
+
+    if token is not None and cliente.exists(token):
+        datos = cliente.hgetall(f'usuario:{cliente.get(token)}')
+
+    else:
+        if not cliente.exists(f'usuario:{nombre_usuario}'): return -1
+        datos = cliente.hgetall(f'usuario:{nombre_usuario}')
+
+        if datos['contrasenia'] != practica2.encriptar_md5(contrasenia): return -1
+
+        if not cliente.exists(f'token:{nombre_usuario}'):
+            token = str(uuid.uuid4())
+            cliente.setex(token, practica2.TTL_TOKEN, nombre_usuario)
+            cliente.setex(f'token:{nombre_usuario}', practica2.TTL_TOKEN, token)
+
+        else: token = cliente.get(f'token:{nombre_usuario}')
+
+    return {'token': token, 'privilegios': int(datos['privilegios'])}
+
+
+def benchmark_login(repeticiones: int = 10000) -> dict[str, dict]:
+    """
+    Compara los inicios de sesion por segundo de practica2 con el inicio
+    de sesion secuencial anterior, con usuario y contrasenia y con token,
+    y con token usando la cache local de tokens.
+    Usa el servidor de redis de practica2.
+
+    Parameters
+    ----------
+        repeticiones : int
+            inicios de sesion de cada tipo
+    Returns
+    -------
+        dict[str, dict]
+            resultados de medir por tipo de inicio de sesion
+    """
+
+    import practica2
+
+    contador = Contador()
+    cliente = contador.contar_redis(practica2.cliente_redis)
+    practica2.registrar_usuario('Benchmark', 'benchmark-login', 'benchmark', 1)
+    token = practica2.iniciar_sesion('benchmark-login', 'benchmark')['token']
+
+    resultados = {
+        'secuencial_credenciales': medir(lambda _: iniciar_sesion_secuencial(cliente, 'benchmark-login', 'benchmark'), repeticiones, contador),
+        'atomico_credenciales': medir(lambda _: practica2.iniciar_sesion('benchmark-login', 'benchmark'), repeticiones, contador),
+        'secuencial_token': medir(lambda _: iniciar_sesion_secuencial(cliente, token=token), repeticiones, contador),
+        'atomico_token': medir(lambda _: practica2.iniciar_sesion(token=token), repeticiones, contador)
+    }
+
+    # Con la cache local de tokens solo el primer inicio de sesion consulta redis
+    practica2.activar_cache_tokens()
+    resultados['cache_token'] = medir(lambda _: practica2.iniciar_sesion(token=token), repeticiones, contador)
+    practica2.desactivar_cache_tokens()
+
+    return resultados
+
+
+def benchmark_memoria_sesiones(sesiones: int = 100000, buckets: int = 1024) -> dict[str, dict]:
+    """
+    Compara la memoria que ocupa cada sesion de practica2 con la distribucion
+    anterior (dos claves por sesion) y con la de SesionesCompactas, y cuantas
+    sesiones caben en los 150mb de maxmemory.
+    Usa el servidor de redis de practica2, necesita INFO y OBJECT ENCODING
+    de un redis real (fakeredis no los tiene).
+
+    Parameters
+    ----------
+        sesiones : int
+            sesiones que se crean con cada distribucion
+        buckets : int
+            buckets de SesionesCompactas
+    Returns
+    -------
+        dict[str, dict]
+            bytes por sesion, sesiones en 150mb y codificaciones de los buckets
+    """
+
+    import practica2
+
+    cliente = practica2.cliente_redis
+    usuarios = [f'benchmark-sesion-{i}' for i in range(sesiones)]
+    contrasenia = practica2.encriptar_md5('benchmark')
+    limite = 150 * 1024 * 1024
+
+    pipeline = cliente.pipeline(transaction=False)
+    for usuario in usuarios: pipeline.hset(f'usuario:{usuario}', mapping={'nombre_completo': 'Benchmark', 'nombre_usuario': usuario, 'contrasenia': contrasenia, 'privilegios': 1})
+    pipeline.execute()
+
+    def memoria() -> int:
+        return cliente.info('memory')['used_memory']
+
+    def resultado(antes: int, despues: int) -> dict:
+        por_sesion = (despues - antes) / sesiones
+        return {'bytes_por_sesion': por_sesion, 'sesiones_150mb': int(limite / por_sesion) if por_sesion > 0 else None}
+
+    # Distribucion anterior, una clave por token y otra por usuario
+    antes = memoria()
+    tokens = [practica2.script_iniciar_sesion(args=['', usuario, contrasenia, str(uuid.uuid4()), practica2.TTL_TOKEN])[0] for usuario in usuarios]
+    resultados = {'claves': resultado(antes, memoria())}
+    cliente.delete(*tokens, *[f'token:{usuario}' for usuario in usuarios])
+
+    # Distribucion compacta, con un prefijo propio para no mezclarla con las sesiones reales
+    compactas = practica2.SesionesCompactas(buckets, prefijo='benchmark-sesiones')
+    antes = memoria()
+    for usuario in usuarios: compactas.iniciar_sesion(usuario, contrasenia, None)
+    resultados['compacta'] = resultado(antes, memoria())
+
+    claves = [f'benchmark-sesiones:{tipo}:{bucket}' for tipo in ('tokens', 'usuarios') for bucket in range(buckets)]
+    pipeline = cliente.pipeline(transaction=False)
+    for clave in claves: pipeline.object('encoding', clave)
+    codificaciones = collections.Counter(codificacion for codificacion in pipeline.execute() if codificacion)
+    resultados['compacta'].update({'hexpire': compactas.expiracion_campos, 'codificaciones': dict(codificaciones)})
+
+    cliente.delete(*claves, *[f'usuario:{usuario}' for usuario in usuarios])
+
+    return resultados
+
+
+def benchmark_codecs() -> dict[str, dict[str, float]]:
+    """
+    Compara los formatos de la cache con los documentos de ejemplo.
+    """
+
+    personas = cargar_personas()
+
+    # El formato json no admite ObjectId ni datetime, se comparan sin la fecha
+    sin_fecha = [{clave: valor for clave, valor in persona.items() if clave != 'fecha_alta'} for persona in personas]
+
+    return {
+        'json (sin fecha)': benchmark_codec(JsonCodec(), sin_fecha),
+        'bson (sin fecha)': benchmark_codec(BsonCodec(), sin_fecha),
+        'bson (con fecha)': benchmark_codec(BsonCodec(), personas)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark del ODM')
+    parser.add_argument('--memoria', action='store_true', help='usa mongomock y fakeredis en lugar de servidores locales')
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--db-name', default='benchmark_odm', help='base de datos de mongo, se borra al empezar')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--documentos', type=int, default=1000)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--salida', default='benchmark.json', help='fichero json con los resultados')
+    parser.add_argument('--login', action='store_true', help='mide solo los inicios de sesion de practica2 (redis local)')
+    parser.add_argument('--memoria-sesiones', type=int, metavar='SESIONES', help='mide solo la memoria por sesion de practica2 (redis local)')
+    parser.add_argument('--buckets', type=int, default=1024, help='buckets de las sesiones compactas')
+    argumentos = parser.parse_args()
+
+    contador = Contador()
+    if argumentos.memoria_sesiones:
+        resultados = {
+            'fecha': datetime.datetime.now().isoformat(),
+            'sesiones': argumentos.memoria_sesiones,
+            'buckets': argumentos.buckets,
+            'operaciones': benchmark_memoria_sesiones(argumentos.memoria_sesiones, argumentos.buckets)
+        }
+
+    elif argumentos.login:
+        resultados = {
+            'fecha': datetime.datetime.now().isoformat(),
+            'repeticiones': argumentos.repeticiones,
+            'operaciones': benchmark_login(argumentos.repeticiones)
+        }
+
+    else:
+        if argumentos.memoria:
+            import fakeredis
+            import mongomock
+
+            base_datos = mongomock.MongoClient()[argumentos.db_name]
+            modelos = crear_modelos(base_datos, contador.contar_redis(fakeredis.FakeRedis()), contador)
+        else:
+            cliente_mongodb = pymongo.MongoClient(argumentos.mongodb_uri, event_listeners=[contador])
+            cliente_mongodb.drop_database(argumentos.db_name)
+            base_datos = cliente_mongodb[argumentos.db_name]
+            modelos = crear_modelos(base_datos, contador.contar_redis(redis.Redis(host=argumentos.redis_host, port=argumentos.redis_port)))
+
+        resultados = {
+            'fecha': datetime.datetime.now().isoformat(),
+            'entorno': 'memoria' if argumentos.memoria else 'local',
+            'documentos': argumentos.documentos,
+            'repeticiones': argumentos.repeticiones,
+            'operaciones': benchmark_odm(modelos, contador, argumentos.documentos, argumentos.repeticiones),
+            'codecs': benchmark_codecs()
+        }
+
+    with open(argumentos.salida, 'w') as fichero:
+        json.dump(resultados, fichero, indent=4)
+
+    for operacion, medida in resultados['operaciones'].items():
+        print(f'{operacion}: {medida}')
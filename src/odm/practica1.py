@@ -1,16 +1,322 @@
 __author__ = 'Adrian Toral / Dario Llodra'
 
+import abc
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import itertools
 import json
+import logging
+import os
+import sqlite3
+import threading
 import time
-from typing import Generator, Any, Self
+import unicodedata
+import weakref
+from typing import Generator, AsyncGenerator, Any, Callable, Self
 
 import bson
+import bson.json_util
 import pymongo
+import pymongo.monitoring
 import redis
+import redis.asyncio
 import yaml
 from geojson import Point
 from geopy.exc import GeocoderTimedOut
 from geopy.geocoders import Nominatim
+from pymongo.errors import BulkWriteError, OperationFailure
+
+# Errores de los hilos en segundo plano, que no se pueden lanzar a quien llama
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Limitador de peticiones por cubo de fichas.
+    Cada peticion consume una ficha y las fichas se recargan a un
+    ritmo constante hasta llenar la capacidad del cubo.
+
+    Attributes
+    ----------
+        rate : float
+            fichas que se recargan por segundo
+        capacity : float
+            numero maximo de fichas acumuladas
+
+    Methods
+    -------
+        acquire() -> None
+            Espera hasta que haya una ficha disponible y la consume.
+    """
+
+    def __init__(self, rate: float = 1, capacity: float = 1):
+        """
+        Inicializa el cubo lleno
+
+        Parameters
+        ----------
+            rate : float
+                fichas que se recargan por segundo
+            capacity : float
+                numero maximo de fichas acumuladas
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.fichas = capacity
+        self.ultima_recarga = time.monotonic()
+        self.cerrojo = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Espera hasta que haya una ficha disponible y la consume.
+        """
+
+        with self.cerrojo:
+            while True:
+                ahora = time.monotonic()
+                self.fichas = min(self.capacity, self.fichas + (ahora - self.ultima_recarga) * self.rate)
+                self.ultima_recarga = ahora
+
+                if self.fichas >= 1:
+                    self.fichas -= 1
+                    return
+
+                time.sleep((1 - self.fichas) / self.rate)
+
+
+class GeocodingCache:
+    """
+    Cache persistente de direcciones a puntos geojson.
+    Guarda los puntos en un fichero sqlite y, opcionalmente, en redis
+    para compartirlos entre procesos sin acceder al disco.
+
+    Attributes
+    ----------
+        path : str
+            ruta al fichero sqlite de la cache
+        redis : redis.Redis | None
+            conexion a redis opcional para el primer nivel de la cache
+
+    Methods
+    -------
+        get(clave: str) -> Point | None
+            Devuelve el punto guardado para la clave o None si no existe.
+        set(clave: str, punto: Point) -> None
+            Guarda el punto de la clave en todos los niveles de la cache.
+    """
+
+    def __init__(self, path: str = 'geocoding.sqlite3', redis_connection: redis.Redis | None = None):
+        """
+        Abre el fichero sqlite de la cache y crea la tabla si no existe
+
+        Parameters
+        ----------
+            path : str
+                ruta al fichero sqlite de la cache
+            redis_connection : redis.Redis | None
+                conexion a redis opcional para el primer nivel de la cache
+        """
+
+        self.path = path
+        self.redis = redis_connection
+        self.cerrojo = threading.Lock()
+        self.conexion = sqlite3.connect(path, check_same_thread=False)
+        self.conexion.execute('CREATE TABLE IF NOT EXISTS geocoding (direccion TEXT PRIMARY KEY, punto TEXT NOT NULL)')
+
+        # La version 0 guardaba los puntos como (latitud, longitud),
+        # geojson y los indices 2dsphere los esperan como (longitud, latitud)
+        if self.conexion.execute('PRAGMA user_version').fetchone()[0] < 1:
+            filas = self.conexion.execute('SELECT direccion, punto FROM geocoding').fetchall()
+            self.conexion.executemany('UPDATE geocoding SET punto = ? WHERE direccion = ?',
+                                      [(json.dumps(json.loads(punto)[::-1]), direccion) for direccion, punto in filas])
+            self.conexion.execute('PRAGMA user_version = 1')
+
+        self.conexion.commit()
+
+    def get(self, clave: str) -> Point | None:
+        """
+        Devuelve el punto guardado para la clave o None si no existe.
+        Si el punto solo esta en sqlite, se copia a redis.
+
+        Parameters
+        ----------
+            clave : str
+                direccion normalizada
+        Returns
+        -------
+            geojson.Point | None
+                punto de la direccion o None si no esta en la cache
+        """
+
+        # Las claves geocoding: de redis guardaban los puntos como (latitud, longitud)
+        if self.redis is not None and (punto := self.redis.get(f'geopunto:{clave}')) is not None:
+            return Point(tuple(json.loads(punto)))
+
+        with self.cerrojo:
+            fila = self.conexion.execute('SELECT punto FROM geocoding WHERE direccion = ?', (clave,)).fetchone()
+
+        if fila is None: return None
+
+        if self.redis is not None: self.redis.setex(f'geopunto:{clave}', 60 * 60 * 24 * 30, fila[0])
+        return Point(tuple(json.loads(fila[0])))
+
+    def set(self, clave: str, punto: Point) -> None:
+        """
+        Guarda el punto de la clave en todos los niveles de la cache.
+
+        Parameters
+        ----------
+            clave : str
+                direccion normalizada
+            punto : geojson.Point
+                punto de la direccion
+        """
+
+        coordenadas = json.dumps(list(punto['coordinates']))
+
+        with self.cerrojo:
+            self.conexion.execute('INSERT OR REPLACE INTO geocoding (direccion, punto) VALUES (?, ?)', (clave, coordenadas))
+            self.conexion.commit()
+
+        if self.redis is not None: self.redis.setex(f'geopunto:{clave}', 60 * 60 * 24 * 30, coordenadas)
+
+
+class Geocoder:
+    """
+    Obtiene puntos geojson a partir de direcciones utilizando una cache
+    persistente y limitando las peticiones al proveedor.
+    El proveedor puede ser cualquier objeto con un metodo
+    geocode(address) que devuelva un objeto con latitude y longitude,
+    o None si no encuentra la direccion (la interfaz de geopy).
+
+    Attributes
+    ----------
+        provider : Any
+            proveedor de geolocalizacion, Nominatim por defecto
+        cache : GeocodingCache
+            cache persistente de los puntos
+        limiter : TokenBucket
+            limitador de peticiones al proveedor
+        provider_calls : int
+            numero de peticiones realizadas al proveedor
+
+    Methods
+    -------
+        normalize(address: str) -> str
+            Normaliza una direccion para utilizarla como clave de la cache.
+        locate(address: str) -> Point
+            Devuelve el punto de una direccion.
+        locate_many(addresses: list[str]) -> dict[str, Point]
+            Devuelve los puntos de varias direcciones sin repetir peticiones.
+    """
+
+    def __init__(self, provider: Any = None, cache: GeocodingCache | None = None, limiter: TokenBucket | None = None):
+        """
+        Inicializa el geocodificador
+
+        Parameters
+        ----------
+            provider : Any
+                proveedor de geolocalizacion, Nominatim por defecto
+            cache : GeocodingCache | None
+                cache persistente, por defecto un fichero sqlite local
+            limiter : TokenBucket | None
+                limitador de peticiones, por defecto una peticion por segundo
+        """
+
+        self.provider = provider if provider is not None else Nominatim(user_agent='adtodallo')
+        self.cache = cache if cache is not None else GeocodingCache()
+        self.limiter = limiter if limiter is not None else TokenBucket()
+        self.provider_calls = 0
+
+    @staticmethod
+    def normalize(address: str) -> str:
+        """
+        Normaliza una direccion para utilizarla como clave de la cache.
+        Ignora mayusculas, espacios repetidos y comas o espacios en los extremos.
+
+        Parameters
+        ----------
+            address : str
+                direccion a normalizar
+        Returns
+        -------
+            str
+                direccion normalizada
+        """
+
+        return ' '.join(unicodedata.normalize('NFKC', address).casefold().split()).strip(' ,')
+
+    def locate(self, address: str) -> Point:
+        """
+        Devuelve el punto de una direccion.
+        Solo se consulta al proveedor si la direccion no esta en la cache.
+
+        Parameters
+        ----------
+            address : str
+                direccion completa de la que obtener las coordenadas
+        Returns
+        -------
+            geojson.Point
+                coordenadas del punto de la direccion
+        """
+
+        clave = self.normalize(address)
+        if (punto := self.cache.get(clave)) is not None: return punto
+
+        location = None
+        while location is None:
+            try:
+                self.limiter.acquire()
+                self.provider_calls += 1
+                location = self.provider.geocode(address)
+            except GeocoderTimedOut:
+                # Puede lanzar una excepcion si se supera el tiempo de espera
+                # Volver a intentarlo
+                continue
+
+            if location is None:
+                raise Exception(f'[5] Direccion "{address}" no encontrada.')
+
+        # geojson ordena las coordenadas como (longitud, latitud)
+        punto = Point((location.longitude, location.latitude))
+        self.cache.set(clave, punto)
+        return punto
+
+    def locate_many(self, addresses: list[str]) -> dict[str, Point]:
+        """
+        Devuelve los puntos de varias direcciones.
+        Las direcciones que son iguales una vez normalizadas solo se
+        consultan una vez.
+
+        Parameters
+        ----------
+            addresses : list[str]
+                direcciones de las que obtener las coordenadas
+        Returns
+        -------
+            dict[str, geojson.Point]
+                puntos de cada una de las direcciones proporcionadas
+        """
+
+        puntos: dict[str, Point] = {}
+        for address in addresses:
+            clave = self.normalize(address)
+            if clave not in puntos: puntos[clave] = self.locate(address)
+
+        return {address: puntos[self.normalize(address)] for address in addresses}
+
+
+# Geocodificador compartido por getLocationPoint, se crea en la primera llamada
+geocoder: Geocoder | None = None
 
 
 def getLocationPoint(address: str) -> Point:
@@ -18,109 +324,2617 @@ def getLocationPoint(address: str) -> Point:
     Obtiene las coordenadas de una dirección en formato geojson.Point
     Utilizar la API de geopy para obtener las coordenadas de la direccion
     Cuidado, la API es publica tiene limite de peticiones, utilizar sleeps.
+    Los resultados se guardan en una cache persistente y las peticiones
+    a la API se limitan a una por segundo.
+
+    Parameters
+    ----------
+        address : str
+            direccion completa de la que obtener las coordenadas
+    Returns
+    -------
+        geojson.Point
+            coordenadas del punto de la direccion
+    """
+
+    global geocoder
+    if geocoder is None: geocoder = Geocoder()
+
+    return geocoder.locate(address)
+
+
+# Actualiza variables de un documento de la cache solo si ya esta en ella,
+# para no dejar en la cache documentos a medias.
+# KEYS[1] clave del documento, ARGV[1] tiempo de vida, resto pares variable valor
+ACTUALIZAR_HASH = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Reemplaza un documento de la cache por su version nueva solo si ya esta
+# en ella, eliminando las variables que ya no tiene.
+# KEYS[1] clave del documento, ARGV[1] tiempo de vida, resto pares variable valor
+REEMPLAZAR_HASH = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('DEL', KEYS[1])
+    if #ARGV > 1 then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+    return 1
+end
+return 0
+"""
+
+# Elimina un documento de la cache salvo que ya tenga los valores del cambio,
+# como ocurre con los cambios que ha hecho el propio ODM al guardarlo
+# KEYS[1] clave del documento, ARGV[1] numero de variables del documento completo
+# o -1 si el cambio solo tiene algunas, resto pares variable valor
+EXPULSAR_SI_CAMBIA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local iguales = ARGV[1] == '-1' or redis.call('HLEN', KEYS[1]) == tonumber(ARGV[1])
+for indice = 2, #ARGV, 2 do
+    if not iguales then break end
+    iguales = redis.call('HGET', KEYS[1], ARGV[indice]) == ARGV[indice + 1]
+end
+if iguales then return 0 end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+class CacheCodec(abc.ABC):
+    """
+    Interfaz de los formatos en los que se guardan los documentos en la cache.
+    Los formatos con version anteponen un byte con su version a los datos
+    para que documentos guardados con formatos distintos puedan convivir.
+
+    Attributes
+    ----------
+        version : int | None
+            byte de version del formato, None para el formato json original
+
+    Methods
+    -------
+        encode(documento: dict) -> bytes
+            Codifica un documento para guardarlo en la cache.
+        decode(datos: bytes) -> dict
+            Decodifica un documento guardado en la cache.
+        encode_value(valor: Any) -> bytes
+            Codifica el valor de una variable para guardarlo en un hash de la cache.
+        decode_value(datos: bytes) -> Any
+            Decodifica el valor de una variable guardado en un hash de la cache.
+    """
+
+    version: int | None = None
+
+    @abc.abstractmethod
+    def encode(self, documento: dict) -> bytes: ...
+
+    @abc.abstractmethod
+    def decode(self, datos: bytes) -> dict: ...
+
+    @abc.abstractmethod
+    def encode_value(self, valor: Any) -> bytes: ...
+
+    @abc.abstractmethod
+    def decode_value(self, datos: bytes) -> Any: ...
+
+
+class JsonCodec(CacheCodec):
+    """
+    Formato json original, sin byte de version.
+    No guarda el _id, que se obtiene de la clave del documento en la cache.
+    """
+
+    def encode(self, documento: dict) -> bytes:
+        datos = documento.copy()
+        datos.pop('_id', None)
+        return json.dumps(datos).encode()
+
+    def decode(self, datos: bytes) -> dict:
+        return json.loads(datos)
+
+    def encode_value(self, valor: Any) -> bytes:
+        return self.encode({'v': valor})
+
+    # Los valores pueden estar guardados con otro formato, se decodifican segun su version
+    def decode_value(self, datos: bytes) -> Any:
+        return decodeCache(datos)['v']
+
+
+class BsonCodec(CacheCodec):
+    """
+    Formato binario bson, mantiene los tipos de mongo (ObjectId,
+    datetime, ...) sin perdidas, incluidos los anidados.
+    """
+
+    version = 1
+
+    def encode(self, documento: dict) -> bytes:
+        return bytes((self.version,)) + bson.encode(documento)
+
+    def decode(self, datos: bytes) -> dict:
+        return bson.decode(datos[1:])
+
+    def encode_value(self, valor: Any) -> bytes:
+        return self.encode({'v': valor})
+
+    def decode_value(self, datos: bytes) -> Any:
+        return decodeCache(datos)['v']
+
+
+# Formatos con version que se pueden leer de la cache
+CACHE_CODECS: dict[int, CacheCodec] = {codec.version: codec for codec in (BsonCodec(),)}
+
+
+def decodeCache(datos: bytes | str) -> dict:
+    """
+    Decodifica un documento de la cache con el formato con el que se guardo.
+    Los documentos json originales empiezan por '{', el resto por el
+    byte de version de su formato.
+
+    Parameters
+    ----------
+        datos : bytes | str
+            documento guardado en la cache
+    Returns
+    -------
+        dict
+            documento decodificado
+    """
+
+    if isinstance(datos, str): datos = datos.encode()
+    if datos[:1] == b'{': return JsonCodec().decode(datos)
+
+    if (codec := CACHE_CODECS.get(datos[0])) is None:
+        raise Exception(f'[6] Formato de cache "{datos[0]}" desconocido.')
+
+    return codec.decode(datos)
+
+
+# Reclama de forma atomica un lote de documentos pendientes de escribir en mongo
+# Los cambios de cada documento pasan a <prefijo><id>:procesando y su id al conjunto ordenado
+# de reclamados con el instante (ms) en que caduca la reclamacion. Si no se confirma a tiempo
+# se vuelve a reclamar, primero se reclaman los caducados y despues los pendientes
+# KEYS[1] conjunto de ids pendientes, KEYS[2] ids reclamados
+# ARGV[1] tamanio del lote, ARGV[2] prefijo de los cambios, ARGV[3] ms de la reclamacion
+# Devuelve el instante en que caduca la reclamacion seguido de pares id, cambios
+RECLAMAR_PENDIENTES = """
+local tiempo = redis.call('TIME')
+local ahora = tonumber(tiempo[1]) * 1000 + math.floor(tonumber(tiempo[2]) / 1000)
+local limite = ahora + tonumber(ARGV[3])
+
+local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ahora, 'LIMIT', 0, ARGV[1])
+local ocupados = {}
+if #ids < tonumber(ARGV[1]) then
+    for _, id in ipairs(redis.call('SPOP', KEYS[1], tonumber(ARGV[1]) - #ids)) do
+        -- Si otro proceso lo esta escribiendo, sus cambios nuevos esperan al siguiente lote
+        local reclamado = redis.call('ZSCORE', KEYS[2], id)
+        if reclamado and tonumber(reclamado) > ahora then ocupados[#ocupados + 1] = id
+        else ids[#ids + 1] = id end
+    end
+end
+if #ocupados > 0 then redis.call('SADD', KEYS[1], unpack(ocupados)) end
+
+local reclamados = {tostring(limite)}
+for _, id in ipairs(ids) do
+    local cambios = ARGV[2] .. id
+    local procesando = cambios .. ':procesando'
+
+    -- Los cambios nuevos se escriben encima de los reclamados que no se confirmaron
+    local campos = redis.call('HGETALL', cambios)
+    if #campos > 0 then
+        redis.call('HSET', procesando, unpack(campos))
+        redis.call('DEL', cambios)
+    end
+
+    redis.call('SREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], limite, id)
+    reclamados[#reclamados + 1] = id
+    reclamados[#reclamados + 1] = redis.call('HGETALL', procesando)
+end
+return reclamados
+"""
+
+# Confirma los documentos escritos en mongo o libera los que no se han podido escribir
+# Solo si siguen reclamados con el mismo limite, si no los ha reclamado otro proceso
+# KEYS[1] ids reclamados, ARGV[1] prefijo de los cambios, ARGV[2] limite de la reclamacion,
+# ARGV[3] '1' para confirmar o '0' para liberar, ARGV[4...] ids
+CERRAR_RECLAMACION = """
+for indice = 4, #ARGV do
+    local id = ARGV[indice]
+    if tonumber(redis.call('ZSCORE', KEYS[1], id)) == tonumber(ARGV[2]) then
+        if ARGV[3] == '1' then
+            redis.call('ZREM', KEYS[1], id)
+            redis.call('DEL', ARGV[1] .. id .. ':procesando')
+        else
+            -- La reclamacion caduca ya, el siguiente flush lo vuelve a reclamar
+            redis.call('ZADD', KEYS[1], 0, id)
+        end
+    end
+end
+return 1
+"""
+
+# Canal de redis por el que se avisa a todos los procesos de los documentos modificados
+CANAL_NEAR_CACHE = 'odm:near-cache'
+
+
+class NearCache:
+    """
+    Cache local del proceso que se situa delante de redis para los
+    documentos mas consultados. Las entradas caducan tras un tiempo
+    y se eliminan las menos usadas cuando se supera el numero de
+    entradas o de bytes permitido.
+    Los documentos se guardan tal y como estan en redis (variables
+    codificadas), asi cada consulta devuelve un modelo nuevo.
+
+    Attributes
+    ----------
+        max_entries : int
+            numero maximo de documentos guardados
+        max_bytes : int
+            numero maximo de bytes de las variables guardadas
+        ttl : float
+            segundos que dura cada entrada
+        hits : int
+            consultas encontradas en la cache local
+        misses : int
+            consultas no encontradas en la cache local
+
+    Methods
+    -------
+        get(clave: str) -> dict | None
+            Devuelve las variables de un documento o None si no esta.
+        set(clave: str, campos: dict) -> None
+            Guarda las variables de un documento.
+        invalidate(clave: str) -> None
+            Elimina un documento de la cache local.
+        clear() -> None
+            Elimina todos los documentos de la cache local.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 5):
+        """
+        Inicializa la cache local vacia
+
+        Parameters
+        ----------
+            max_entries : int
+                numero maximo de documentos guardados
+            max_bytes : int
+                numero maximo de bytes de las variables guardadas
+            ttl : float
+                segundos que dura cada entrada
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.entradas: collections.OrderedDict[str, tuple[float, int, dict]] = collections.OrderedDict()
+        self.cerrojo = threading.Lock()
+
+    def get(self, clave: str) -> dict | None:
+        """
+        Devuelve las variables de un documento o None si no esta o ha caducado.
+
+        Parameters
+        ----------
+            clave : str
+                clave del documento en redis
+        Returns
+        -------
+            dict | None
+                variables codificadas del documento
+        """
+
+        with self.cerrojo:
+            entrada = self.entradas.get(clave)
+            if entrada is None or entrada[0] < time.monotonic():
+                if entrada is not None: self._eliminar(clave)
+                self.misses += 1
+                return None
+
+            self.entradas.move_to_end(clave)
+            self.hits += 1
+            return entrada[2]
+
+    def set(self, clave: str, campos: dict) -> None:
+        """
+        Guarda las variables de un documento y elimina los menos usados
+        si se superan los limites de la cache.
+
+        Parameters
+        ----------
+            clave : str
+                clave del documento en redis
+            campos : dict
+                variables codificadas del documento
+        """
+
+        tamanio = sum(len(campo) + len(valor) for campo, valor in campos.items())
+        if tamanio > self.max_bytes: return
+
+        with self.cerrojo:
+            if clave in self.entradas: self._eliminar(clave)
+            self.entradas[clave] = (time.monotonic() + self.ttl, tamanio, campos)
+            self.bytes += tamanio
+
+            while len(self.entradas) > self.max_entries or self.bytes > self.max_bytes:
+                self._eliminar(next(iter(self.entradas)))
+
+    def invalidate(self, clave: str) -> None:
+        """
+        Elimina un documento de la cache local.
+
+        Parameters
+        ----------
+            clave : str
+                clave del documento en redis
+        """
+
+        with self.cerrojo:
+            if clave in self.entradas: self._eliminar(clave)
+
+    def clear(self) -> None:
+        """
+        Elimina todos los documentos de la cache local.
+        """
+
+        with self.cerrojo:
+            self.entradas.clear()
+            self.bytes = 0
+
+    def _eliminar(self, clave: str) -> None:
+        self.bytes -= self.entradas.pop(clave)[1]
+
+
+# Caches locales de cada modelo y suscripcion al canal de invalidaciones del proceso
+near_caches: dict[str, NearCache] = {}
+suscripcion_near_cache: redis.client.PubSubWorkerThread | None = None
+modelo_suscripcion: type | None = None
+
+
+def suscribirNearCache(model_class: type) -> None:
+    """
+    Se suscribe al canal de invalidaciones con la conexion del modelo
+    si el proceso no esta suscrito todavia. Una sola suscripcion por
+    proceso sirve para todos los modelos.
+
+    Parameters
+    ----------
+        model_class : type[Model]
+            modelo cuya conexion a redis se utiliza
+    """
+
+    global suscripcion_near_cache, modelo_suscripcion
+
+    if suscripcion_near_cache is not None: return
+
+    pubsub = model_class.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{CANAL_NEAR_CACHE: invalidarNearCache})
+    suscripcion_near_cache = pubsub.run_in_thread(sleep_time=1, daemon=True)
+    modelo_suscripcion = model_class
+
+
+def reiniciarNearCache() -> None:
+    """
+    Tras un fork el hilo de la suscripcion no existe en el proceso hijo,
+    se vacian las caches locales y se vuelve a suscribir al canal.
+    """
+
+    global suscripcion_near_cache
+
+    suscripcion_near_cache = None
+    for cache in near_caches.values():
+        cache.cerrojo = threading.Lock()
+        cache.entradas.clear()
+        cache.bytes = 0
+
+    if modelo_suscripcion is not None: suscribirNearCache(modelo_suscripcion)
+
+
+os.register_at_fork(after_in_child=reiniciarNearCache)
+
+
+def invalidarNearCache(mensaje: dict) -> None:
+    """
+    Elimina de la cache local del modelo el documento recibido por el
+    canal de invalidaciones.
+
+    Parameters
+    ----------
+        mensaje : dict
+            mensaje de redis con la clave del documento modificado
+    """
+
+    clave = mensaje['data'].decode() if isinstance(mensaje['data'], bytes) else mensaje['data']
+    if (cache := near_caches.get(clave.split(':', 1)[0])) is not None: cache.invalidate(clave)
+
+
+class Histograma:
+    """
+    Histograma de latencias con limites fijos en escala logaritmica.
+
+    Attributes
+    ----------
+        cuentas : list[int]
+            numero de medidas en cada intervalo, la ultima sin limite
+        total : float
+            suma de las medidas en segundos
+    """
+
+    # Limites superiores de cada intervalo en segundos
+    LIMITES = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.cuentas = [0] * (len(self.LIMITES) + 1)
+        self.total = 0.0
+
+    def registrar(self, segundos: float) -> None:
+        self.cuentas[bisect.bisect_left(self.LIMITES, segundos)] += 1
+        self.total += segundos
+
+    def snapshot(self) -> dict[str, Any]:
+        cuenta = sum(self.cuentas)
+        return {
+            'count': cuenta,
+            'total_ms': self.total * 1e3,
+            'media_ms': self.total * 1e3 / cuenta if cuenta else 0.0,
+            'buckets': {f'<={limite * 1e3:g}ms': n for limite, n in zip(self.LIMITES, self.cuentas)} | {'>1000ms': self.cuentas[-1]}
+        }
+
+
+class Instrumentacion(pymongo.monitoring.CommandListener):
+    """
+    Registra, por modelo, los aciertos y fallos de la cache, las
+    latencias de cada operacion del modelo y las peticiones a mongo
+    y redis que hace cada una.
+    Las operaciones del modelo guardan en un contextvar el modelo y la
+    operacion en curso, y las peticiones que se hacen durante ella se
+    asignan a ese modelo. Las de mongo se miden como CommandListener
+    y las de redis envolviendo el cliente.
+
+    Attributes
+    ----------
+        exporter : Callable[[dict], None] | None
+            funcion que recibe periodicamente el snapshot de todos los modelos
+        interval : float
+            segundos entre cada llamada al exporter
+
+    Methods
+    -------
+        medir(modelo: str, operacion: str, funcion: Callable, *args, **kwargs) -> Any
+            Ejecuta una operacion del modelo midiendo su latencia.
+        cache(modelo: str, evento: str, cantidad: int) -> None
+            Suma un evento de la cache del modelo.
+        instrumentar_redis(cliente: redis.Redis) -> redis.Redis
+            Envuelve los comandos y pipelines del cliente para medirlos.
+        snapshot(modelo: str | None) -> dict
+            Devuelve una copia de las medidas de un modelo o de todos.
+        export() -> None
+            Envia el snapshot de todos los modelos al exporter.
+    """
+
+    # Modelo y operacion en curso en el hilo o tarea actual
+    contexto: contextvars.ContextVar[tuple[str, str] | None] = contextvars.ContextVar('odm_operacion', default=None)
+
+    def __init__(self, exporter: Callable[[dict], None] | None = None, interval: float = 10):
+        self.exporter = exporter
+        self.interval = interval
+        self.cerrojo = threading.Lock()
+        self.modelos: dict[str, dict] = {}
+        self.pendientes: dict[int, tuple[str, float]] = {}
+        self.hilo: threading.Thread | None = None
+        self.parar = threading.Event()
+
+    def _datos(self, modelo: str) -> dict:
+        if (datos := self.modelos.get(modelo)) is None:
+            datos = self.modelos.setdefault(modelo, {
+                'cache': collections.Counter(),
+                'operaciones': collections.defaultdict(Histograma),
+                'mongo': collections.defaultdict(Histograma),
+                'redis': collections.defaultdict(Histograma)
+            })
+
+        return datos
+
+    def _modelo_actual(self) -> str:
+        return (operacion := self.contexto.get()) and operacion[0] or 'global'
+
+    def medir(self, modelo: str, operacion: str, funcion: Callable, *args, **kwargs) -> Any:
+        token = self.contexto.set((modelo, operacion))
+        inicio = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            duracion = time.perf_counter() - inicio
+            self.contexto.reset(token)
+            with self.cerrojo: self._datos(modelo)['operaciones'][operacion].registrar(duracion)
+
+    def cache(self, modelo: str, evento: str, cantidad: int = 1) -> None:
+        with self.cerrojo: self._datos(modelo)['cache'][evento] += cantidad
+
+    def _redis(self, comando: str, duracion: float) -> None:
+        with self.cerrojo: self._datos(self._modelo_actual())['redis'][comando].registrar(duracion)
+
+    # CommandListener de pymongo, los eventos llegan en el hilo que hace la peticion
+    # Los clientes conservan el listener con el que se crearon, las medidas
+    # se registran en la instrumentacion activa y se ignoran si no hay ninguna
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        if (actual := instrumentacion) is None: return
+        with actual.cerrojo: actual.pendientes[event.request_id] = actual._modelo_actual()
+
+    def succeeded(self, event: pymongo.monitoring.CommandSucceededEvent) -> None:
+        if (actual := instrumentacion) is not None: actual._mongo(event)
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        if (actual := instrumentacion) is not None: actual._mongo(event)
+
+    def _mongo(self, event: pymongo.monitoring.CommandSucceededEvent | pymongo.monitoring.CommandFailedEvent) -> None:
+        with self.cerrojo:
+            modelo = self.pendientes.pop(event.request_id, 'global')
+            self._datos(modelo)['mongo'][event.command_name].registrar(event.duration_micros / 1e6)
+
+    def instrumentar_redis(self, cliente: redis.Redis) -> redis.Redis:
+        """
+        Envuelve los comandos sueltos y los pipelines del cliente de
+        redis para medir su latencia. Los pipelines se registran como
+        un solo comando PIPELINE o MULTI.
+
+        Parameters
+        ----------
+            cliente : redis.Redis
+                cliente de redis a instrumentar
+        Returns
+        -------
+            redis.Redis
+                el mismo cliente
+        """
+
+        if getattr(cliente, '_instrumentado', False): return cliente
+
+        execute_command = cliente.execute_command
+        pipeline = cliente.pipeline
+
+        # El cliente queda instrumentado para siempre, las medidas se registran en
+        # la instrumentacion activa en cada llamada y se ignoran si no hay ninguna
+        def comando(*args, **options):
+            if instrumentacion is None: return execute_command(*args, **options)
+            inicio = time.perf_counter()
+            try: return execute_command(*args, **options)
+            finally:
+                if (actual := instrumentacion) is not None: actual._redis(str(args[0]).split(' ')[0].upper(), time.perf_counter() - inicio)
+
+        def pipeline_medido(transaction: bool = True, shard_hint: Any = None):
+            nuevo = pipeline(transaction, shard_hint)
+            execute = nuevo.execute
+
+            def ejecutar(raise_on_error: bool = True):
+                if not nuevo.command_stack or instrumentacion is None: return execute(raise_on_error)
+                inicio = time.perf_counter()
+                try: return execute(raise_on_error)
+                finally:
+                    if (actual := instrumentacion) is not None: actual._redis('MULTI' if transaction else 'PIPELINE', time.perf_counter() - inicio)
+
+            nuevo.execute = ejecutar
+            return nuevo
+
+        cliente.execute_command = comando
+        cliente.pipeline = pipeline_medido
+        cliente._instrumentado = True
+        return cliente
+
+    def snapshot(self, modelo: str | None = None) -> dict:
+        """
+        Devuelve una copia de las medidas de un modelo, o de todos los
+        modelos por nombre si no se indica ninguno.
+
+        Parameters
+        ----------
+            modelo : str | None
+                nombre del modelo
+        Returns
+        -------
+            dict
+                aciertos, fallos y rellenos de la cache, tasa de aciertos
+                e histogramas de operaciones, comandos de mongo y de redis
+        """
+
+        with self.cerrojo:
+            if modelo is None: return {nombre: self._snapshot(datos) for nombre, datos in self.modelos.items()}
+            return self._snapshot(self._datos(modelo))
+
+    @staticmethod
+    def _snapshot(datos: dict) -> dict:
+        cache = dict(datos['cache'])
+        consultas = cache.get('hits', 0) + cache.get('misses', 0)
+        cache['hit_ratio'] = cache.get('hits', 0) / consultas if consultas else 0.0
+
+        return {'cache': cache} | {
+            tipo: {nombre: histograma.snapshot() for nombre, histograma in datos[tipo].items()}
+            for tipo in ('operaciones', 'mongo', 'redis')
+        }
+
+    def export(self) -> None:
+        if self.exporter is not None: self.exporter(self.snapshot())
+
+    def start(self) -> None:
+        if self.exporter is None or (self.hilo is not None and self.hilo.is_alive()): return
+
+        self.parar.clear()
+        self.hilo = threading.Thread(target=self._bucle, name='odm-instrumentacion', daemon=True)
+        self.hilo.start()
+
+    def stop(self) -> None:
+        self.parar.set()
+        if self.hilo is not None: self.hilo.join()
+        self.hilo = None
+        self.export()
+
+    def _bucle(self) -> None:
+        while not self.parar.wait(self.interval):
+            try: self.export()
+            except Exception: logger.exception('[9] Error al exportar las metricas')
+
+
+# Instrumentacion activa, None cuando esta desactivada
+instrumentacion: Instrumentacion | None = None
+
+
+def enableInstrumentation(exporter: Callable[[dict], None] | None = None, interval: float = 10) -> Instrumentacion:
+    """
+    Activa la instrumentacion de los modelos.
+    Los clientes de mongo y redis que crea initApp se instrumentan al
+    crearse, por lo que debe activarse antes de la primera peticion. Los
+    clientes creados fuera de initApp se instrumentan con instrumentar_redis
+    y pasando la instrumentacion en event_listeners de MongoClient.
+
+    Parameters
+    ----------
+        exporter : Callable[[dict], None] | None
+            funcion que recibe cada interval segundos el snapshot de todos los modelos
+        interval : float
+            segundos entre cada llamada al exporter
+    Returns
+    -------
+        Instrumentacion
+            instrumentacion activa
+    """
+
+    global instrumentacion
+
+    if instrumentacion is not None: instrumentacion.stop()
+    instrumentacion = Instrumentacion(exporter, interval)
+    instrumentacion.start()
+    atexit.register(instrumentacion.stop)
+
+    return instrumentacion
+
+
+def disableInstrumentation() -> None:
+    """
+    Desactiva la instrumentacion y envia las ultimas medidas al exporter.
+    Los clientes ya instrumentados dejan de registrar medidas, y vuelven
+    a hacerlo en la nueva instrumentacion si se activa otra vez.
+    """
+
+    global instrumentacion
+
+    if instrumentacion is None: return
+    anterior, instrumentacion = instrumentacion, None
+    atexit.unregister(anterior.stop)
+    anterior.stop()
+
+
+def medido(operacion: str) -> Callable:
+    """
+    Decorador de las operaciones del modelo que mide su latencia y asigna
+    al modelo las peticiones que hace. Sin instrumentacion solo comprueba
+    una variable global.
+
+    Parameters
+    ----------
+        operacion : str
+            nombre de la operacion en las medidas
+    """
+
+    def decorador(funcion: Callable) -> Callable:
+        @functools.wraps(funcion)
+        def medida(modelo: Any, *args, **kwargs) -> Any:
+            if instrumentacion is None: return funcion(modelo, *args, **kwargs)
+            nombre = modelo.__name__ if isinstance(modelo, type) else type(modelo).__name__
+            return instrumentacion.medir(nombre, operacion, funcion, modelo, *args, **kwargs)
+
+        return medida
+
+    return decorador
+
+
+def coleccionesRelacionadas(pipeline: Any) -> set[str]:
+    """
+    Devuelve las colecciones que consulta un pipeline de aggregate
+    ademas de la suya ($lookup, $graphLookup y $unionWith).
+
+    Parameters
+    ----------
+        pipeline : Any
+            pipeline o parte de un pipeline
+    Returns
+    -------
+        set[str]
+            nombres de las colecciones
+    """
+
+    colecciones: set[str] = set()
+
+    if isinstance(pipeline, list):
+        for elemento in pipeline: colecciones |= coleccionesRelacionadas(elemento)
+
+    elif isinstance(pipeline, dict):
+        for operador, valor in pipeline.items():
+            if operador in ('$lookup', '$graphLookup') and isinstance(valor, dict) and 'from' in valor:
+                colecciones.add(valor['from'])
+            elif operador == '$unionWith':
+                colecciones.add(valor if isinstance(valor, str) else valor['coll'])
+
+            colecciones |= coleccionesRelacionadas(valor)
+
+    return colecciones
+
+
+def coleccionesDestino(pipeline: list[dict], coleccion: str) -> set[str]:
+    """
+    Devuelve las colecciones en las que escribe un pipeline de aggregate
+    con $out o $merge.
+
+    Parameters
+    ----------
+        pipeline : list[dict]
+            pipeline de aggregate
+        coleccion : str
+            coleccion sobre la que se ejecuta el pipeline
+    Returns
+    -------
+        set[str]
+            nombres de las colecciones destino, vacio si no escribe
+    """
+
+    destinos: set[str] = set()
+    for etapa in pipeline:
+        destino = etapa.get('$out', etapa.get('$merge'))
+        if isinstance(destino, dict): destino = destino.get('into', destino.get('coll', coleccion))
+        if isinstance(destino, dict): destino = destino.get('coll', coleccion)
+        if destino is not None: destinos.add(destino)
+
+    return destinos
+
+
+# Etapas de aggregate que devuelven los documentos tal y como estan guardados
+ETAPAS_DOCUMENTOS_GUARDADOS = frozenset(('$match', '$sort', '$limit', '$skip'))
+
+
+class Model:
+    """ 
+    Clase de modelo abstracta
+    Crear tantas clases que hereden de esta clase como  
+    colecciones/modelos se deseen tener en la base de datos.
+
+    Attributes
+    ----------
+        required_vars : set[str]
+            conjunto de variables requeridas por el modelo
+        admissible_vars : set[str]
+            conjunto de variables admitidas por el modelo
+        db : pymongo.collection.Collection
+            conexion a la coleccion de la base de datos
+        codec : CacheCodec
+            formato con el que se guardan los documentos en la cache
+        near_cache : NearCache | None
+            cache local del proceso delante de redis, desactivada por defecto
+        negative_ttl : int
+            segundos que se recuerda en la cache que un id no existe,
+            0 para no recordarlo
+        refill_lock_ttl : float
+            segundos maximos que find_by_id espera a que otro proceso
+            rellene la cache de un documento, 0 para no esperar
+        write_behind : WriteBehind | None
+            escritura diferida en mongo, desactivada por defecto
+        change_stream : ChangeStreamWatcher | None
+            invalidacion de la cache con change streams, desactivada por defecto
+        document_ttl : int
+            segundos que se guarda un documento en la cache desde su ultimo uso
+        location_field : str
+            variable con el punto geojson de la direccion, con indice 2dsphere
+        geocode : bool
+            calcula location_field a partir de la direccion al guardar
+        __changed__ : set[str]
+            variables modificadas desde el ultimo guardado
+
+    Methods
+    -------
+        __setattr__(name: str, value: str | dict) -> None
+            Sobreescribe el metodo de asignacion de valores a las
+            variables del objeto con el fin de controlar las variables
+            que se asignan al modelo y cuando son modificadas.
+        save(session: ModelSession | None) -> None
+            Guarda el modelo en la base de datos o lo registra en la sesion
+        delete() -> None
+            Elimina el modelo de la base de datos
+        find(filter: dict[str, str | dict], projection: list[str] | None) -> ModelCursor
+            Realiza una consulta de lectura en la BBDD.
+            Devuelve un cursor de modelos ModelCursor, parciales si hay proyeccion
+        aggregate(pipeline: list[dict], cache_ttl: int | None, ..., models: bool) -> pymongo.command_cursor.CommandCursor
+            Devuelve el resultado de una consulta aggregate, opcionalmente desde la cache
+            o como modelos.
+        find_by_id(id: str, fields: list[str] | None) -> dict | None
+            Busca un documento por su id utilizando la cache y lo devuelve.
+            Si no se encuentra el documento, devuelve None.
+        near(point: Point, max_distance: float | None, filter: dict | None) -> Generator
+            Devuelve los modelos mas cercanos a un punto con su distancia.
+        stats() -> dict
+            Devuelve las medidas del modelo si la instrumentacion esta activa.
+        enable_near_cache(max_entries: int, max_bytes: int, ttl: float) -> NearCache
+            Activa la cache local del proceso para find_by_id.
+        sync_indexes(indexes: list[str | dict]) -> list[str]
+            Crea o actualiza los indices declarados en models.yml.
+        enable_write_behind(max_lag: float, batch_size: int, claim_timeout: float) -> WriteBehind
+            Activa la escritura diferida en mongo de save.
+        enable_change_stream(mode: str, batch_size: int, max_lag: float) -> ChangeStreamWatcher
+            Activa la invalidacion de la cache con los change streams de mongo.
+        find_many_by_id(identificadores: list[str]) -> list[Model | None]
+            Busca varios documentos por su id con un solo pipeline y una sola
+            consulta $in para los que no estan en la cache.
+        init_class(db_collection: pymongo.collection.Collection, requiered_vars: set[str], admissible_vars: set[str]) -> None
+            Inicializa las variables de clase en la inicializacion del sistema.
+
+    """
+
+    # Las variables del modelo se guardan en slots generados por initApp
+    # _cargadas y _cambiadas son mascaras de bits sobre _campos
+    # _parcial indica que el modelo se ha cargado con una proyeccion
+    __slots__ = ('_cargadas', '_cambiadas', '_parcial')
+
+    required_vars: set[str]
+    admissible_vars: set[str]
+    db: pymongo.collection.Collection
+    redis: redis.Redis
+    codec: CacheCodec = BsonCodec()
+    near_cache: NearCache | None = None
+    negative_ttl: int = 0
+    refill_lock_ttl: float = 5
+    write_behind: 'WriteBehind | None' = None
+    change_stream: 'ChangeStreamWatcher | None' = None
+    document_ttl: int = 60 * 60 * 24
+    location_field: str = 'ubicacion'
+    geocode: bool = False
+    _script_actualizar: redis.commands.core.Script
+
+    # Calculados en init_class a partir de las variables del modelo
+    _campos: tuple[str, ...]
+    _bits: dict[str, int]
+    _bit_id: int
+    _requeridas: frozenset[str]
+
+    def __init__(self, **kwargs: dict[str, str | dict]):
+        """
+        Inicializa el modelo con los valores proporcionados en kwargs
+        Comprueba que los valores proporcionados en kwargs son admitidos
+        por el modelo y que las variables requeridas son proporcionadas.
+
+        Parameters
+        ----------
+            kwargs : dict[str, str | dict]
+                diccionario con los valores de las variables del modelo
+        """
+
+        for required in self._requeridas - kwargs.keys():
+            raise Exception(f'[2] Variable "{required}" requerida no especificada.')
+
+        cargadas = 0
+        for name, value in kwargs.items():
+            if (bit := self._bits.get(name)) is None:
+                raise Exception(f'[1] Variable "{name}" no admitida por el modelo.')
+
+            object.__setattr__(self, name, value)
+            cargadas |= bit
+
+        object.__setattr__(self, '_cargadas', cargadas)
+        object.__setattr__(self, '_cambiadas', 0)
+        object.__setattr__(self, '_parcial', False)
+
+    @classmethod
+    def _parcial_desde(cls, documento: dict[str, str | dict]) -> Self:
+        """
+        Crea un modelo parcialmente cargado a partir de un documento
+        obtenido con una proyeccion. No comprueba las variables requeridas,
+        las variables que faltan se cargan al acceder a ellas.
+
+        Parameters
+        ----------
+            documento : dict[str, str | dict]
+                documento proyectado, debe contener el _id
+        Returns
+        -------
+            Model
+                modelo parcialmente cargado
+        """
+
+        modelo = cls.__new__(cls)
+        cargadas = 0
+        for name, value in documento.items():
+            if (bit := cls._bits.get(name)) is None: continue
+            object.__setattr__(modelo, name, value)
+            cargadas |= bit
+
+        object.__setattr__(modelo, '_cargadas', cargadas)
+        object.__setattr__(modelo, '_cambiadas', 0)
+        object.__setattr__(modelo, '_parcial', True)
+        return modelo
+
+    def __getattr__(self, name: str) -> Any:
+        """
+        Solo se llama cuando la variable no esta cargada.
+        Si el modelo es parcial, carga de la base de datos todas las
+        variables que faltan y devuelve la solicitada.
+        """
+
+        if name in Model.__slots__ or name not in self._bits or not self._parcial:
+            raise AttributeError(f'{type(self).__name__} no tiene la variable "{name}"')
+
+        # Carga solo las variables que faltan, sin pisar las modificadas
+        faltan = [campo for campo, bit in self._bits.items() if not (self._cargadas | self._cambiadas) & bit]
+        documento = self.db.find_one({'_id': getattr(self, '_id')}, faltan) or {}
+
+        cargadas = self._cargadas
+        for campo in faltan:
+            if campo not in documento: continue
+            object.__setattr__(self, campo, documento[campo])
+            cargadas |= self._bits[campo]
+
+        object.__setattr__(self, '_cargadas', cargadas)
+        object.__setattr__(self, '_parcial', False)
+
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name: str, value: str | dict) -> None:
+        """ Sobreescribe el metodo de asignacion de valores a las
+        variables del objeto con el fin de controlar las variables
+        que se asignan al modelo y cuando son modificadas.
+        """
+
+        if (bit := self._bits.get(name)) is None:
+            raise Exception(f'[1] Variable "{name}" no admitida por el modelo.')
+
+        # Si ya existe la variable o el modelo esta guardado, la agrega como cambiada
+        # En ambos casos queda cargada, asi no se vuelve a leer de la base de datos
+        if self._cargadas & (bit | self._bit_id): object.__setattr__(self, '_cambiadas', self._cambiadas | bit)
+        object.__setattr__(self, '_cargadas', self._cargadas | bit)
+
+        object.__setattr__(self, name, value)
+
+    @property
+    def __changed__(self) -> set[str]:
+        """
+        Devuelve las variables modificadas desde el ultimo guardado
+        a partir de la mascara de bits de variables cambiadas.
+        """
+
+        return {campo for campo, bit in self._bits.items() if self._cambiadas & bit}
+
+    def _documento(self) -> dict[str, str | dict]:
+        """
+        Devuelve un diccionario con las variables cargadas del modelo.
+        """
+
+        return {campo: getattr(self, campo) for campo, bit in self._bits.items() if self._cargadas & bit}
+
+    def _limpiar_cambios(self) -> None:
+        """
+        Marca todas las variables del modelo como guardadas.
+        """
+
+        object.__setattr__(self, '_cambiadas', 0)
+
+    @medido('save')
+    def save(self, session: 'ModelSession | None' = None) -> None:
+        """
+        Guarda el modelo en la base de datos
+        Si el modelo no existe en la base de datos, se crea un nuevo
+        documento con los valores del modelo. En caso contrario, se
+        actualiza el documento existente con los nuevos valores del
+        modelo.
+        Si se proporciona una sesion, el modelo se registra en ella y
+        se guarda cuando la sesion se vacia con flush.
+
+        Parameters
+        ----------
+            session : ModelSession | None
+                sesion en la que registrar el modelo
+        """
+
+        if self.geocode: self._geolocalizar()
+
+        if session is not None:
+            session.add(self)
+            return
+
+        # En modo write-behind se guarda en redis y se escribe en mongo en segundo plano
+        if self.write_behind is not None:
+            self.write_behind.save(self)
+            return
+
+        pipeline = self.redis.pipeline()
+
+        # Si tiene datos cambiados, los actualiza basado en los otros datos no cambiados
+        # En la cache solo se escriben las variables cambiadas
+        if hasattr(self, '_id'):
+            cambios = {changed: getattr(self, changed) for changed in self.__changed__}
+            if not cambios: return
+
+            self.db.update_one({'_id': getattr(self, '_id')}, {'$set': cambios})
+            self._limpiar_cambios()
+            self._actualizar_cache(pipeline, getattr(self, '_id'), cambios)
+            self._invalidar_near_cache(pipeline, getattr(self, '_id'))
+
+        # Si no tiene datos cambiados, inserta los datos
+        else:
+            # Copia los datos en una variable nueva
+            # Elimina las variables cambiadas para evitar errores en la busqueda
+            # Elimina las variables de control
+            datos: dict[str, str | dict] = self._documento()
+            setattr(self, '_id', self.db.insert_one(datos).inserted_id)
+            self._cachear(pipeline, self._documento())
+
+        self._nueva_version(pipeline)
+        pipeline.execute()
+
+    @medido('delete')
+    def delete(self) -> None:
+        """
+        Elimina el modelo de la base de datos
+        """
+
+        if not hasattr(self, '_id'):
+            raise Exception('[3] El modelo no esta guardado, imposible eliminarlo.')
+
+        # Descarta los cambios pendientes de escribir en mongo
+        if self.write_behind is not None: self.write_behind.discard(getattr(self, '_id'))
+
+        self.db.delete_one({'_id': getattr(self, '_id')})
+
+        pipeline = self.redis.pipeline()
+        pipeline.delete(self._clave(getattr(self, '_id')))
+        self._invalidar_near_cache(pipeline, getattr(self, '_id'))
+        self._nueva_version(pipeline)
+        pipeline.execute()
+
+    def _geolocalizar(self) -> None:
+        """
+        Asigna a location_field el punto de la direccion del modelo si
+        la direccion es nueva o ha cambiado desde el ultimo guardado.
+        """
+
+        if (bit := self._bits.get('direccion')) is None or self._bits.get(self.location_field) is None: return
+        if not self._cargadas & bit: return
+        if self._cargadas & self._bits[self.location_field] and not self._cambiadas & bit: return
+
+        setattr(self, self.location_field, dict(getLocationPoint(getattr(self, 'direccion'))))
+
+    @classmethod
+    def _registrar(cls, evento: str, cantidad: int = 1) -> None:
+        """
+        Suma un evento de la cache del modelo si la instrumentacion esta activa.
+        """
+
+        if instrumentacion is not None: instrumentacion.cache(cls.__name__, evento, cantidad)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Devuelve una copia de las medidas del modelo: aciertos, fallos y
+        rellenos de la cache y los histogramas de latencia de sus
+        operaciones y de las peticiones a mongo y redis que hacen.
+        Vacio si la instrumentacion no esta activa.
+
+        Returns
+        -------
+            dict
+                medidas del modelo
+        """
+
+        if instrumentacion is None: return {}
+        return instrumentacion.snapshot(cls.__name__)
+
+    @classmethod
+    def _nueva_version(cls, pipeline: redis.client.Pipeline, coleccion: str | None = None) -> None:
+        """
+        Incrementa el contador de version de la coleccion para que los
+        resultados de aggregate guardados en la cache dejen de ser validos.
+
+        Parameters
+        ----------
+            pipeline : redis.client.Pipeline
+                pipeline en el que encolar el incremento
+            coleccion : str | None
+                coleccion modificada, por defecto la del modelo
+        """
+
+        pipeline.incr(f'version:{coleccion or cls.db.name}')
+
+    @classmethod
+    def _versionar_destinos(cls, destinos: set[str]) -> Any:
+        """
+        Incrementa la version de las colecciones en las que escribe una
+        consulta aggregate con $out o $merge, en una sola peticion.
+        Con una conexion asincrona devuelve una corrutina que hay que esperar.
+
+        Parameters
+        ----------
+            destinos : set[str]
+                colecciones destino de la consulta
+        """
+
+        versiones = cls.redis.pipeline(transaction=False)
+        for destino in destinos: cls._nueva_version(versiones, destino)
+        return versiones.execute()
+
+    @classmethod
+    def _clave(cls, identificador: str | bson.ObjectId) -> str:
+        """
+        Devuelve la clave del hash de la cache de un documento del modelo.
+        La clave depende de la coleccion y no de la clase, asi los modelos
+        sincronos y asincronos comparten la cache.
+        """
+
+        return f'{cls.db.name}:{identificador}'
+
+    @classmethod
+    def _cachear(cls, pipeline: redis.client.Pipeline, documento: dict[str, str | dict]) -> dict[str, bytes]:
+        """
+        Guarda un documento completo en la cache como un hash con una
+        entrada por variable, reemplazando el que hubiera.
+
+        Parameters
+        ----------
+            pipeline : redis.client.Pipeline
+                pipeline en el que encolar los comandos
+            documento : dict[str, str | dict]
+                documento completo, debe contener el _id
+        Returns
+        -------
+            dict[str, bytes]
+                variables codificadas del documento
+        """
+
+        clave = cls._clave(documento['_id'])
+        campos = {campo: cls.codec.encode_value(valor) for campo, valor in documento.items() if campo != '_id'}
+
+        # Elimina tambien la marca de documento inexistente si la hubiera
+        pipeline.delete(clave, f'{clave}:missing')
+        if not campos: return campos
+        pipeline.hset(clave, mapping=campos)
+        pipeline.expire(clave, cls.document_ttl)
+        return campos
+
+    @classmethod
+    def _aplicar_pendientes(cls, documentos: list[dict[str, str | dict]]) -> None:
+        """
+        Con escritura diferida mongo puede tener una version anterior de
+        los documentos. Aplica sobre ellos los cambios que aun no se han
+        escrito para no guardar en la cache la version anterior.
+
+        Parameters
+        ----------
+            documentos : list[dict[str, str | dict]]
+                documentos leidos de mongo, se modifican
+        """
+
+        if cls.write_behind is None or not documentos: return
+
+        pendientes = cls.write_behind.pending([documento['_id'] for documento in documentos])
+        for documento in documentos:
+            if (cambios := pendientes.get(str(documento['_id']))) is not None: documento.update(cambios)
+
+    @classmethod
+    def _invalidar_near_cache(cls, pipeline: redis.client.Pipeline, identificador: bson.ObjectId) -> None:
+        """
+        Elimina un documento modificado de la cache local y avisa al
+        resto de procesos por el canal de invalidaciones.
+
+        Parameters
+        ----------
+            pipeline : redis.client.Pipeline
+                pipeline en el que encolar el aviso
+            identificador : bson.ObjectId
+                id del documento modificado
+        """
+
+        # Se avisa aunque este proceso no tenga cache local, otros procesos pueden tenerla
+        clave = cls._clave(identificador)
+        if cls.near_cache is not None: cls.near_cache.invalidate(clave)
+        pipeline.publish(CANAL_NEAR_CACHE, clave)
+
+    @classmethod
+    def enable_near_cache(cls, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 5) -> NearCache:
+        """
+        Activa la cache local del proceso para find_by_id.
+        Los documentos modificados con save o delete se eliminan de
+        las caches locales de todos los procesos que la tengan activada
+        mediante pub/sub de redis. Si se pierde algun aviso, el documento
+        se mantiene como mucho ttl segundos.
+
+        Parameters
+        ----------
+            max_entries : int
+                numero maximo de documentos guardados
+            max_bytes : int
+                numero maximo de bytes de las variables guardadas
+            ttl : float
+                segundos que dura cada entrada
+        Returns
+        -------
+            NearCache
+                cache local del modelo, con sus contadores de aciertos y fallos
+        """
+
+        cls.near_cache = NearCache(max_entries, max_bytes, ttl)
+        near_caches[cls.db.name] = cls.near_cache
+        suscribirNearCache(cls)
+
+        return cls.near_cache
+
+    @classmethod
+    def enable_write_behind(cls, max_lag: float = 1, batch_size: int = 1000, claim_timeout: float = 30) -> 'WriteBehind':
+        """
+        Activa la escritura diferida en mongo para el modelo.
+        save guarda los cambios en redis en una sola peticion y un hilo
+        en segundo plano los escribe en mongo por lotes cada max_lag
+        segundos. Al terminar el proceso se escriben los pendientes.
+
+        Parameters
+        ----------
+            max_lag : float
+                segundos maximos que tarda un cambio en llegar a mongo
+            batch_size : int
+                numero maximo de documentos por bulk_write
+            claim_timeout : float
+                segundos tras los que otro flush reclama un lote sin confirmar
+        Returns
+        -------
+            WriteBehind
+                escritura diferida del modelo
+        """
+
+        if cls.write_behind is not None: cls.write_behind.stop()
+
+        cls.write_behind = WriteBehind(cls, max_lag, batch_size, claim_timeout)
+        cls.write_behind.start()
+        return cls.write_behind
+
+    @classmethod
+    def enable_change_stream(cls, mode: str = 'evict', batch_size: int = 500, max_lag: float = 0.5) -> 'ChangeStreamWatcher':
+        """
+        Activa la invalidacion de la cache del modelo con los change
+        streams de mongo, para que los cambios hechos fuera del modelo
+        no se sirvan caducados desde la cache hasta document_ttl.
+
+        Parameters
+        ----------
+            mode : str
+                'evict' elimina los documentos cambiados de la cache y
+                'refresh' reemplaza los que estan en ella por su version nueva
+            batch_size : int
+                numero maximo de cambios por pipeline
+            max_lag : float
+                segundos maximos que se acumulan cambios antes de aplicarlos
+        Returns
+        -------
+            ChangeStreamWatcher
+                invalidacion de la cache del modelo
+        """
+
+        if cls.change_stream is not None: cls.change_stream.stop()
+
+        cls.change_stream = ChangeStreamWatcher(cls, mode, batch_size, max_lag)
+        cls.change_stream.start()
+        return cls.change_stream
+
+    @classmethod
+    def _actualizar_cache(cls, pipeline: redis.client.Pipeline, identificador: bson.ObjectId, campos: dict[str, str | dict]) -> Any:
+        """
+        Actualiza solo las variables indicadas de un documento de la cache
+        y renueva su tiempo de vida. Si el documento no esta en la cache
+        no se hace nada, asi nunca queda un documento a medias.
+        Con un pipeline asincrono devuelve una corrutina que hay que esperar.
+
+        Parameters
+        ----------
+            pipeline : redis.client.Pipeline
+                pipeline en el que encolar los comandos
+            identificador : bson.ObjectId
+                id del documento
+            campos : dict[str, str | dict]
+                variables cambiadas y sus valores
+        """
+
+        argumentos = [cls.document_ttl]
+        for campo, valor in campos.items(): argumentos += [campo, cls.codec.encode_value(valor)]
+
+        return cls._script_actualizar(keys=[cls._clave(identificador)], args=argumentos, client=pipeline)
+
+    @classmethod
+    def _desde_cache(cls, identificador: str, campos: dict[bytes, bytes]) -> dict[str, str | dict]:
+        """
+        Convierte un hash de la cache en un documento.
+
+        Parameters
+        ----------
+            identificador : str
+                id del documento
+            campos : dict[bytes | str, bytes]
+                variables del hash tal y como las devuelve redis
+        Returns
+        -------
+            dict[str, str | dict]
+                documento con su _id
+        """
+
+        documento = {campo.decode() if isinstance(campo, bytes) else campo: cls.codec.decode_value(valor) for campo, valor in campos.items()}
+        documento.update({'_id': bson.ObjectId(identificador)})
+        return documento
+
+    @classmethod
+    @medido('find')
+    def find(cls, filter: dict[str, str | dict], projection: list[str] | dict[str, int] | None = None, batch_size: int = 100) -> Any:
+        """
+        Utiliza el metodo find de pymongo para realizar una consulta
+        de lectura en la BBDD.
+        find debe devolver un cursor de modelos ModelCurso
+        Si se proporciona una proyeccion, los modelos se cargan
+        parcialmente y el resto de variables se obtienen al acceder a ellas.
+
+        Parameters
+        ----------
+            filter : dict[str, str | dict]
+                diccionario con el criterio de busqueda de la consulta
+            projection : list[str] | dict[str, int] | None
+                variables a obtener de cada documento
+            batch_size : int
+                numero de documentos que se procesan por lote en la cache
+        Returns
+        -------
+            ModelCursor
+                cursor de modelos
+        """
+
+        # Los modelos parciales necesitan el _id para cargar el resto de variables
+        if isinstance(projection, dict): projection = {**projection, '_id': 1}
+        elif projection is not None and '_id' not in projection: projection = [*projection, '_id']
+
+        return ModelCursor(cls, cls.db.find(filter, projection), batch_size, projection is not None)
+
+    @staticmethod
+    def _opciones_aggregate(batch_size: int | None, allow_disk_use: bool, max_time_ms: int | None, hint: str | list | None) -> dict:
+        """
+        Traduce las opciones de aggregate a los argumentos de pymongo,
+        omitiendo las que no se indican para usar las del servidor.
+        """
+
+        opciones = {'allowDiskUse': allow_disk_use}
+        if batch_size is not None:
+            if batch_size < 1: raise Exception(f'[4] Tamanio de lote "{batch_size}" no valido.')
+            opciones['batchSize'] = batch_size
+        if max_time_ms is not None: opciones['maxTimeMS'] = max_time_ms
+        if hint is not None: opciones['hint'] = hint
+        return opciones
+
+    @classmethod
+    @medido('aggregate')
+    def aggregate(cls, pipeline: list[dict], cache_ttl: int | None = None, batch_size: int | None = None,
+                  allow_disk_use: bool = False, max_time_ms: int | None = None, hint: str | list | None = None,
+                  models: bool = False) -> pymongo.command_cursor.CommandCursor | list[dict] | Generator:
+        """
+        Devuelve el resultado de una consulta aggregate.
+        No hay nada que hacer en esta funcion.
+        Se utilizara para las consultas solicitadas
+        en el segundo apartado de la practica.
+        Si se indica cache_ttl, el resultado se guarda en redis junto con
+        la version de las colecciones que consulta, y se reutiliza mientras
+        ninguna de ellas se modifique. Las consultas con $out o $merge
+        nunca se guardan, y modifican la version de su coleccion destino.
+        Con models los documentos se devuelven como modelos lote a lote,
+        igual que en find, y se guardan en la cache. Solo se admite si el
+        pipeline unicamente filtra u ordena ($match, $sort, $limit, $skip),
+        con cualquier otra etapa los resultados no son los documentos
+        guardados.
+
+        Parameters
+        ----------
+            pipeline : list[dict]
+                lista de etapas de la consulta aggregate
+            cache_ttl : int | None
+                segundos que se guarda el resultado en la cache
+            batch_size : int | None
+                numero de documentos por lote, por defecto el de mongo
+            allow_disk_use : bool
+                permite a mongo usar ficheros temporales en las etapas
+                que superan el limite de memoria, como $group o $sort
+            max_time_ms : int | None
+                tiempo maximo de ejecucion de la consulta en mongo
+            hint : str | list | None
+                nombre o claves del indice que debe usar la consulta
+            models : bool
+                devuelve los documentos como modelos
+        Returns
+        -------
+            pymongo.command_cursor.CommandCursor | list[dict] | Generator
+                cursor de pymongo con el resultado de la consulta,
+                la lista de resultados si se utiliza la cache,
+                o un iterador de modelos si se indica models
+        """
+
+        # Los resultados transformados, como los de $group, no se pueden convertir en modelos
+        if models and not all(etapa.keys() <= ETAPAS_DOCUMENTOS_GUARDADOS for etapa in pipeline):
+            raise Exception(f'[12] Solo se pueden devolver modelos con las etapas {", ".join(sorted(ETAPAS_DOCUMENTOS_GUARDADOS))}.')
+
+        opciones = cls._opciones_aggregate(batch_size, allow_disk_use, max_time_ms, hint)
+
+        destinos = coleccionesDestino(pipeline, cls.db.name)
+        if destinos:
+            resultado = cls.db.aggregate(pipeline, **opciones)
+            cls._versionar_destinos(destinos)
+            return resultado
+
+        if cache_ttl is None:
+            cursor = cls.db.aggregate(pipeline, **opciones)
+            if not models: return cursor
+            return ModelCursor(cls, cursor, batch_size or 100)
+
+        resultado = cls._aggregate_cacheado(pipeline, cache_ttl, opciones)
+        if not models: return resultado
+
+        cls._aplicar_pendientes(resultado)
+        return (cls(**documento) for documento in resultado)
+
+    @classmethod
+    def _aggregate_cacheado(cls, pipeline: list[dict], cache_ttl: int, opciones: dict) -> list[dict]:
+        """
+        Devuelve el resultado de aggregate guardado en la cache si
+        ninguna de las colecciones que consulta ha cambiado desde que
+        se guardo, y si no lo calcula y lo guarda.
+        """
+
+        colecciones = [cls.db.name, *sorted(coleccionesRelacionadas(pipeline) - {cls.db.name})]
+        clave = f'aggregate:{cls.db.name}:{hashlib.sha256(bson.json_util.dumps(pipeline).encode()).hexdigest()}'
+
+        # Lee el resultado guardado y las versiones actuales en una sola peticion
+        lectura = cls.redis.pipeline(transaction=False)
+        lectura.get(clave)
+        lectura.mget([f'version:{coleccion}' for coleccion in colecciones])
+        guardado, versiones = lectura.execute()
+        versiones = [int(version or 0) for version in versiones]
+
+        if guardado is not None and (datos := decodeCache(guardado))['versiones'] == versiones:
+            cls._registrar('aggregate_hits')
+            return datos['resultado']
+
+        cls._registrar('aggregate_misses')
+
+        # Las versiones se leen antes de la consulta, si hay una escritura
+        # mientras tanto el resultado guardado ya nace caducado
+        resultado = list(cls.db.aggregate(pipeline, **opciones))
+        try:
+            cls.redis.set(clave, cls.codec.encode({'versiones': versiones, 'resultado': resultado}), ex=cache_ttl)
+        except (TypeError, bson.errors.InvalidDocument):
+            # El formato de la cache no admite algun valor del resultado
+            pass
+
+        return resultado
+
+    @classmethod
+    @medido('near')
+    def near(cls, point: Point | dict, max_distance: float | None = None, filter: dict | None = None,
+             batch_size: int = 100) -> Generator:
+        """
+        Devuelve los modelos mas cercanos a un punto, ordenados por
+        distancia, con $geoNear sobre el indice 2dsphere de location_field.
+        Los modelos pasan por la cache igual que en find.
+
+        Parameters
+        ----------
+            point : geojson.Point | dict
+                punto geojson de referencia, (longitud, latitud)
+            max_distance : float | None
+                distancia maxima en metros
+            filter : dict | None
+                filtro adicional sobre los documentos
+            batch_size : int
+                numero de documentos por lote
+        Returns
+        -------
+            Generator
+                iterador de pares (modelo, distancia en metros)
+        """
+
+        etapa = {'near': dict(point), 'key': cls.location_field, 'distanceField': '_distancia', 'spherical': True}
+        if max_distance is not None: etapa['maxDistance'] = max_distance
+        if filter: etapa['query'] = filter
+
+        cursor = cls.db.aggregate([{'$geoNear': etapa}], batchSize=batch_size)
+        return ModelCursor(cls, cursor, batch_size, extra='_distancia')
+
+    @classmethod
+    @medido('find_by_id')
+    def find_by_id(cls, identificador: str, fields: list[str] | None = None) -> Self | None:
+        """
+        NO IMPLEMENTAR HASTA LA SEGUNDA PRACTICA
+        Busca un documento por su id utilizando la cache y lo devuelve.
+        Si no se encuentra el documento, devuelve None.
+        Si se indican variables, solo se leen esas de la cache y se
+        devuelve un modelo parcial.
+        Cuando el documento no esta en la cache, solo un proceso lo
+        busca en mongo mientras el resto espera a que lo guarde. Los ids
+        que no existen se recuerdan durante negative_ttl segundos.
+
+        Parameters
+        ----------
+            id : str
+                id del documento a buscar
+            fields : list[str] | None
+                variables a leer de la cache
+        Returns
+        -------
+            dict | None
+                documento encontrado o None si no se encuentra
+        """
+
+        clave = cls._clave(identificador)
+
+        # Primero busca en la cache local del proceso si esta activada
+        usar_near_cache = fields is None and cls.near_cache is not None
+        if usar_near_cache and (campos := cls.near_cache.get(clave)) is not None:
+            cls._registrar('near_hits')
+            return cls(**cls._desde_cache(identificador, campos))
+
+        cerrojo = False
+        limite = time.monotonic() + cls.refill_lock_ttl
+        while True:
+            # Lee el documento, renueva su tiempo de vida y comprueba si
+            # se sabe que no existe en una sola peticion
+            pipeline = cls.redis.pipeline(transaction=False)
+            if fields is None:
+                pipeline.hgetall(clave)
+                pipeline.expire(clave, cls.document_ttl)
+                pipeline.exists(f'{clave}:missing')
+                campos, _, inexistente = pipeline.execute()
+
+                if campos:
+                    cls._registrar('hits')
+                    if usar_near_cache: cls.near_cache.set(clave, campos)
+                    return cls(**cls._desde_cache(identificador, campos))
+
+            else:
+                pipeline.exists(clave)
+                pipeline.hmget(clave, fields)
+                pipeline.expire(clave, cls.document_ttl)
+                pipeline.exists(f'{clave}:missing')
+                existe, valores, _, inexistente = pipeline.execute()
+
+                if existe:
+                    cls._registrar('hits')
+                    campos = {campo.encode(): valor for campo, valor in zip(fields, valores) if valor is not None}
+                    return cls._parcial_desde(cls._desde_cache(identificador, campos))
+
+            if inexistente:
+                cls._registrar('negative_hits')
+                return None
+
+            # Solo un proceso rellena la cache, el resto espera a que lo haga
+            # Si el cerrojo caduca sin que se rellene, se consulta mongo igualmente
+            if cls.refill_lock_ttl <= 0 or time.monotonic() >= limite: break
+            if cls.redis.set(f'{clave}:lock', b'1', nx=True, px=int(cls.refill_lock_ttl * 1000)):
+                cerrojo = True
+                break
+
+            time.sleep(0.05)
+
+        cls._registrar('misses')
+        documento = cls.db.find_one({'_id': bson.ObjectId(identificador)})
+        if documento is not None: cls._aplicar_pendientes([documento])
+
+        pipeline = cls.redis.pipeline()
+        if documento is not None:
+            campos = cls._cachear(pipeline, documento)
+            cls._registrar('backfills')
+        elif cls.negative_ttl > 0: pipeline.set(f'{clave}:missing', b'1', ex=cls.negative_ttl)
+        if cerrojo: pipeline.delete(f'{clave}:lock')
+        pipeline.execute()
+
+        if documento is None: return None
+
+        if usar_near_cache: cls.near_cache.set(clave, campos)
+        return cls(**documento)
+
+    @classmethod
+    @medido('find_many_by_id')
+    def find_many_by_id(cls, identificadores: list[str]) -> list[Self | None]:
+        """
+        Busca varios documentos por su id utilizando la cache y los
+        devuelve en el mismo orden en el que se han pedido.
+        Los documentos se leen de redis en un solo pipeline, los que no
+        estan en la cache se buscan en mongo con una sola consulta $in
+        y se guardan en redis en un solo pipeline.
+        Si no se encuentra un documento, su posicion contiene None.
+
+        Parameters
+        ----------
+            identificadores : list[str]
+                ids de los documentos a buscar
+        Returns
+        -------
+            list[Model | None]
+                modelos encontrados o None si no se encuentran
+        """
+
+        if not identificadores: return []
+
+        documentos: dict[str, dict] = {}
+
+        # Lee todos los documentos de la cache y renueva su tiempo de vida de una vez
+        pipeline = cls.redis.pipeline(transaction=False)
+        for identificador in identificadores:
+            pipeline.hgetall(cls._clave(identificador))
+            pipeline.expire(cls._clave(identificador), cls.document_ttl)
+        respuestas = pipeline.execute()
+
+        for identificador, campos in zip(identificadores, respuestas[::2]):
+            if campos: documentos[identificador] = cls._desde_cache(identificador, campos)
+
+        # Busca en mongo solo los que no estan en la cache
+        pendientes = {bson.ObjectId(identificador) for identificador in identificadores if identificador not in documentos}
+        cls._registrar('hits', len(identificadores) - len(pendientes))
+        if pendientes:
+            cls._registrar('misses', len(pendientes))
+            encontrados = list(cls.db.find({'_id': {'$in': list(pendientes)}}))
+            cls._aplicar_pendientes(encontrados)
+
+            pipeline = cls.redis.pipeline()
+            for documento in encontrados:
+                documentos[str(documento['_id'])] = documento
+                cls._cachear(pipeline, documento)
+                cls._registrar('backfills')
+            pipeline.execute()
+
+        return [cls(**documentos[identificador]) if identificador in documentos else None for identificador in identificadores]
+
+    @classmethod
+    def sync_indexes(cls, indexes: list[str | dict]) -> list[str]:
+        """
+        Crea los indices declarados en models.yml que no existen en la
+        coleccion y vuelve a crear los que existen con otra definicion.
+        Los indices que ya existen con la misma definicion no se tocan,
+        aunque tengan otro nombre, por lo que se puede llamar en cada arranque.
+
+        Cada indice puede ser el nombre de una variable (indice simple
+        ascendente) o un diccionario con keys (variable o diccionario de
+        variables y su tipo: 1, -1, 2dsphere, ...) y las opciones de
+        create_index (unique, sparse, expireAfterSeconds, name, ...).
+
+        Parameters
+        ----------
+            indexes : list[str | dict]
+                indices declarados para el modelo
+        Returns
+        -------
+            list[str]
+                nombres de los indices creados
+        """
+
+        modelos: list[pymongo.IndexModel] = []
+        for definicion in indexes:
+            if isinstance(definicion, str): definicion = {'keys': definicion}
+
+            opciones = dict(definicion)
+            claves = opciones.pop('keys')
+            if isinstance(claves, str): claves = {claves: pymongo.ASCENDING}
+            modelos.append(pymongo.IndexModel(list(claves.items()), **opciones))
+
+        def normalizar(claves: Any) -> list[tuple[str, str | int]]:
+            return [(campo, tipo if isinstance(tipo, str) else int(tipo)) for campo, tipo in (claves.items() if isinstance(claves, dict) else claves)]
+
+        existentes = cls.db.index_information()
+        nuevos: list[pymongo.IndexModel] = []
+
+        for modelo in modelos:
+            indice = modelo.document
+            claves = normalizar(indice['key'])
+
+            # Un indice con las mismas claves puede existir con otro nombre, por ejemplo creado a mano
+            por_claves = next((nombre for nombre, existente in existentes.items() if nombre != '_id_' and normalizar(existente['key']) == claves), None)
+            if por_claves is not None and all(existentes[por_claves].get(opcion) == indice.get(opcion) for opcion in ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')):
+                continue
+
+            # Mismo nombre o mismas claves con otra definicion, hay que volver a crearlo
+            for nombre in {indice['name'], por_claves} & existentes.keys():
+                cls.db.drop_index(nombre)
+                del existentes[nombre]
+
+            nuevos.append(modelo)
+
+        return cls.db.create_indexes(nuevos) if nuevos else []
+
+    @classmethod
+    def init_class(cls, db_collection: pymongo.collection.Collection, redis_connection: redis.Redis, required_vars: set[str], admissible_vars: set[str], codec: CacheCodec | None = None) -> None:
+        """
+        Inicializa las variables de clase en la inicializacion del sistema.
+        En principio nada que hacer aqui salvo que se quieran realizar
+        comprobaciones o cambios adicionales.
+
+        Parameters
+        ----------
+            db_collection : pymongo.collection.Collection
+                Conexion a la collecion de la base de datos,
+                o un LazyConnection que la crea al utilizarla.
+            redis_connection : redis.Redis
+                Conexion a redis o un LazyConnection que la crea al utilizarla.
+            required_vars : set[str]
+                Set de variables requeridas por el modelo
+            admissible_vars : set[str]
+                Set de variables admitidas por el modelo
+            codec : CacheCodec | None
+                Formato de la cache del modelo, bson por defecto
+        """
+
+        cls.db = db_collection
+        cls.redis = redis_connection
+        # El script se ejecuta siempre con el pipeline indicado, asi no se crea la conexion a redis al inicializar la clase
+        cls._script_actualizar = redis.commands.core.Script(None, ACTUALIZAR_HASH.encode())
+        cls.required_vars = required_vars
+        cls.admissible_vars = admissible_vars
+        if codec is not None: cls.codec = codec
+
+        # Precalcula el orden de las variables y el bit de cada una
+        # para no reconstruirlos en cada asignacion
+        cls._campos = tuple(dict.fromkeys([*required_vars, *admissible_vars]))
+        cls._bits = {campo: 1 << indice for indice, campo in enumerate(cls._campos)}
+        cls._bit_id = cls._bits.get('_id', 0)
+        cls._requeridas = frozenset(required_vars)
+
+
+class ModelCursor:
+    """
+    Cursor para iterar sobre los documentos del resultado de una
+    consulta. Los documentos deben ser devueltos en forma de objetos
+    modelo.
+
+    Attributes
+    ----------
+        model_class : Model
+            Clase para crear los modelos de los documentos que se iteran.
+        command_cursor : pymongo.command_cursor.CommandCursor
+            Cursor de pymongo a iterar
+        batch_size : int
+            Numero de documentos que se leen de mongo y se comprueban
+            en la cache de redis en una sola peticion.
+        partial : bool
+            Indica si los documentos se han obtenido con una proyeccion,
+            en ese caso se devuelven modelos parciales y no se guardan en la cache.
+        saved_round_trips : int
+            Numero de peticiones a redis ahorradas al agrupar los
+            documentos por lotes.
+        extra : str | None
+            Variable calculada por la consulta que no pertenece al modelo,
+            como la distancia de $geoNear. Si se indica, se devuelven
+            pares (modelo, valor).
+
+    Methods
+    -------
+        __iter__() -> ModelCursor
+            Devuelve el propio cursor, que recorre los elementos del cursor
+            y devuelve los documentos en forma de objetos modelo.
+        __next__() -> Model
+            Devuelve el siguiente modelo.
+    """
+
+    def __init__(self, model_class: Model, command_cursor: pymongo.cursor.Cursor, batch_size: int = 100, partial: bool = False,
+                 extra: str | None = None):
+        """
+        Inicializa el cursor con la clase de modelo y el cursor de pymongo
+
+        Parameters
+        ----------
+            model_class : Model
+                Clase para crear los modelos de los documentos que se iteran.
+            command_cursor: pymongo.command_cursor.CommandCursor
+                Cursor de pymongo a iterar
+            batch_size : int
+                Numero de documentos por lote
+            partial : bool
+                Indica si los documentos se han obtenido con una proyeccion
+            extra : str | None
+                Variable calculada por la consulta que se devuelve junto al modelo
+        """
+
+        if batch_size < 1:
+            raise Exception(f'[4] Tamanio de lote "{batch_size}" no valido.')
+
+        self.model = model_class
+        self.cursor = command_cursor
+        self.batch_size = batch_size
+        self.partial = partial
+        self.extra = extra
+        self.saved_round_trips = 0
+
+        # Ajusta el tamanio de lote de mongo al de la cache
+        self.cursor.batch_size(batch_size)
+
+        # El cursor es su propio iterador, asi se puede consultar saved_round_trips mientras se recorre
+        self.modelos = self._modelos()
+
+    def __iter__(self) -> Self:
+        return self
+
+    def __next__(self) -> Any:
+        return next(self.modelos)
+
+    def _modelos(self) -> Generator:
+        """
+        Devuelve un iterador que recorre los elementos del cursor
+        y devuelve los documentos en forma de objetos modelo.
+        Utilizar yield para generar el iterador
+        Utilizar la funcion next para obtener el siguiente documento del cursor
+        Utilizar alive para comprobar si existen mas documentos.
+        """
+
+        while self.cursor.alive:
+            # Las peticiones de cada lote se asignan al modelo en las medidas
+            if instrumentacion is None: lote, extras = self._siguiente_lote()
+            else: lote, extras = instrumentacion.medir(self.model.__name__, 'cursor_batch', self._siguiente_lote)
+            if not lote: break
+
+            if self.partial: modelos = map(self.model._parcial_desde, lote)
+            else: modelos = (self.model(**documento) for documento in lote)
+
+            if self.extra is not None: yield from zip(modelos, extras)
+            else: yield from modelos
+
+    def _siguiente_lote(self) -> tuple[list[dict], list[Any] | None]:
+        """
+        Lee el siguiente lote de documentos del cursor y lo guarda en la
+        cache. Devuelve los documentos y, si se indica extra, sus valores.
+        """
+
+        # Obtiene el siguiente lote de documentos del cursor
+        lote = list(itertools.islice(self.cursor, self.batch_size))
+        if not lote: return lote, None
+
+        extras = [documento.pop(self.extra) for documento in lote] if self.extra is not None else None
+        if not self.partial: self.model._aplicar_pendientes(lote)
+
+        # Guarda los documentos del lote en la cache en una sola peticion
+        # Los documentos vienen de mongo, asi que reemplazan a los de la cache
+        # Los documentos parciales nunca se guardan en la cache, solo se renueva su tiempo de vida
+        pipeline = self.model.redis.pipeline()
+        for documento in lote:
+            if self.partial: pipeline.expire(self.model._clave(documento['_id']), self.model.document_ttl)
+            else: self.model._cachear(pipeline, documento)
+        pipeline.execute()
+
+        if not self.partial: self.model._registrar('backfills', len(lote))
+
+        # Antes se hacian dos peticiones por documento, ahora una por lote
+        self.saved_round_trips += 2 * len(lote) - 1
+
+        return lote, extras
+
+
+class ModelSession:
+    """
+    Unidad de trabajo que agrupa los modelos nuevos y modificados
+    y los guarda de una sola vez.
+    Por cada coleccion se hace un solo bulk_write desordenado con las
+    inserciones y las actualizaciones $set de las variables cambiadas,
+    y todas las escrituras en la cache se envian en un solo pipeline,
+    escribiendo en la cache solo las variables cambiadas.
+
+    Attributes
+    ----------
+        modelos : dict[int, Model]
+            modelos pendientes de guardar por su id(), en orden de registro
+
+    Methods
+    -------
+        add(modelo: Model) -> None
+            Registra un modelo para guardarlo en el siguiente flush.
+        flush() -> None
+            Guarda todos los modelos pendientes en la base de datos y en la cache.
+    """
+
+    def __init__(self):
+        """
+        Inicializa la sesion sin modelos pendientes
+        """
+
+        # Por id() para comprobar en O(1) si un modelo ya esta registrado,
+        # el diccionario mantiene el orden en el que se registran
+        self.modelos: dict[int, Model] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Solo guarda los modelos si no se ha producido ningun error
+        if exc_type is None: self.flush()
+        else: self.modelos.clear()
+
+    def add(self, modelo: Model) -> None:
+        """
+        Registra un modelo para guardarlo en el siguiente flush.
+        Un mismo modelo solo se registra una vez.
+
+        Parameters
+        ----------
+            modelo : Model
+                modelo a guardar
+        """
+
+        self.modelos.setdefault(id(modelo), modelo)
+
+    def flush(self) -> None:
+        """
+        Guarda todos los modelos pendientes en la base de datos y en la cache.
+        Los _id de los documentos insertados se asignan a sus modelos.
+        Si alguna escritura falla, el resto de modelos se guarda igualmente
+        y se relanza el error de pymongo al terminar.
+        """
+
+        # Agrupa los modelos por clase, cada clase tiene su coleccion
+        clases: dict[type, list[Model]] = {}
+        for modelo in self.modelos.values(): clases.setdefault(type(modelo), []).append(modelo)
+        self.modelos = {}
+
+        error: BulkWriteError | None = None
+        pipeline = None
+
+        for clase, modelos in clases.items():
+            operaciones: list[pymongo.InsertOne | pymongo.UpdateOne] = []
+            # Modelo, _id generado para las inserciones y variables cambiadas para las actualizaciones
+            escritos: list[tuple[Model, bson.ObjectId | None, dict[str, str | dict] | None]] = []
+
+            for modelo in modelos:
+                if hasattr(modelo, '_id'):
+                    # Los modelos sin cambios no necesitan escribirse
+                    if not modelo._cambiadas: continue
+                    cambios = {changed: getattr(modelo, changed) for changed in modelo.__changed__}
+                    operaciones.append(pymongo.UpdateOne({'_id': getattr(modelo, '_id')}, {'$set': cambios}))
+                    escritos.append((modelo, None, cambios))
+
+                else:
+                    # El _id se genera aqui para poder asignarlo despues al modelo
+                    datos: dict[str, str | dict] = modelo._documento()
+                    datos['_id'] = bson.ObjectId()
+                    operaciones.append(pymongo.InsertOne(datos))
+                    escritos.append((modelo, datos['_id'], None))
+
+            if not operaciones: continue
+
+            # Indices de las operaciones que han fallado
+            fallidos: set[int] = set()
+            try:
+                clase.db.bulk_write(operaciones, ordered=False)
+            except BulkWriteError as excepcion:
+                error = excepcion
+                fallidos = {fallo['index'] for fallo in excepcion.details.get('writeErrors', [])}
+
+            if pipeline is None: pipeline = clase.redis.pipeline()
+
+            for indice, (modelo, identificador, cambios) in enumerate(escritos):
+                if indice in fallidos: continue
+
+                modelo._limpiar_cambios()
+
+                # Las inserciones guardan el documento completo y las
+                # actualizaciones solo las variables cambiadas
+                if identificador is not None:
+                    setattr(modelo, '_id', identificador)
+                    clase._cachear(pipeline, modelo._documento())
+                else:
+                    clase._actualizar_cache(pipeline, getattr(modelo, '_id'), cambios)
+                    clase._invalidar_near_cache(pipeline, getattr(modelo, '_id'))
+
+            clase._nueva_version(pipeline)
+
+        if pipeline is not None: pipeline.execute()
+        if error is not None: raise error
+
+
+# Hilos en segundo plano del proceso, de escritura diferida y de change streams
+hilos_fondo: weakref.WeakSet = weakref.WeakSet()
+
+
+def reiniciarHilosFondo() -> None:
+    """
+    Tras un fork los hilos no existen en el proceso hijo, se vuelven a
+    arrancar los que estaban arrancados y no se han detenido.
+    """
+
+    for hilo in list(hilos_fondo): hilo._reiniciar()
+
+
+def detenerHilosFondo() -> None:
+    """
+    Al terminar el proceso detiene los hilos que no se han detenido,
+    la escritura diferida escribe antes los cambios que queden pendientes.
+    """
+
+    for hilo in list(hilos_fondo):
+        if not hilo.detenido: hilo.stop()
+
+
+os.register_at_fork(after_in_child=reiniciarHilosFondo)
+atexit.register(detenerHilosFondo)
+
+
+class WriteBehind:
+    """
+    Escritura diferida en mongo de los modelos guardados con save.
+    Los cambios de cada documento se acumulan en un hash de redis y su
+    id en un conjunto de documentos pendientes. Un hilo en segundo plano
+    reclama los pendientes por lotes y los escribe con un solo bulk_write,
+    de modo que varios save del mismo documento se escriben una sola vez.
+    Los cambios reclamados solo se eliminan de redis cuando bulk_write
+    termina bien. Si falla, o el proceso termina de forma inesperada,
+    se vuelven a reclamar en el siguiente flush o cuando caduca la
+    reclamacion, asi que cada cambio se escribe al menos una vez.
+
+    Attributes
+    ----------
+        model_class : type[Model]
+            modelo cuyos cambios se escriben
+        max_lag : float
+            segundos entre escrituras en mongo
+        batch_size : int
+            numero maximo de documentos por bulk_write
+        claim_timeout : float
+            segundos tras los que se vuelve a reclamar un lote sin confirmar
+        written : int
+            documentos escritos en mongo
+
+    Methods
+    -------
+        save(modelo: Model) -> None
+            Guarda los cambios del modelo en redis y lo marca como pendiente.
+        discard(identificador: bson.ObjectId) -> None
+            Descarta los cambios pendientes de un documento.
+        pending(identificadores: list) -> dict[str, dict]
+            Devuelve los cambios que aun no se han escrito en mongo.
+        flush() -> int
+            Escribe en mongo todos los cambios pendientes.
+        start() -> None
+            Arranca el hilo de escritura.
+        stop() -> None
+            Detiene el hilo de escritura y escribe los cambios pendientes.
+    """
+
+    def __init__(self, model_class: type[Model], max_lag: float = 1, batch_size: int = 1000, claim_timeout: float = 30):
+        """
+        Inicializa la escritura diferida del modelo
+
+        Parameters
+        ----------
+            model_class : type[Model]
+                modelo cuyos cambios se escriben
+            max_lag : float
+                segundos entre escrituras en mongo
+            batch_size : int
+                numero maximo de documentos por bulk_write
+            claim_timeout : float
+                segundos tras los que se vuelve a reclamar un lote sin confirmar
+        """
+
+        self.model = model_class
+        self.max_lag = max_lag
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self.written = 0
+        self.script_reclamar = redis.commands.core.Script(None, RECLAMAR_PENDIENTES.encode())
+        self.script_cerrar = redis.commands.core.Script(None, CERRAR_RECLAMACION.encode())
+        self.parar = threading.Event()
+        self.hilo: threading.Thread | None = None
+        self.detenido = False
+
+        # El hilo no sobrevive a un fork, el proceso hijo arranca el suyo
+        hilos_fondo.add(self)
+
+    def _clave_pendientes(self) -> str:
+        return f'write-behind:{self.model.db.name}'
+
+    def _clave_reclamados(self) -> str:
+        return f'write-behind:{self.model.db.name}:procesando'
+
+    def _clave_cambios(self, identificador: str | bson.ObjectId = '') -> str:
+        return f'write-behind:{self.model.db.name}:{identificador}'
+
+    def save(self, modelo: Model) -> None:
+        """
+        Guarda los cambios del modelo en redis y lo marca como pendiente
+        en una sola peticion. Los modelos nuevos reciben su _id al momento.
+
+        Parameters
+        ----------
+            modelo : Model
+                modelo a guardar
+        """
+
+        if hasattr(modelo, '_id'):
+            cambios = {changed: getattr(modelo, changed) for changed in modelo.__changed__}
+            if not cambios: return
+            pendientes = {campo: self.model.codec.encode_value(valor) for campo, valor in cambios.items()}
+
+        else:
+            setattr(modelo, '_id', bson.ObjectId())
+            cambios = None
+            pendientes = {campo: self.model.codec.encode_value(valor) for campo, valor in modelo._documento().items() if campo != '_id'}
+            # Los documentos nuevos se insertan, el resto solo se actualizan
+            pendientes['__insert__'] = b'1'
+
+        modelo._limpiar_cambios()
+        identificador = getattr(modelo, '_id')
+
+        # Los modelos completos se guardan enteros en la cache para que las
+        # lecturas los encuentren aunque su documento hubiera caducado
+        pipeline = self.model.redis.pipeline()
+        if modelo._parcial and cambios is not None: self.model._actualizar_cache(pipeline, identificador, cambios)
+        else: self.model._cachear(pipeline, modelo._documento())
+        self.model._invalidar_near_cache(pipeline, identificador)
+
+        pipeline.hset(self._clave_cambios(identificador), mapping=pendientes)
+        pipeline.sadd(self._clave_pendientes(), str(identificador))
+        pipeline.execute()
+
+    def discard(self, identificador: bson.ObjectId) -> None:
+        """
+        Descarta los cambios pendientes de un documento.
+
+        Parameters
+        ----------
+            identificador : bson.ObjectId
+                id del documento
+        """
+
+        pipeline = self.model.redis.pipeline()
+        self.descartar(pipeline, self.model.db.name, identificador)
+        pipeline.execute()
+
+    @staticmethod
+    def descartar(pipeline: redis.client.Pipeline | redis.asyncio.client.Pipeline, coleccion: str, identificador: str | bson.ObjectId) -> None:
+        """
+        Encola en el pipeline, sincrono o asincrono, el descarte de los
+        cambios pendientes de un documento de la coleccion indicada.
+
+        Parameters
+        ----------
+            pipeline : redis.client.Pipeline | redis.asyncio.client.Pipeline
+                pipeline en el que encolar los comandos
+            coleccion : str
+                nombre de la coleccion del modelo
+            identificador : str | bson.ObjectId
+                id del documento
+        """
+
+        pipeline.srem(f'write-behind:{coleccion}', str(identificador))
+        pipeline.zrem(f'write-behind:{coleccion}:procesando', str(identificador))
+        pipeline.delete(f'write-behind:{coleccion}:{identificador}', f'write-behind:{coleccion}:{identificador}:procesando')
+
+    def pending(self, identificadores: list[str | bson.ObjectId]) -> dict[str, dict]:
+        """
+        Devuelve los cambios que aun no se han escrito en mongo de los
+        documentos indicados, incluidos los reclamados sin confirmar.
+
+        Parameters
+        ----------
+            identificadores : list[str | bson.ObjectId]
+                ids de los documentos
+        Returns
+        -------
+            dict[str, dict]
+                cambios decodificados por id, solo de los documentos que tienen
+        """
+
+        pipeline = self.model.redis.pipeline(transaction=False)
+        for identificador in identificadores:
+            pipeline.hgetall(f'{self._clave_cambios(identificador)}:procesando')
+            pipeline.hgetall(self._clave_cambios(identificador))
+        respuestas = pipeline.execute()
+
+        pendientes: dict[str, dict] = {}
+        for identificador, procesando, nuevos in zip(identificadores, respuestas[::2], respuestas[1::2]):
+            # Los cambios nuevos son posteriores a los reclamados
+            campos = {**procesando, **nuevos}
+            campos.pop(b'__insert__', None)
+            if campos: pendientes[str(identificador)] = {campo.decode(): self.model.codec.decode_value(valor) for campo, valor in campos.items()}
+
+        return pendientes
+
+    def flush(self) -> int:
+        """
+        Escribe en mongo todos los cambios pendientes por lotes.
+
+        Returns
+        -------
+            int
+                numero de documentos escritos
+        """
+
+        escritos = 0
+        while True:
+            limite, *reclamados = self.script_reclamar(keys=[self._clave_pendientes(), self._clave_reclamados()],
+                                                       args=[self.batch_size, self._clave_cambios(), int(self.claim_timeout * 1000)],
+                                                       client=self.model.redis)
+            if not reclamados: return escritos
+
+            ids: list[bytes] = []
+            operaciones: list[pymongo.UpdateOne] = []
+            for identificador, campos in zip(reclamados[::2], reclamados[1::2]):
+                cambios = {campos[indice].decode(): campos[indice + 1] for indice in range(0, len(campos), 2)}
+                insertar = cambios.pop('__insert__', None) is not None
+                if not cambios: continue
+
+                cambios = {campo: self.model.codec.decode_value(valor) for campo, valor in cambios.items()}
+                ids.append(identificador)
+                operaciones.append(pymongo.UpdateOne({'_id': bson.ObjectId(identificador.decode())}, {'$set': cambios}, upsert=insertar))
+
+            # Los reclamados sin cambios se confirman directamente
+            fallidos: set[bytes] = set()
+            try:
+                if operaciones: self.model.db.bulk_write(operaciones, ordered=False)
+            except BulkWriteError as error:
+                # El resto de operaciones del lote desordenado si se han escrito
+                fallidos = {ids[fallo['index']] for fallo in error.details.get('writeErrors', [])}
+                if not fallidos: fallidos = set(ids)
+                raise
+            except Exception:
+                fallidos = set(ids)
+                raise
+            finally:
+                confirmados = [identificador for identificador in reclamados[::2] if identificador not in fallidos]
+                pipeline = self.model.redis.pipeline(transaction=False)
+                if confirmados: self.script_cerrar(keys=[self._clave_reclamados()], args=[self._clave_cambios(), limite, 1, *confirmados], client=pipeline)
+                if fallidos: self.script_cerrar(keys=[self._clave_reclamados()], args=[self._clave_cambios(), limite, 0, *fallidos], client=pipeline)
+                if len(fallidos) < len(ids): self.model._nueva_version(pipeline)
+                pipeline.execute()
+
+            escritos += len(operaciones)
+            self.written += len(operaciones)
+
+    def start(self) -> None:
+        """
+        Arranca el hilo que escribe los cambios en mongo cada max_lag segundos.
+        """
+
+        if self.hilo is not None and self.hilo.is_alive(): return
+
+        self.detenido = False
+        self.parar.clear()
+        self.hilo = threading.Thread(target=self._bucle, name=f'write-behind-{self.model.__name__}', daemon=True)
+        self.hilo.start()
+
+    def stop(self) -> None:
+        """
+        Detiene el hilo de escritura y escribe los cambios pendientes.
+        """
+
+        self.detenido = True
+        self.parar.set()
+        if self.hilo is not None and self.hilo is not threading.current_thread(): self.hilo.join()
+        self.hilo = None
+        self.flush()
+
+    def _bucle(self) -> None:
+        while not self.parar.wait(self.max_lag):
+            try:
+                self.flush()
+            except Exception:
+                # Los errores no detienen el hilo, se vuelve a intentar en el siguiente ciclo
+                logger.exception('[8] Error en la escritura diferida de %s', self.model.__name__)
+
+    def _reiniciar(self) -> None:
+        # Solo se vuelve a arrancar si el hilo estaba arrancado en el proceso padre
+        arrancado = self.hilo is not None and not self.detenido
+        self.parar = threading.Event()
+        self.hilo = None
+        if arrancado: self.start()
+
+
+class ChangeStreamWatcher:
+    """
+    Invalidacion de la cache a partir de los change streams de mongo.
+    Un hilo en segundo plano sigue los cambios de la coleccion del modelo,
+    hechos por este u otros servicios o por consultas con $out o $merge,
+    y los aplica a la cache por lotes en un solo pipeline: elimina o
+    refresca los documentos cambiados, avisa a las caches locales,
+    invalida los resultados de aggregate y guarda el resume token, de
+    modo que al reiniciar se continua desde el ultimo lote aplicado.
+    Si el token ya no esta en el oplog o la coleccion se elimina o
+    renombra, se vacia la cache completa del modelo.
+    Los cambios que hace el propio ODM llegan tambien por el stream. En
+    modo 'evict' los documentos cuya cache ya tiene los valores del cambio
+    no se eliminan, para no perder lo que el ODM acaba de guardar.
+    Necesita que mongo sea un replica set, basta con uno de un solo nodo.
+
+    Attributes
+    ----------
+        model_class : type[Model]
+            modelo cuya cache se invalida
+        mode : str
+            'evict' elimina los documentos cambiados de la cache y
+            'refresh' reemplaza los que estan en ella por su version nueva
+        batch_size : int
+            numero maximo de cambios por pipeline
+        max_lag : float
+            segundos maximos que se acumulan cambios antes de aplicarlos
+        applied : int
+            cambios aplicados a la cache
+
+    Methods
+    -------
+        apply(cambios: list[dict]) -> None
+            Aplica un lote de cambios a la cache y guarda su resume token.
+        start() -> None
+            Arranca el hilo que sigue los cambios.
+        stop() -> None
+            Detiene el hilo.
+    """
+
+    def __init__(self, model_class: type[Model], mode: str = 'evict', batch_size: int = 500, max_lag: float = 0.5):
+        """
+        Inicializa la invalidacion de la cache del modelo
+
+        Parameters
+        ----------
+            model_class : type[Model]
+                modelo cuya cache se invalida
+            mode : str
+                'evict' o 'refresh'
+            batch_size : int
+                numero maximo de cambios por pipeline
+            max_lag : float
+                segundos maximos que se acumulan cambios antes de aplicarlos
+        """
+
+        if mode not in ('evict', 'refresh'):
+            raise Exception(f'[10] Modo de invalidacion "{mode}" no valido.')
+        if batch_size < 1:
+            raise Exception(f'[4] Tamanio de lote "{batch_size}" no valido.')
+
+        self.model = model_class
+        self.mode = mode
+        self.batch_size = batch_size
+        self.max_lag = max_lag
+        self.applied = 0
+        self.script_reemplazar = redis.commands.core.Script(None, REEMPLAZAR_HASH.encode())
+        self.script_expulsar = redis.commands.core.Script(None, EXPULSAR_SI_CAMBIA.encode())
+        self.parar = threading.Event()
+        self.hilo: threading.Thread | None = None
+        self.detenido = False
+
+        # El hilo no sobrevive a un fork, el proceso hijo arranca el suyo
+        hilos_fondo.add(self)
+
+    def _clave_token(self) -> str:
+        return f'change-stream:{self.model.db.name}:token'
+
+    def _token(self) -> dict | None:
+        token = self.model.redis.get(self._clave_token())
+        return bson.decode(token) if token is not None else None
+
+    def apply(self, cambios: list[dict]) -> None:
+        """
+        Aplica un lote de cambios a la cache en una sola peticion junto
+        con el resume token del ultimo, para no perder ni repetir cambios.
+
+        Parameters
+        ----------
+            cambios : list[dict]
+                eventos del change stream
+        """
+
+        if not cambios: return
+
+        pipeline = self.model.redis.pipeline()
+        for cambio in cambios:
+            if (operacion := cambio['operationType']) not in ('insert', 'update', 'replace', 'delete'): continue
+
+            identificador = cambio['documentKey']['_id']
+            clave = self.model._clave(identificador)
+
+            # Los documentos nuevos solo invalidan la marca de inexistente
+            if operacion == 'insert': pipeline.delete(f'{clave}:missing')
+            elif self.mode == 'refresh' and (documento := cambio.get('fullDocument')) is not None:
+                argumentos = [self.model.document_ttl]
+                for campo, valor in documento.items():
+                    if campo != '_id': argumentos += [campo, self.model.codec.encode_value(valor)]
+                self.script_reemplazar(keys=[clave], args=argumentos, client=pipeline)
+            elif (valores := self._valores(cambio)) is not None:
+                self.script_expulsar(keys=[clave], args=valores, client=pipeline)
+            else: pipeline.delete(clave)
+
+            if operacion != 'insert': self.model._invalidar_near_cache(pipeline, identificador)
+
+        self.model._nueva_version(pipeline)
+        pipeline.set(self._clave_token(), bson.encode(cambios[-1]['_id']))
+        pipeline.execute()
+
+        self.applied += len(cambios)
+
+    def _valores(self, cambio: dict) -> list | None:
+        """
+        Devuelve los argumentos de EXPULSAR_SI_CAMBIA con los valores que
+        deja el cambio, o None si hay que eliminar el documento sin comparar
+        (borrados, variables eliminadas o anidadas).
+        """
 
-    Parameters
-    ----------
-        address : str
-            direccion completa de la que obtener las coordenadas
-    Returns
-    -------
-        geojson.Point
-            coordenadas del punto de la direccion
-    """
+        if cambio['operationType'] == 'replace' and (documento := cambio.get('fullDocument')) is not None:
+            campos = {campo: valor for campo, valor in documento.items() if campo != '_id'}
+            argumentos = [len(campos)]
 
-    location = None
-    while location is None:
-        try:
-            time.sleep(1)
-            location = Nominatim(user_agent='adtodallo').geocode(address)
-        except GeocoderTimedOut:
-            # Puede lanzar una excepcion si se supera el tiempo de espera
-            # Volver a intentarlo
-            continue
+        elif cambio['operationType'] == 'update' and (descripcion := cambio.get('updateDescription')) is not None:
+            if descripcion.get('removedFields') or descripcion.get('truncatedArrays'): return None
+            campos = descripcion.get('updatedFields', {})
+            if any('.' in campo for campo in campos): return None
+            argumentos = [-1]
 
-    return Point((location.latitude, location.longitude))
+        else: return None
 
+        for campo, valor in campos.items(): argumentos += [campo, self.model.codec.encode_value(valor)]
+        return argumentos
 
-class Model:
-    """ 
-    Clase de modelo abstracta
-    Crear tantas clases que hereden de esta clase como  
-    colecciones/modelos se deseen tener en la base de datos.
+    def _vaciar(self) -> None:
+        """
+        Elimina de la cache todos los documentos del modelo y el resume
+        token, cuando no se puede saber que documentos han cambiado.
+        """
+
+        claves = self.model.redis.scan_iter(match=f'{self.model.db.name}:*', count=self.batch_size)
+        for lote in iter(lambda: list(itertools.islice(claves, self.batch_size)), []):
+            self.model.redis.delete(*lote)
+
+        pipeline = self.model.redis.pipeline()
+        self.model._nueva_version(pipeline)
+        pipeline.delete(self._clave_token())
+        pipeline.execute()
+
+        if self.model.near_cache is not None: self.model.near_cache.clear()
+
+    def _seguir(self) -> None:
+        """
+        Sigue el change stream desde el ultimo token guardado hasta que
+        se detiene el hilo o el stream se invalida.
+        """
+
+        opciones = {'max_await_time_ms': int(self.max_lag * 1000)}
+        if self.mode == 'refresh': opciones['full_document'] = 'updateLookup'
+        if (token := self._token()) is not None: opciones['resume_after'] = token
+
+        with self.model.db.watch(**opciones) as stream:
+            while not self.parar.is_set():
+                lote: list[dict] = []
+                limite = time.monotonic() + self.max_lag
+                while len(lote) < self.batch_size and time.monotonic() < limite and not self.parar.is_set():
+                    if (cambio := stream.try_next()) is None: continue
+                    lote.append(cambio)
+
+                    # Tras eliminar o renombrar la coleccion no hay ids con los que invalidar
+                    if cambio['operationType'] in ('drop', 'rename', 'dropDatabase', 'invalidate'): break
+
+                if lote and lote[-1]['operationType'] in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+                    self.apply(lote[:-1])
+                    self._vaciar()
+                    return
+
+                self.apply(lote)
+
+    def start(self) -> None:
+        """
+        Arranca el hilo que sigue los cambios de la coleccion.
+        """
+
+        if self.hilo is not None and self.hilo.is_alive(): return
+
+        self.detenido = False
+        self.parar.clear()
+        self.hilo = threading.Thread(target=self._bucle, name=f'change-stream-{self.model.__name__}', daemon=True)
+        self.hilo.start()
+
+    def stop(self) -> None:
+        """
+        Detiene el hilo, los cambios ya leidos del lote en curso se aplican.
+        """
+
+        self.detenido = True
+        self.parar.set()
+        if self.hilo is not None and self.hilo is not threading.current_thread(): self.hilo.join()
+        self.hilo = None
+
+    def _bucle(self) -> None:
+        while not self.parar.is_set():
+            try:
+                self._seguir()
+            except OperationFailure as error:
+                # El token ya no esta en el oplog, no se sabe que ha cambiado
+                if error.code in (260, 280, 286): self._vaciar()
+                else: logger.exception('[11] Error en el change stream de %s', self.model.__name__)
+                self.parar.wait(self.max_lag)
+            except Exception:
+                # Los errores no detienen el hilo, se vuelve a intentar tras max_lag
+                logger.exception('[11] Error en el change stream de %s', self.model.__name__)
+                self.parar.wait(self.max_lag)
+
+    def _reiniciar(self) -> None:
+        # Solo se vuelve a arrancar si el hilo estaba arrancado en el proceso padre
+        arrancado = self.hilo is not None and not self.detenido
+        self.parar = threading.Event()
+        self.hilo = None
+        if arrancado: self.start()
+
+
+class AsyncModel(Model):
+    """
+    Version asincrona de Model para utilizar con asyncio.
+    La cache utiliza redis.asyncio y las operaciones de mongo se
+    ejecutan en un conjunto limitado de hilos para no bloquear el
+    bucle de eventos. Comparte la cache de redis con el modelo sincrono
+    de la misma coleccion.
 
     Attributes
     ----------
-        required_vars : set[str]
-            conjunto de variables requeridas por el modelo
-        admissible_vars : set[str]
-            conjunto de variables admitidas por el modelo
-        db : pymongo.collection.Collection
-            conexion a la coleccion de la base de datos
+        redis : redis.asyncio.Redis
+            conexion asincrona a redis
+        executor : concurrent.futures.ThreadPoolExecutor
+            hilos en los que se ejecutan las operaciones de mongo
 
     Methods
     -------
-        __setattr__(name: str, value: str | dict) -> None
-            Sobreescribe el metodo de asignacion de valores a las
-            variables del objeto con el fin de controlar las variables
-            que se asignan al modelo y cuando son modificadas.
-        save()  -> None
+        save() -> None
             Guarda el modelo en la base de datos
         delete() -> None
             Elimina el modelo de la base de datos
-        find(filter: dict[str, str | dict]) -> ModelCursor
+        find(filter: dict[str, str | dict]) -> AsyncModelCursor
             Realiza una consulta de lectura en la BBDD.
-            Devuelve un cursor de modelos ModelCursor
-        aggregate(pipeline: list[dict]) -> pymongo.command_cursor.CommandCursor
+        aggregate(pipeline: list[dict]) -> list[dict]
             Devuelve el resultado de una consulta aggregate.
-        find_by_id(id: str) -> dict | None
-            Busca un documento por su id utilizando la cache y lo devuelve.
-            Si no se encuentra el documento, devuelve None.
-        init_class(db_collection: pymongo.collection.Collection, requiered_vars: set[str], admissible_vars: set[str]) -> None
-            Inicializa las variables de clase en la inicializacion del sistema.
+        find_by_id(id: str) -> Model | None
+            Busca un documento por su id utilizando la cache.
+        find_many_by_id(identificadores: list[str]) -> list[Model | None]
+            Busca varios documentos por su id utilizando la cache.
 
+    La cache local, la escritura diferida, los change streams y near solo
+    estan disponibles en el modelo sincrono, igual que los modelos parciales.
     """
 
-    required_vars: set[str]
-    admissible_vars: set[str]
-    db: pymongo.collection.Collection
-    redis: redis.Redis
+    __slots__ = ()
 
-    def __init__(self, **kwargs: dict[str, str | dict]):
-        """
-        Inicializa el modelo con los valores proporcionados en kwargs
-        Comprueba que los valores proporcionados en kwargs son admitidos
-        por el modelo y que las variables requeridas son proporcionadas.
+    redis: redis.asyncio.Redis
+    executor: concurrent.futures.ThreadPoolExecutor
 
-        Parameters
-        ----------
-            kwargs : dict[str, str | dict]
-                diccionario con los valores de las variables del modelo
+    @classmethod
+    async def _mongo(cls, funcion: Any, *args: Any, **kwargs: Any) -> Any:
         """
-
-        self.__changed__: set[str] = set()
-
-        for required in self.required_vars:
-            if required not in kwargs.keys():
-                raise Exception(f'[2] Variable "{required}" requerida no especificada.')
-
-        for name, value in kwargs.items(): self.__setattr__(name, value)
-
-    def __setattr__(self, name: str, value: str | dict) -> None:
-        """ Sobreescribe el metodo de asignacion de valores a las
-        variables del objeto con el fin de controlar las variables
-        que se asignan al modelo y cuando son modificadas.
+        Ejecuta una operacion de mongo en los hilos del modelo y espera su resultado.
         """
 
-        if name not in {*self.required_vars, *self.admissible_vars, *{'__changed__'}}:
-            raise Exception(f'[1] Variable "{name}" no admitida por el modelo.')
-
-        # Si ya existe la variable, la agrega como cambiada
-        if name in self.__dict__.keys():
-            self.__changed__.add(name)
+        return await asyncio.get_running_loop().run_in_executor(cls.executor, functools.partial(funcion, *args, **kwargs))
 
-        self.__dict__[name] = value
-
-    def save(self) -> None:
+    async def save(self) -> None:
         """
         Guarda el modelo en la base de datos
         Si el modelo no existe en la base de datos, se crea un nuevo
@@ -129,192 +2943,557 @@ class Model:
         modelo.
         """
 
-        # Si tiene datos cambiados, los actualiza basado en los otros datos no cambiados
+        pipeline = self.redis.pipeline()
+
         if hasattr(self, '_id'):
-            self.db.update_one({'_id': getattr(self, '_id')}, {'$set': {changed: getattr(self, changed) for changed in self.__changed__}})
-            self.__changed__.clear()
+            cambios = {changed: getattr(self, changed) for changed in self.__changed__}
+            if not cambios: return
+
+            await self._mongo(self.db.update_one, {'_id': getattr(self, '_id')}, {'$set': cambios})
+            self._limpiar_cambios()
+            await self._actualizar_cache(pipeline, getattr(self, '_id'), cambios)
+
+            # Avisa a las caches locales de los procesos sincronos
+            pipeline.publish(CANAL_NEAR_CACHE, self._clave(getattr(self, '_id')))
 
-        # Si no tiene datos cambiados, inserta los datos
         else:
-            # Copia los datos en una variable nueva
-            # Elimina las variables cambiadas para evitar errores en la busqueda
-            # Elimina las variables de control
-            datos: dict[str, str | dict] = self.__dict__.copy()
-            datos.pop('__changed__')
-            setattr(self, '_id', self.db.insert_one(datos).inserted_id)
+            datos: dict[str, str | dict] = self._documento()
+            setattr(self, '_id', (await self._mongo(self.db.insert_one, datos)).inserted_id)
+            self._cachear(pipeline, self._documento())
 
-        datos: dict[str, str | dict] = self.__dict__.copy()
-        datos.pop('__changed__')
-        datos.pop('_id')
-        self.redis.setex(str(getattr(self, '_id')), 60 * 60 * 24, json.dumps(datos))
+        self._nueva_version(pipeline)
+        await pipeline.execute()
 
-    def delete(self) -> None:
+    def __getattr__(self, name: str) -> Any:
+        """
+        Los modelos asincronos siempre estan completos, nunca se cargan
+        variables de forma sincrona desde la base de datos.
+        """
+
+        raise AttributeError(f'{type(self).__name__} no tiene la variable "{name}"')
+
+    async def delete(self) -> None:
         """
         Elimina el modelo de la base de datos
+        Descarta tambien los cambios pendientes de la escritura diferida del
+        modelo sincrono, que puede estar activada en este u otro proceso,
+        para que no vuelva a crear el documento.
         """
 
         if not hasattr(self, '_id'):
             raise Exception('[3] El modelo no esta guardado, imposible eliminarlo.')
 
-        self.db.delete_one({'_id': getattr(self, '_id')})
-        self.redis.delete(getattr(self, '_id'))
+        await self._mongo(self.db.delete_one, {'_id': getattr(self, '_id')})
+
+        pipeline = self.redis.pipeline()
+        WriteBehind.descartar(pipeline, self.db.name, getattr(self, '_id'))
+        pipeline.delete(self._clave(getattr(self, '_id')))
+        pipeline.publish(CANAL_NEAR_CACHE, self._clave(getattr(self, '_id')))
+        self._nueva_version(pipeline)
+        await pipeline.execute()
 
     @classmethod
-    def find(cls, filter: dict[str, str | dict]) -> Any:
+    def find(cls, filter: dict[str, str | dict], batch_size: int = 100) -> 'AsyncModelCursor':
         """
-        Utiliza el metodo find de pymongo para realizar una consulta
-        de lectura en la BBDD.
-        find debe devolver un cursor de modelos ModelCurso
+        Realiza una consulta de lectura en la BBDD.
+        Devuelve un cursor asincrono de modelos.
 
         Parameters
         ----------
             filter : dict[str, str | dict]
                 diccionario con el criterio de busqueda de la consulta
+            batch_size : int
+                numero de documentos que se procesan por lote en la cache
         Returns
         -------
-            ModelCursor
-                cursor de modelos
+            AsyncModelCursor
+                cursor asincrono de modelos
         """
 
-        return iter(ModelCursor(cls, cls.db.find(filter), cls.redis))
+        return AsyncModelCursor(cls, cls.db.find(filter), batch_size)
 
     @classmethod
-    def aggregate(cls, pipeline: list[dict]) -> pymongo.command_cursor.CommandCursor:
+    async def aggregate(cls, pipeline: list[dict], batch_size: int | None = None, allow_disk_use: bool = False,
+                        max_time_ms: int | None = None, hint: str | list | None = None) -> list[dict]:
         """
         Devuelve el resultado de una consulta aggregate.
-        No hay nada que hacer en esta funcion.
-        Se utilizara para las consultas solicitadas
-        en el segundo apartado de la practica.
+        Las consultas con $out o $merge modifican la version de su
+        coleccion destino, igual que en el modelo sincrono.
 
         Parameters
         ----------
             pipeline : list[dict]
                 lista de etapas de la consulta aggregate
+            batch_size, allow_disk_use, max_time_ms, hint
+                opciones de la consulta, ver Model.aggregate
         Returns
         -------
-            pymongo.command_cursor.CommandCursor
-                cursor de pymongo con el resultado de la consulta
+            list[dict]
+                documentos resultado de la consulta
         """
 
-        return cls.db.aggregate(pipeline)
+        opciones = cls._opciones_aggregate(batch_size, allow_disk_use, max_time_ms, hint)
+        resultado = await cls._mongo(lambda: list(cls.db.aggregate(pipeline, **opciones)))
+
+        if destinos := coleccionesDestino(pipeline, cls.db.name): await cls._versionar_destinos(destinos)
+        return resultado
 
     @classmethod
-    def find_by_id(cls, identificador: str) -> Self | None:
+    async def find_by_id(cls, identificador: str, fields: list[str] | None = None) -> Self | None:
         """
-        NO IMPLEMENTAR HASTA LA SEGUNDA PRACTICA
         Busca un documento por su id utilizando la cache y lo devuelve.
         Si no se encuentra el documento, devuelve None.
 
         Parameters
         ----------
-            id : str
+            identificador : str
                 id del documento a buscar
+            fields : list[str] | None
+                no disponible, los modelos asincronos no pueden ser parciales
         Returns
         -------
-            dict | None
-                documento encontrado o None si no se encuentra
+            Model | None
+                modelo encontrado o None si no se encuentra
         """
 
-        if cls.redis.exists(identificador):
-            documento = json.loads(cls.redis.get(identificador))
-            documento.update({'_id': bson.ObjectId(identificador)})
-            cls.redis.expire(identificador, 60 * 60 * 24)
+        if fields is not None:
+            raise Exception('[7] Los modelos parciales no estan disponibles para los modelos asincronos.')
 
-        else:
-            documento = cls.db.find_one({'_id': bson.ObjectId(identificador)})
-            documento_copia = documento.copy()
-            documento_copia.pop('_id')
-            cls.redis.setex(identificador, 60 * 60 * 24, json.dumps(documento_copia))
+        clave = cls._clave(identificador)
+
+        # Como en el modelo sincrono, solo uno rellena la cache y los ids que no existen se recuerdan
+        cerrojo = False
+        limite = time.monotonic() + cls.refill_lock_ttl
+        while True:
+            pipeline = cls.redis.pipeline(transaction=False)
+            pipeline.hgetall(clave)
+            pipeline.expire(clave, cls.document_ttl)
+            pipeline.exists(f'{clave}:missing')
+            campos, _, inexistente = await pipeline.execute()
+
+            if campos: return cls(**cls._desde_cache(identificador, campos))
+            if inexistente: return None
+
+            if cls.refill_lock_ttl <= 0 or time.monotonic() >= limite: break
+            if await cls.redis.set(f'{clave}:lock', b'1', nx=True, px=int(cls.refill_lock_ttl * 1000)):
+                cerrojo = True
+                break
+
+            await asyncio.sleep(0.05)
+
+        documento = await cls._mongo(cls.db.find_one, {'_id': bson.ObjectId(identificador)})
+
+        pipeline = cls.redis.pipeline()
+        if documento is not None: cls._cachear(pipeline, documento)
+        elif cls.negative_ttl > 0: pipeline.set(f'{clave}:missing', b'1', ex=cls.negative_ttl)
+        if cerrojo: pipeline.delete(f'{clave}:lock')
+        await pipeline.execute()
+
+        if documento is None: return None
+        return cls(**documento)
+
+    @classmethod
+    async def find_many_by_id(cls, identificadores: list[str]) -> list[Self | None]:
+        """
+        Busca varios documentos por su id utilizando la cache y los
+        devuelve en el mismo orden en el que se han pedido.
+        Los que no estan en la cache se buscan con una sola consulta $in.
+
+        Parameters
+        ----------
+            identificadores : list[str]
+                ids de los documentos a buscar
+        Returns
+        -------
+            list[Model | None]
+                modelos encontrados o None si no se encuentran
+        """
+
+        if not identificadores: return []
+
+        documentos: dict[str, dict] = {}
+
+        pipeline = cls.redis.pipeline(transaction=False)
+        for identificador in identificadores:
+            pipeline.hgetall(cls._clave(identificador))
+            pipeline.expire(cls._clave(identificador), cls.document_ttl)
+        respuestas = await pipeline.execute()
+
+        for identificador, campos in zip(identificadores, respuestas[::2]):
+            if campos: documentos[identificador] = cls._desde_cache(identificador, campos)
+
+        pendientes = {bson.ObjectId(identificador) for identificador in identificadores if identificador not in documentos}
+        if pendientes:
+            pipeline = cls.redis.pipeline()
+            for documento in await cls._mongo(lambda: list(cls.db.find({'_id': {'$in': list(pendientes)}}))):
+                documentos[str(documento['_id'])] = documento
+                cls._cachear(pipeline, documento)
+            await pipeline.execute()
 
-        return cls(**documento) if documento else None
+        return [cls(**documentos[identificador]) if identificador in documentos else None for identificador in identificadores]
 
     @classmethod
-    def init_class(cls, db_collection: pymongo.collection.Collection, redis_connection: redis.Redis, required_vars: set[str], admissible_vars: set[str]) -> None:
+    def enable_near_cache(cls, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl: float = 5) -> NearCache:
+        raise Exception('[7] La cache local no esta disponible para los modelos asincronos.')
+
+    @classmethod
+    def near(cls, point: Point | dict, max_distance: float | None = None, filter: dict | None = None,
+             batch_size: int = 100) -> Generator:
+        raise Exception('[7] Las busquedas por cercania no estan disponibles para los modelos asincronos.')
+
+    @classmethod
+    def enable_write_behind(cls, max_lag: float = 1, batch_size: int = 1000, claim_timeout: float = 30) -> 'WriteBehind':
+        raise Exception('[7] La escritura diferida no esta disponible para los modelos asincronos.')
+
+    @classmethod
+    def enable_change_stream(cls, mode: str = 'evict', batch_size: int = 500, max_lag: float = 0.5) -> 'ChangeStreamWatcher':
+        raise Exception('[7] Los change streams no estan disponibles para los modelos asincronos.')
+
+    @classmethod
+    def init_class(cls, db_collection: pymongo.collection.Collection, redis_connection: redis.asyncio.Redis, required_vars: set[str], admissible_vars: set[str], codec: CacheCodec | None = None, executor: concurrent.futures.ThreadPoolExecutor | None = None) -> None:
         """
         Inicializa las variables de clase en la inicializacion del sistema.
-        En principio nada que hacer aqui salvo que se quieran realizar
-        comprobaciones o cambios adicionales.
 
         Parameters
         ----------
             db_collection : pymongo.collection.Collection
                 Conexion a la collecion de la base de datos.
+            redis_connection : redis.asyncio.Redis
+                Conexion asincrona a redis
             required_vars : set[str]
                 Set de variables requeridas por el modelo
             admissible_vars : set[str]
                 Set de variables admitidas por el modelo
+            codec : CacheCodec | None
+                Formato de la cache del modelo, bson por defecto
+            executor : concurrent.futures.ThreadPoolExecutor | None
+                Hilos para las operaciones de mongo, 8 por defecto
         """
 
-        cls.db = db_collection
-        cls.redis = redis_connection
-        cls.required_vars = required_vars
-        cls.admissible_vars = admissible_vars
+        super().init_class(db_collection, redis_connection, required_vars, admissible_vars, codec)
+        cls._script_actualizar = redis.commands.core.AsyncScript(None, ACTUALIZAR_HASH.encode())
+        cls.executor = executor if executor is not None else concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
 
-class ModelCursor:
+class AsyncModelCursor:
     """
-    Cursor para iterar sobre los documentos del resultado de una
-    consulta. Los documentos deben ser devueltos en forma de objetos
-    modelo.
+    Cursor asincrono para iterar con async for sobre los documentos
+    del resultado de una consulta. Los documentos se leen de mongo por
+    lotes en los hilos del modelo y cada lote se guarda en la cache en
+    una sola peticion.
 
     Attributes
     ----------
-        model_class : Model
+        model_class : AsyncModel
             Clase para crear los modelos de los documentos que se iteran.
-        command_cursor : pymongo.command_cursor.CommandCursor
+        command_cursor : pymongo.cursor.Cursor
             Cursor de pymongo a iterar
-
-    Methods
-    -------
-        __iter__() -> Generator
-            Devuelve un iterador que recorre los elementos del cursor
-            y devuelve los documentos en forma de objetos modelo.
+        batch_size : int
+            Numero de documentos por lote
     """
 
-    def __init__(self, model_class: Model, command_cursor: pymongo.cursor.Cursor):
+    def __init__(self, model_class: type[AsyncModel], command_cursor: pymongo.cursor.Cursor, batch_size: int = 100):
         """
         Inicializa el cursor con la clase de modelo y el cursor de pymongo
 
         Parameters
         ----------
-            model_class : Model
+            model_class : AsyncModel
                 Clase para crear los modelos de los documentos que se iteran.
-            command_cursor: pymongo.command_cursor.CommandCursor
+            command_cursor: pymongo.cursor.Cursor
                 Cursor de pymongo a iterar
+            batch_size : int
+                Numero de documentos por lote
         """
 
+        if batch_size < 1:
+            raise Exception(f'[4] Tamanio de lote "{batch_size}" no valido.')
+
         self.model = model_class
         self.cursor = command_cursor
+        self.batch_size = batch_size
+
+        self.cursor.batch_size(batch_size)
 
-    def __iter__(self) -> Generator:
+    async def __aiter__(self) -> AsyncGenerator:
         """
-        Devuelve un iterador que recorre los elementos del cursor
-        y devuelve los documentos en forma de objetos modelo.
-        Utilizar yield para generar el iterador
-        Utilizar la funcion next para obtener el siguiente documento del cursor
-        Utilizar alive para comprobar si existen mas documentos.
+        Devuelve un iterador asincrono que recorre los elementos del
+        cursor y devuelve los documentos en forma de objetos modelo.
         """
 
-        while self.cursor.alive:
-            # Comprobar si el documento existe en la cache
-            # Si existe, devolver el documento de la cache
-            # Si no existe, devolver el documento de la base de datos
-            documento = next(self.cursor)
-            if not self.model.redis.exists(str(documento['_id'])):
-                documento_copia = documento.copy()
-                documento_copia.pop('_id')
-                self.model.redis.setex(str(documento['_id']), 60 * 60 * 24, json.dumps(documento_copia))
+        while True:
+            lote = await self.model._mongo(lambda: list(itertools.islice(self.cursor, self.batch_size)))
+            if not lote: break
 
-            else:
-                self.model.redis.expire(str(documento['_id']), 60 * 60 * 24)
+            pipeline = self.model.redis.pipeline()
+            for documento in lote: self.model._cachear(pipeline, documento)
+            await pipeline.execute()
+
+            for documento in lote: yield self.model(**documento)
+
+
+class ConnectionConfig:
+    """
+    Configuracion de las conexiones a mongo y redis.
+
+    Attributes
+    ----------
+        mongodb_uri : str
+            uri de conexion a la base de datos
+        db_name : str
+            nombre de la base de datos
+        mongo_max_pool_size : int
+            numero maximo de conexiones a mongo
+        mongo_min_pool_size : int
+            numero minimo de conexiones a mongo
+        mongo_connect_timeout_ms : int
+            tiempo maximo para establecer una conexion con mongo
+        mongo_socket_timeout_ms : int | None
+            tiempo maximo de espera de una respuesta de mongo
+        mongo_server_selection_timeout_ms : int
+            tiempo maximo para encontrar un servidor de mongo disponible
+        read_preference : str
+            servidores de los que se leen los datos (primary, secondaryPreferred, ...)
+        redis_host : str
+            servidor de redis
+        redis_port : int
+            puerto de redis
+        redis_db : int
+            base de datos de redis
+        redis_max_connections : int | None
+            numero maximo de conexiones a redis
+        redis_socket_timeout : float | None
+            tiempo maximo de espera de una respuesta de redis
+        redis_socket_connect_timeout : float | None
+            tiempo maximo para establecer una conexion con redis
+        redis_socket_keepalive : bool
+            mantiene abiertas las conexiones a redis con keepalive
+        redis_health_check_interval : int
+            segundos tras los que se comprueba una conexion a redis sin uso
+        redis_server_config : dict[str, str] | None
+            configuracion que se aplica al servidor de redis, None para no cambiarla
+        executor_max_workers : int
+            hilos para las operaciones de mongo de los modelos asincronos
+    """
+
+    def __init__(self,
+                 mongodb_uri: str = 'mongodb://localhost:27017/',
+                 db_name: str = 'proyecto1',
+                 mongo_max_pool_size: int = 100,
+                 mongo_min_pool_size: int = 0,
+                 mongo_connect_timeout_ms: int = 20000,
+                 mongo_socket_timeout_ms: int | None = None,
+                 mongo_server_selection_timeout_ms: int = 30000,
+                 read_preference: str = 'primary',
+                 redis_host: str = 'localhost',
+                 redis_port: int = 6379,
+                 redis_db: int = 0,
+                 redis_max_connections: int | None = None,
+                 redis_socket_timeout: float | None = None,
+                 redis_socket_connect_timeout: float | None = None,
+                 redis_socket_keepalive: bool = True,
+                 redis_health_check_interval: int = 0,
+                 redis_server_config: dict[str, str] | None = None,
+                 executor_max_workers: int = 16):
+        self.mongodb_uri = mongodb_uri
+        self.db_name = db_name
+        self.mongo_max_pool_size = mongo_max_pool_size
+        self.mongo_min_pool_size = mongo_min_pool_size
+        self.mongo_connect_timeout_ms = mongo_connect_timeout_ms
+        self.mongo_socket_timeout_ms = mongo_socket_timeout_ms
+        self.mongo_server_selection_timeout_ms = mongo_server_selection_timeout_ms
+        self.read_preference = read_preference
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.redis_db = redis_db
+        self.redis_max_connections = redis_max_connections
+        self.redis_socket_timeout = redis_socket_timeout
+        self.redis_socket_connect_timeout = redis_socket_connect_timeout
+        self.redis_socket_keepalive = redis_socket_keepalive
+        self.redis_health_check_interval = redis_health_check_interval
+        self.redis_server_config = redis_server_config
+        self.executor_max_workers = executor_max_workers
+
+    def redis_options(self) -> dict[str, Any]:
+        """
+        Devuelve las opciones comunes de los pools de conexiones a redis.
+        """
+
+        return {
+            'host': self.redis_host,
+            'port': self.redis_port,
+            'db': self.redis_db,
+            'max_connections': self.redis_max_connections,
+            'socket_timeout': self.redis_socket_timeout,
+            'socket_connect_timeout': self.redis_socket_connect_timeout,
+            'socket_keepalive': self.redis_socket_keepalive,
+            'health_check_interval': self.redis_health_check_interval
+        }
+
+
+class Connections:
+    """
+    Crea las conexiones a mongo y redis la primera vez que se utilizan
+    y las vuelve a crear en el proceso hijo tras un fork, para que los
+    procesos no compartan sockets ni hilos.
+
+    Attributes
+    ----------
+        config : ConnectionConfig
+            configuracion de las conexiones
+
+    Methods
+    -------
+        collection(nombre: str) -> pymongo.collection.Collection
+            Devuelve una coleccion de la base de datos.
+        redis_client() -> redis.Redis
+            Devuelve el cliente de redis.
+        redis_async_client() -> redis.asyncio.Redis
+            Devuelve el cliente asincrono de redis.
+        executor() -> concurrent.futures.ThreadPoolExecutor
+            Devuelve los hilos para las operaciones de mongo asincronas.
+        reset() -> None
+            Olvida las conexiones creadas para volver a crearlas.
+        sync_indexes_on_first_use(nombre: str, sincronizar: Callable[[], Any]) -> None
+            Sincroniza los indices de una coleccion la primera vez que se utiliza.
+    """
+
+    def __init__(self, config: ConnectionConfig):
+        """
+        Inicializa las conexiones sin crear ninguna
 
-            yield self.model(**documento)
+        Parameters
+        ----------
+            config : ConnectionConfig
+                configuracion de las conexiones
+        """
+
+        self.config = config
+        self.indices: dict[str, Callable[[], Any]] = {}
+        self.reset()
+        conexiones_creadas.add(self)
+
+    def reset(self) -> None:
+        """
+        Olvida las conexiones creadas para volver a crearlas.
+        No las cierra porque tras un fork pertenecen al proceso padre.
+        """
+
+        self.cerrojo = threading.Lock()
+        self.cliente_mongodb: pymongo.MongoClient | None = None
+        self.colecciones: dict[str, pymongo.collection.Collection] = {}
+        self.cliente_redis: redis.Redis | None = None
+        self.cliente_redis_async: redis.asyncio.Redis | None = None
+        self.hilos: concurrent.futures.ThreadPoolExecutor | None = None
+
+    def collection(self, nombre: str) -> pymongo.collection.Collection:
+        if (coleccion := self.colecciones.get(nombre)) is not None: return coleccion
+
+        with self.cerrojo:
+            if self.cliente_mongodb is None:
+                self.cliente_mongodb = pymongo.MongoClient(
+                    self.config.mongodb_uri,
+                    maxPoolSize=self.config.mongo_max_pool_size,
+                    minPoolSize=self.config.mongo_min_pool_size,
+                    connectTimeoutMS=self.config.mongo_connect_timeout_ms,
+                    socketTimeoutMS=self.config.mongo_socket_timeout_ms,
+                    serverSelectionTimeoutMS=self.config.mongo_server_selection_timeout_ms,
+                    readPreference=self.config.read_preference,
+                    event_listeners=[instrumentacion] if instrumentacion is not None else [],
+                    connect=False
+                )
+
+            coleccion = self.colecciones.setdefault(nombre, self.cliente_mongodb[self.config.db_name][nombre])
+
+        # Fuera del cerrojo, sincronizar los indices vuelve a pedir la coleccion
+        if (sincronizar := self.indices.pop(nombre, None)) is not None: sincronizar()
+
+        return coleccion
+
+    def sync_indexes_on_first_use(self, nombre: str, sincronizar: Callable[[], Any]) -> None:
+        """
+        Guarda la sincronizacion de los indices de una coleccion para
+        hacerla la primera vez que se utilice, sin conectarse a mongo antes.
+
+        Parameters
+        ----------
+            nombre : str
+                nombre de la coleccion
+            sincronizar : Callable[[], Any]
+                funcion que sincroniza los indices
+        """
+
+        self.indices[nombre] = sincronizar
+
+    def redis_client(self) -> redis.Redis:
+        if self.cliente_redis is not None: return self.cliente_redis
+
+        with self.cerrojo:
+            if self.cliente_redis is None:
+                # La cache guarda documentos binarios, las respuestas no se decodifican a str
+                cliente_redis = redis.Redis(connection_pool=redis.ConnectionPool(**self.config.redis_options()))
+                if instrumentacion is not None: instrumentacion.instrumentar_redis(cliente_redis)
+
+                if self.config.redis_server_config:
+                    for parametro, valor in self.config.redis_server_config.items(): cliente_redis.config_set(parametro, valor)
+
+                self.cliente_redis = cliente_redis
+
+        return self.cliente_redis
+
+    def redis_async_client(self) -> redis.asyncio.Redis:
+        if self.cliente_redis_async is not None: return self.cliente_redis_async
+
+        with self.cerrojo:
+            if self.cliente_redis_async is None:
+                self.cliente_redis_async = redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool(**self.config.redis_options()))
+
+        return self.cliente_redis_async
+
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self.hilos is not None: return self.hilos
+
+        with self.cerrojo:
+            if self.hilos is None:
+                self.hilos = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.executor_max_workers)
+
+        return self.hilos
+
+
+# Conexiones que se vuelven a crear en el proceso hijo tras un fork
+conexiones_creadas: weakref.WeakSet[Connections] = weakref.WeakSet()
+
+
+def reiniciarConexiones() -> None:
+    """
+    Tras un fork olvida las conexiones del proceso padre en todas las
+    conexiones creadas. Se registra una sola vez para todo el modulo.
+    """
+
+    for conexiones in list(conexiones_creadas): conexiones.reset()
 
 
-def initApp(definitions_path: str = '/home/adriantoral/utad/ampliacion-bases-de-datos/p1_g11_adrian_toral_dario_llodra/models.yml', mongodb_uri='mongodb://localhost:27017/', db_name='proyecto1') -> None:
+os.register_at_fork(after_in_child=reiniciarConexiones)
+
+
+class LazyConnection:
+    """
+    Descriptor que devuelve la conexion de un modelo al acceder a ella,
+    tanto desde la clase como desde sus objetos, creandola si hace falta.
+    """
+
+    def __init__(self, fabrica: Any):
+        self.fabrica = fabrica
+
+    def __get__(self, instancia: Any, propietario: type) -> Any:
+        return self.fabrica()
+
+
+def initApp(definitions_path: str = '/home/adriantoral/utad/ampliacion-bases-de-datos/p1_g11_adrian_toral_dario_llodra/models.yml', mongodb_uri='mongodb://localhost:27017/', db_name='proyecto1', check_indexes: bool = False, config: ConnectionConfig | None = None) -> Connections:
     """
     Declara las clases que heredan de Model para cada uno de los
-    modelos de las colecciones definidas en definitions_path.
+    modelos de las colecciones definidas en definitions_path, y su
+    version asincrona con el prefijo Async (AsyncPersona, ...).
     Inicializa las clases de los modelos proporcionando las variables
     admitidas y requeridas para cada una de ellas y la conexión a la
     collecion de la base de datos.
@@ -327,21 +3506,96 @@ def initApp(definitions_path: str = '/home/adriantoral/utad/ampliacion-bases-de-
             uri de conexion a la base de datos
         db_name : str
             nombre de la base de datos
+        check_indexes : bool
+            muestra las consultas Q1-Q7 que no utilizan ningun indice
+        config : ConnectionConfig | None
+            configuracion de las conexiones, si se indica se ignoran
+            mongodb_uri y db_name
+    Returns
+    -------
+        Connections
+            conexiones compartidas por todos los modelos
     """
 
-    cliente_mongodb = pymongo.MongoClient(mongodb_uri)
-    base_datos = cliente_mongodb[db_name]
+    if config is None:
+        config = ConnectionConfig(mongodb_uri, db_name, redis_server_config={'maxmemory': '150mb', 'maxmemory-policy': 'volatile-ttl'})
 
-    cliente_redis = redis.Redis(host='localhost', port=6379, decode_responses=True)
-    cliente_redis.config_set('maxmemory', '150mb')
-    cliente_redis.config_set('maxmemory-policy', 'volatile-ttl')
+    # Las conexiones se crean al utilizarlas y se vuelven a crear tras un fork
+    conexiones = Connections(config)
 
     with open(definitions_path, 'r') as modelos:
         colecciones = yaml.safe_load(modelos)
 
     for modelo, atributos in colecciones.items():
-        globals()[modelo] = type(modelo, (Model,), {})
-        globals()[modelo].init_class(getattr(base_datos, modelo), cliente_redis, atributos['required_vars'], atributos['admissible_vars'])
+        # Cada variable del modelo ocupa un slot, los modelos no tienen __dict__
+        campos = tuple(dict.fromkeys([*atributos['required_vars'], *atributos['admissible_vars']]))
+        globals()[modelo] = type(modelo, (Model,), {'__slots__': campos})
+        globals()[modelo].init_class(LazyConnection(functools.partial(conexiones.collection, modelo)), LazyConnection(conexiones.redis_client), atributos['required_vars'], atributos['admissible_vars'])
+
+        # Los indices se sincronizan al utilizar la coleccion por primera vez, no al arrancar
+        conexiones.sync_indexes_on_first_use(modelo, functools.partial(globals()[modelo].sync_indexes, atributos.get('indexes', [])))
+
+        globals()[f'Async{modelo}'] = type(f'Async{modelo}', (AsyncModel,), {'__slots__': campos})
+        globals()[f'Async{modelo}'].init_class(LazyConnection(functools.partial(conexiones.collection, modelo)), LazyConnection(conexiones.redis_async_client), atributos['required_vars'], atributos['admissible_vars'], executor=LazyConnection(conexiones.executor))
+
+        opciones_cache = dict(atributos.get('cache', {}))
+        change_stream = opciones_cache.pop('change_stream', None)
+        localizacion = atributos.get('location', {})
+
+        # Las dos versiones del modelo comparten la cache, asi que tienen las mismas opciones
+        for clase in (globals()[modelo], globals()[f'Async{modelo}']):
+            # Opciones de la cache del modelo (negative_ttl, refill_lock_ttl, document_ttl)
+            for opcion, valor in opciones_cache.items(): setattr(clase, opcion, valor)
+
+            # Opciones de la ubicacion del modelo (field, geocode)
+            if 'field' in localizacion: clase.location_field = localizacion['field']
+            if 'geocode' in localizacion: clase.geocode = localizacion['geocode']
+
+        # El change stream invalida la cache compartida, basta con el del modelo sincrono
+        if change_stream: globals()[modelo].enable_change_stream(change_stream)
+
+    if check_indexes:
+        for consulta, etapa in checkIndexes(globals()['Persona'], {f'Q{i}': globals()[f'Q{i}'] for i in range(1, 8)}).items():
+            print(f'{consulta} no utiliza ningun indice: {etapa}')
+
+    return conexiones
+
+
+def checkIndexes(model_class: type[Model], pipelines: dict[str, list[dict]]) -> dict[str, str]:
+    """
+    Ejecuta explain sobre las consultas aggregate indicadas y devuelve
+    las que recorren la coleccion completa en lugar de usar un indice.
+
+    Parameters
+    ----------
+        model_class : type[Model]
+            modelo sobre cuya coleccion se ejecutan las consultas
+        pipelines : dict[str, list[dict]]
+            consultas aggregate por nombre
+    Returns
+    -------
+        dict[str, str]
+            consultas sin indice y la etapa del plan que recorre la coleccion
+    """
+
+    def buscar_collscan(plan: Any) -> str | None:
+        # Recorre el plan de ejecucion buscando una etapa COLLSCAN
+        if isinstance(plan, dict):
+            if plan.get('stage') == 'COLLSCAN': return f"COLLSCAN {plan.get('filter', {})}"
+            plan = list(plan.values())
+
+        if isinstance(plan, list):
+            for elemento in plan:
+                if (etapa := buscar_collscan(elemento)) is not None: return etapa
+
+        return None
+
+    sin_indice: dict[str, str] = {}
+    for nombre, pipeline in pipelines.items():
+        plan = model_class.db.database.command('explain', {'aggregate': model_class.db.name, 'pipeline': pipeline, 'cursor': {}}, verbosity='queryPlanner')
+        if (etapa := buscar_collscan(plan)) is not None: sin_indice[nombre] = etapa
+
+    return sin_indice
 
 
 # Q1
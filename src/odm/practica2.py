@@ -1,8 +1,17 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import hashlib
+import logging
+import threading
+import time
 import uuid
 
 import redis
 
+logger = logging.getLogger(__name__)
+
 # Crea una conexión a la base de datos Redis
 # decode_responses=True para que devuelva los datos en formato str en vez de bytes
 # maxmemory=150mb para limitar el tamaño de la base de datos a 150mb
@@ -11,6 +20,164 @@ cliente_redis = redis.Redis(host='localhost', port=6379, decode_responses=True)
 cliente_redis.config_set('maxmemory', '150mb')
 cliente_redis.config_set('maxmemory-policy', 'volatile-ttl')
 
+# Tiempo de vida de los tokens de sesión, 30 días
+TTL_TOKEN = 2592000
+
+# Crea el usuario solo si no existe, en una sola operación atómica
+# KEYS[1] clave del usuario, ARGV pares campo valor
+REGISTRAR_USUARIO = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+# Comprueba el token o las credenciales y emite o reutiliza el token de sesión
+# en una sola operación atómica. Devuelve {token, privilegios, usuario} o -1
+# Las claves del usuario dependen del token, por eso se construyen en el script
+# ARGV[1] token o '', ARGV[2] usuario, ARGV[3] contraseña encriptada,
+# ARGV[4] token nuevo por si hay que emitirlo, ARGV[5] tiempo de vida del token
+INICIAR_SESION = """
+if ARGV[1] ~= '' then
+    local usuario = redis.call('GET', ARGV[1])
+    if usuario then
+        local privilegios = redis.call('HGET', 'usuario:' .. usuario, 'privilegios')
+        if privilegios then return {ARGV[1], privilegios, usuario} end
+    end
+end
+
+local datos = redis.call('HMGET', 'usuario:' .. ARGV[2], 'contrasenia', 'privilegios')
+if not datos[1] or datos[1] ~= ARGV[3] then return -1 end
+
+local token = redis.call('GET', 'token:' .. ARGV[2])
+if not token then
+    token = ARGV[4]
+    redis.call('SET', token, ARGV[2], 'EX', ARGV[5])
+    redis.call('SET', 'token:' .. ARGV[2], token, 'EX', ARGV[5])
+end
+
+return {token, datos[2], ARGV[2]}
+"""
+
+# Canal por el que se avisa a las caches locales de tokens de los cambios
+# Los mensajes son 'usuario:<nombre>' o 'token:<token>'
+CANAL_TOKENS = 'sesiones:invalidaciones'
+
+# Elimina el token de sesión y el del usuario si es el mismo y avisa a las caches locales
+# ARGV[1] token, ARGV[2] canal de invalidaciones
+REVOCAR_TOKEN = """
+local usuario = redis.call('GET', ARGV[1])
+if not usuario then return 0 end
+redis.call('DEL', ARGV[1])
+if redis.call('GET', 'token:' .. usuario) == ARGV[1] then redis.call('DEL', 'token:' .. usuario) end
+redis.call('PUBLISH', ARGV[2], 'token:' .. ARGV[1])
+return 1
+"""
+
+# Reclama peticiones de la cola y las mueve a la lista de procesamiento en una sola operación
+# La lista de procesamiento guarda el instante en que caduca cada reclamación y su prioridad
+# KEYS[1] cola, KEYS[2] lista de procesamiento, KEYS[3] prioridades de las reclamadas
+# ARGV[1] número de peticiones, ARGV[2] segundos hasta que caduca la reclamación
+# Devuelve el instante del servidor (segundos, microsegundos) y los pares usuario puntuación
+RECLAMAR_PETICIONES = """
+local ahora = redis.call('TIME')
+local limite = tonumber(ahora[1]) + tonumber(ahora[2]) / 1000000 + tonumber(ARGV[2])
+local reclamadas = redis.call('ZPOPMAX', KEYS[1], ARGV[1])
+local resultado = {ahora[1], ahora[2]}
+for i = 1, #reclamadas, 2 do
+    redis.call('ZADD', KEYS[2], limite, reclamadas[i])
+    redis.call('HSET', KEYS[3], reclamadas[i], reclamadas[i + 1])
+    table.insert(resultado, reclamadas[i])
+    table.insert(resultado, reclamadas[i + 1])
+end
+return resultado
+"""
+
+# Reclama solo las peticiones de los usuarios indicados que sigan en la cola
+# KEYS como en RECLAMAR_PETICIONES, ARGV[1] segundos hasta que caduca la reclamación, resto usuarios
+RECLAMAR_USUARIOS = """
+local ahora = redis.call('TIME')
+local limite = tonumber(ahora[1]) + tonumber(ahora[2]) / 1000000 + tonumber(ARGV[1])
+local resultado = {ahora[1], ahora[2]}
+for i = 2, #ARGV do
+    local puntuacion = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if puntuacion then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('ZADD', KEYS[2], limite, ARGV[i])
+        redis.call('HSET', KEYS[3], ARGV[i], puntuacion)
+        table.insert(resultado, ARGV[i])
+        table.insert(resultado, puntuacion)
+    end
+end
+return resultado
+"""
+
+# Guarda una petición con su prioridad menos el envejecimiento por el instante de llegada,
+# de modo que la prioridad efectiva crece con la espera sin recalcular la puntuación
+# Si el usuario ya estaba en la cola, GT conserva la puntuación mayor para no perder lo que llevaba esperando
+# KEYS[1] cola, ARGV[1] usuario, ARGV[2] prioridad, ARGV[3] prioridad que gana por segundo
+REGISTRAR_PETICION = """
+local ahora = redis.call('TIME')
+local llegada = tonumber(ahora[1]) + tonumber(ahora[2]) / 1000000
+return redis.call('ZADD', KEYS[1], 'GT', tonumber(ARGV[2]) - tonumber(ARGV[3]) * llegada, ARGV[1])
+"""
+
+# Devuelve a la cola las peticiones indicadas o, si no se indica ninguna, las caducadas
+# Si el usuario ha vuelto a pedir ayuda mientras tanto, se queda con la prioridad mayor
+# KEYS como en RECLAMAR_PETICIONES, ARGV nombres de usuario
+REENTREGAR_PETICIONES = """
+local usuarios = ARGV
+if #usuarios == 0 then
+    local ahora = redis.call('TIME')
+    usuarios = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', tonumber(ahora[1]) + tonumber(ahora[2]) / 1000000)
+end
+local reentregadas = 0
+for _, usuario in ipairs(usuarios) do
+    if redis.call('ZREM', KEYS[2], usuario) == 1 then
+        local prioridad = redis.call('HGET', KEYS[3], usuario)
+        redis.call('HDEL', KEYS[3], usuario)
+        if prioridad then
+            redis.call('ZADD', KEYS[1], 'GT', prioridad, usuario)
+            reentregadas = reentregadas + 1
+        end
+    end
+end
+return reentregadas
+"""
+
+# Anota el fallo de una petición reclamada y la deja en la lista de procesamiento hasta que pase
+# la espera, que se duplica en cada intento. Tras el número máximo de intentos la petición pasa
+# a la cola de fallidas y ya no se vuelve a entregar
+# KEYS como en RECLAMAR_PETICIONES, KEYS[4] intentos, KEYS[5] fallidas
+# ARGV[1] usuario, ARGV[2] segundos de espera del primer reintento, ARGV[3] número máximo de intentos
+# Devuelve el número de intentos, 0 si pasa a fallidas o -1 si ya no estaba reclamada
+FALLAR_PETICION = """
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then return -1 end
+local intentos = redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+if intentos >= tonumber(ARGV[3]) then
+    local prioridad = redis.call('HGET', KEYS[3], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    redis.call('ZADD', KEYS[5], prioridad or 0, ARGV[1])
+    return 0
+end
+local ahora = redis.call('TIME')
+redis.call('ZADD', KEYS[2], tonumber(ahora[1]) + tonumber(ahora[2]) / 1000000 + tonumber(ARGV[2]) * 2 ^ (intentos - 1), ARGV[1])
+return intentos
+"""
+
+script_registrar_usuario = cliente_redis.register_script(REGISTRAR_USUARIO)
+script_iniciar_sesion = cliente_redis.register_script(INICIAR_SESION)
+script_revocar_token = cliente_redis.register_script(REVOCAR_TOKEN)
+
+# Cache local de tokens verificados, desactivada por defecto
+# token -> (instante en que caduca, nombre de usuario, datos de iniciar_sesion)
+cache_tokens: collections.OrderedDict | None = None
+max_tokens_cache = 10000
+ttl_cache_tokens = 5
+cerrojo_cache_tokens = threading.Lock()
+suscripcion_tokens: redis.client.PubSubWorkerThread | None = None
+
 
 # Encriptar un texto con md5
 def encriptar_md5(texto: str) -> str:
@@ -29,12 +196,338 @@ def encriptar_md5(texto: str) -> str:
     return hashlib.md5(texto.encode()).hexdigest()
 
 
+# Función para activar la cache local de tokens verificados
+def activar_cache_tokens(max_tokens: int = 10000, ttl: float = 5) -> None:
+    """
+    Activa la cache local de tokens verificados por iniciar_sesion
+    Los inicios de sesión con un token de la cache no consultan Redis
+    Cada token se guarda como mucho ttl segundos y la cache no supera max_tokens,
+    eliminando los usados hace más tiempo
+    Se suscribe al canal de invalidaciones para eliminar los tokens de los usuarios
+    cuyos privilegios cambian y los tokens revocados
+
+    Parameters
+    ----------
+    max_tokens
+    ttl
+
+    Returns
+    -------
+
+    """
+
+    global cache_tokens, max_tokens_cache, ttl_cache_tokens, suscripcion_tokens
+
+    with cerrojo_cache_tokens:
+        cache_tokens = collections.OrderedDict()
+        max_tokens_cache = max_tokens
+        ttl_cache_tokens = ttl
+
+    if suscripcion_tokens is None:
+        suscripcion = cliente_redis.pubsub(ignore_subscribe_messages=True)
+        suscripcion.subscribe(**{CANAL_TOKENS: invalidar_token_local})
+        suscripcion_tokens = suscripcion.run_in_thread(sleep_time=1, daemon=True)
+
+
+# Función para desactivar la cache local de tokens verificados
+def desactivar_cache_tokens() -> None:
+    """
+    Desactiva la cache local de tokens y cancela la suscripción al canal de invalidaciones
+
+    Returns
+    -------
+
+    """
+
+    global cache_tokens, suscripcion_tokens
+
+    with cerrojo_cache_tokens: cache_tokens = None
+
+    if suscripcion_tokens is not None:
+        suscripcion_tokens.stop()
+        suscripcion_tokens = None
+
+
+# Función para eliminar tokens de la cache local
+def invalidar_token_local(mensaje: dict) -> None:
+    """
+    Elimina de la cache local el token o los tokens del usuario indicados en el mensaje
+    Se llama con los mensajes del canal de invalidaciones
+
+    Parameters
+    ----------
+    mensaje
+
+    Returns
+    -------
+
+    """
+
+    tipo, valor = mensaje['data'].split(':', 1)
+
+    with cerrojo_cache_tokens:
+        if cache_tokens is None: return
+
+        if tipo == 'token': cache_tokens.pop(valor, None)
+        else:
+            for token in [token for token, (_, usuario, _) in cache_tokens.items() if usuario == valor]: del cache_tokens[token]
+
+
+# Función para revocar un token de sesión
+def revocar_token(token: str) -> bool:
+    """
+    Revoca un token de sesión y avisa a las caches locales de tokens
+    Si el token existe, lo elimina y devuelve True
+    Si no existe, devuelve False
+
+    Parameters
+    ----------
+    token
+
+    Returns
+    -------
+
+    """
+
+    invalidar_token_local({'data': f'token:{token}'})
+    if sesiones_compactas is not None: return sesiones_compactas.revocar(token)
+    return script_revocar_token(args=[token, CANAL_TOKENS]) == 1
+
+
+# Inicia sesión con la distribución compacta de SesionesCompactas, con el mismo resultado que INICIAR_SESION
+# KEYS[1] bucket del token recibido, KEYS[2] bucket del usuario, KEYS[3] bucket del token nuevo
+# ARGV[1] token recibido en binario o '', ARGV[2] usuario, ARGV[3] contraseña encriptada,
+# ARGV[4] token nuevo en binario, ARGV[5] tiempo de vida del token, ARGV[6] '1' si hay HEXPIRE
+INICIAR_SESION_COMPACTA = """
+local ahora = tonumber(redis.call('TIME')[1])
+local expiracion_campos = ARGV[6] == '1'
+
+-- Sin HEXPIRE el valor lleva delante el instante en que caduca y los caducados se borran al leerlos
+local function leer(clave, campo)
+    local valor = redis.call('HGET', clave, campo)
+    if not valor or expiracion_campos then return valor end
+    local separador = string.find(valor, ':', 1, true)
+    if tonumber(string.sub(valor, 1, separador - 1)) <= ahora then
+        redis.call('HDEL', clave, campo)
+        return false
+    end
+    return string.sub(valor, separador + 1)
+end
+
+-- El bucket caduca con su sesión más reciente, así volatile-ttl puede desalojarlo
+local function escribir(clave, campo, valor)
+    if expiracion_campos then
+        redis.call('HSET', clave, campo, valor)
+        redis.call('HEXPIRE', clave, ARGV[5], 'FIELDS', 1, campo)
+    else
+        redis.call('HSET', clave, campo, (ahora + tonumber(ARGV[5])) .. ':' .. valor)
+    end
+    if redis.call('TTL', clave) < tonumber(ARGV[5]) then redis.call('EXPIRE', clave, ARGV[5]) end
+end
+
+if ARGV[1] ~= '' then
+    local usuario = leer(KEYS[1], ARGV[1])
+    if usuario then
+        local privilegios = redis.call('HGET', 'usuario:' .. usuario, 'privilegios')
+        if privilegios then return {ARGV[1], privilegios, usuario} end
+    end
+end
+
+local datos = redis.call('HMGET', 'usuario:' .. ARGV[2], 'contrasenia', 'privilegios')
+if not datos[1] or datos[1] ~= ARGV[3] then return -1 end
+
+local token = leer(KEYS[2], ARGV[2])
+if not token then
+    token = ARGV[4]
+    escribir(KEYS[3], token, ARGV[2])
+    escribir(KEYS[2], ARGV[2], token)
+end
+
+return {token, datos[2], ARGV[2]}
+"""
+
+# Revoca un token con la distribución compacta y avisa a las caches locales
+# KEYS[1] bucket del token, KEYS[2] bucket del usuario
+# ARGV[1] token en binario, ARGV[2] usuario, ARGV[3] canal de invalidaciones, ARGV[4] token en texto
+REVOCAR_TOKEN_COMPACTO = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then return 0 end
+local valor = redis.call('HGET', KEYS[2], ARGV[2])
+if valor and string.sub(valor, -#ARGV[1]) == ARGV[1] then redis.call('HDEL', KEYS[2], ARGV[2]) end
+redis.call('PUBLISH', ARGV[3], 'token:' .. ARGV[4])
+return 1
+"""
+
+
+# Clase para guardar las sesiones con menos memoria
+class SesionesCompactas:
+    """
+    Guarda las sesiones en hashes pequeños (buckets) en lugar de dos claves por sesión
+    Cada bucket tiene pocas entradas para que Redis lo guarde con la codificación listpack,
+    y el coste fijo de cada clave se reparte entre todas las sesiones del bucket
+    Los tokens se guardan como los 16 bytes del uuid en lugar de sus 36 caracteres, a los
+    clientes se les sigue devolviendo el uuid en texto
+    Si el servidor tiene HEXPIRE (Redis 7.4 o posterior), cada sesión caduca por separado
+    Si no, cada valor lleva el instante en que caduca y se borra al leerlo caducado
+
+    Parameters
+    ----------
+    buckets
+        número de hashes por tipo, conviene que haya menos de 128 sesiones por bucket
+        (hash-max-listpack-entries)
+    prefijo
+        prefijo de las claves de los buckets
+    expiracion_campos
+        usa HEXPIRE, si es None se comprueba si el servidor lo admite
+    cliente
+        conexión sin decode_responses, por defecto una al mismo servidor que cliente_redis
+
+    """
+
+    def __init__(self, buckets: int = 1024, prefijo: str = 'sesiones', expiracion_campos: bool | None = None, cliente: redis.Redis | None = None):
+        self.buckets = buckets
+        self.prefijo = prefijo
+
+        # Los tokens y las respuestas son binarios, esta conexión no decodifica las respuestas
+        self.cliente = cliente or redis.Redis(**{**cliente_redis.connection_pool.connection_kwargs, 'decode_responses': False})
+        self.script_iniciar_sesion = self.cliente.register_script(INICIAR_SESION_COMPACTA)
+        self.script_revocar_token = self.cliente.register_script(REVOCAR_TOKEN_COMPACTO)
+
+        if expiracion_campos is None:
+            try:
+                # Sobre una clave que no existe no tiene efecto
+                self.cliente.execute_command('HEXPIRE', f'{prefijo}:deteccion', 1, 'FIELDS', 1, 'deteccion')
+                expiracion_campos = True
+            except redis.ResponseError:
+                expiracion_campos = False
+
+        self.expiracion_campos = expiracion_campos
+
+    def _bucket(self, tipo: str, valor: bytes) -> str:
+        return f'{self.prefijo}:{tipo}:{int.from_bytes(hashlib.sha1(valor).digest()[:4], "big") % self.buckets}'
+
+    # Token en binario o None si no es un uuid
+    @staticmethod
+    def _binario(token: str | None) -> bytes | None:
+        try: return uuid.UUID(token).bytes if token else None
+        except ValueError: return None
+
+    def iniciar_sesion(self, nombre_usuario: str | None, contrasenia: str | None, token: str | None) -> list | int:
+        """
+        Inicia sesión con el token o con el usuario y la contraseña encriptada
+
+        Returns
+        -------
+        -1 o el token, los privilegios y el nombre de usuario, como INICIAR_SESION
+
+        """
+
+        binario = self._binario(token)
+        nombre = (nombre_usuario or '').encode()
+        nuevo = uuid.uuid4().bytes
+
+        respuesta = self.script_iniciar_sesion(keys=[
+            self._bucket('tokens', binario) if binario else self._bucket('usuarios', nombre),
+            self._bucket('usuarios', nombre),
+            self._bucket('tokens', nuevo)
+        ], args=[binario or b'', nombre, contrasenia or '', nuevo, TTL_TOKEN, int(self.expiracion_campos)])
+
+        if respuesta == -1: return -1
+        return [str(uuid.UUID(bytes=respuesta[0])), respuesta[1].decode(), respuesta[2].decode()]
+
+    def usuario(self, token: str) -> str | None:
+        """
+        Devuelve el nombre de usuario de un token o None si no existe o ha caducado
+
+        Parameters
+        ----------
+        token
+
+        Returns
+        -------
+
+        """
+
+        if (binario := self._binario(token)) is None: return None
+        if (valor := self.cliente.hget(self._bucket('tokens', binario), binario)) is None: return None
+
+        if not self.expiracion_campos:
+            expira, valor = valor.split(b':', 1)
+            if int(expira) <= time.time(): return None
+
+        return valor.decode()
+
+    def revocar(self, token: str) -> bool:
+        """
+        Revoca un token y avisa a las caches locales de tokens
+
+        Parameters
+        ----------
+        token
+
+        Returns
+        -------
+
+        """
+
+        if (usuario := self.usuario(token)) is None: return False
+
+        binario = self._binario(token)
+        return self.script_revocar_token(keys=[self._bucket('tokens', binario), self._bucket('usuarios', usuario.encode())],
+                                         args=[binario, usuario, CANAL_TOKENS, token]) == 1
+
+
+# Distribución compacta de las sesiones, desactivada por defecto
+sesiones_compactas: SesionesCompactas | None = None
+
+
+# Función para activar la distribución compacta de las sesiones
+def activar_sesiones_compactas(buckets: int = 1024, expiracion_campos: bool | None = None, cliente: redis.Redis | None = None) -> SesionesCompactas:
+    """
+    Guarda las sesiones nuevas con la distribución compacta de SesionesCompactas
+    Las sesiones guardadas con la distribución anterior dejan de ser válidas
+
+    Parameters
+    ----------
+    buckets
+    expiracion_campos
+    cliente
+
+    Returns
+    -------
+
+    """
+
+    global sesiones_compactas
+
+    sesiones_compactas = SesionesCompactas(buckets, expiracion_campos=expiracion_campos, cliente=cliente)
+    return sesiones_compactas
+
+
+# Función para obtener el usuario de un token de sesión
+def usuario_token(token: str) -> str | None:
+    """
+    Devuelve el nombre de usuario de un token de sesión o None si no es válido
+
+    Parameters
+    ----------
+    token
+
+    Returns
+    -------
+
+    """
+
+    if sesiones_compactas is not None: return sesiones_compactas.usuario(token)
+    return cliente_redis.get(token)
+
+
 # Función para registrar un nuevo usuario
 def registrar_usuario(nombre_completo, nombre_usuario, contrasenia, privilegios) -> bool:
     """
     Registra un nuevo usuario en la base de datos
     Si el usuario no existe, lo crea y devuelve True
     Si el usuario existe, devuelve False
+    La comprobación y la creación se hacen en una sola operación atómica
 
     Parameters
     ----------
@@ -48,16 +541,13 @@ def registrar_usuario(nombre_completo, nombre_usuario, contrasenia, privilegios)
 
     """
 
-    if cliente_redis.exists(f'usuario:{nombre_usuario}'): return False  # Usuario ya existe
-
-    cliente_redis.hset(f'usuario:{nombre_usuario}', mapping={
-        'nombre_completo': nombre_completo,
-        'nombre_usuario': nombre_usuario,
-        'contrasenia': encriptar_md5(contrasenia),
-        'privilegios': privilegios
-    })
-
-    return True  # Usuario registrado correctamente
+    # Devuelve 0 si el usuario ya existe y 1 si lo ha registrado
+    return script_registrar_usuario(keys=[f'usuario:{nombre_usuario}'], args=[
+        'nombre_completo', nombre_completo,
+        'nombre_usuario', nombre_usuario,
+        'contrasenia', encriptar_md5(contrasenia),
+        'privilegios', privilegios
+    ]) == 1
 
 
 # Función para realizar el inicio de sesión
@@ -67,6 +557,7 @@ def iniciar_sesion(nombre_usuario: str = None, contrasenia: str = None, token: s
     Si no lo es, intenta iniciar sesión con el nombre de usuario y la contraseña
     Cuando verifica si la contraseña es correcta, verifica que no exista un token de sesión, si existe lo devuelve
     si no existe, genera un token de sesión y lo devuelve junto con los privilegios
+    Todo se hace en una sola operación atómica en Redis
 
     Parameters
     ----------
@@ -79,40 +570,52 @@ def iniciar_sesion(nombre_usuario: str = None, contrasenia: str = None, token: s
 
     """
 
-    if token is not None and cliente_redis.exists(token):
-        # Comprueba si el token de sesión es válido
-        datos = cliente_redis.hgetall(f'usuario:{cliente_redis.get(token)}')
-
-    else:
-        # Comprueba si existe el usuario
-        # Si no existe, devuelve -1
-        if not cliente_redis.exists(f'usuario:{nombre_usuario}'): return -1  # Usuario no existe
-        datos = cliente_redis.hgetall(f'usuario:{nombre_usuario}')
+    # Si la cache local está activada, el token se comprueba primero en ella
+    if token is not None and cache_tokens is not None:
+        with cerrojo_cache_tokens:
+            if cache_tokens is not None and (entrada := cache_tokens.get(token)) is not None and entrada[0] > time.monotonic():
+                cache_tokens.move_to_end(token)
+                return dict(entrada[2])
 
-        # Comprueba si la contraseña es correcta
-        # Si no lo es, devuelve -1
-        if datos['contrasenia'] != encriptar_md5(contrasenia): return -1  # Contraseña incorrecta
+    # Comprueba el token de sesión y, si no es válido, el usuario y la contraseña
+    # Si el usuario no existe o la contraseña es incorrecta, devuelve -1
+    # Si el usuario no tiene token de sesión, se guarda el nuevo, que caduca en 30 días
+    if sesiones_compactas is not None:
+        respuesta = sesiones_compactas.iniciar_sesion(nombre_usuario, encriptar_md5(contrasenia) if contrasenia is not None else None, token)
 
-        # Genera un token de sesión y lo almacena en Redis
-        # El token caduca en 30 días
-        if not cliente_redis.exists(f'token:{nombre_usuario}'):
-            token = str(uuid.uuid4())
-            cliente_redis.setex(token, 2592000, nombre_usuario)
-            cliente_redis.setex(f'token:{nombre_usuario}', 2592000, token)
+    else:
+        respuesta = script_iniciar_sesion(args=[
+            token or '',
+            nombre_usuario or '',
+            encriptar_md5(contrasenia) if contrasenia is not None else '',
+            str(uuid.uuid4()),
+            TTL_TOKEN
+        ])
 
-        else: token = cliente_redis.get(f'token:{nombre_usuario}')  # Devuelve el token de sesión
+    if respuesta == -1: return -1
 
     # Devuelve los privilegios y el token de sesión
-    return {
-        'token': token,
-        'privilegios': int(datos['privilegios'])
+    datos = {
+        'token': respuesta[0],
+        'privilegios': int(respuesta[1])
     }
 
+    # Guarda el token verificado en la cache local, eliminando el más antiguo si está llena
+    if cache_tokens is not None:
+        with cerrojo_cache_tokens:
+            if cache_tokens is not None:
+                cache_tokens[datos['token']] = (time.monotonic() + ttl_cache_tokens, respuesta[2], dict(datos))
+                cache_tokens.move_to_end(datos['token'])
+                while len(cache_tokens) > max_tokens_cache: cache_tokens.popitem(last=False)
+
+    return datos
+
 
 # Función para actualizar los datos de un usuario
 def actualizar_usuario(nombre_usuario: str = None, contrasenia: str = None, token: str = None, nuevos_datos: {str: str | int} = None) -> None:
     """
     Actualiza los datos de un usuario
+    Si cambian los privilegios, avisa a las caches locales de tokens
 
     Parameters
     ----------
@@ -131,13 +634,22 @@ def actualizar_usuario(nombre_usuario: str = None, contrasenia: str = None, toke
     if 'contrasenia' in nuevos_datos.keys(): nuevos_datos['contrasenia'] = encriptar_md5(nuevos_datos['contrasenia'])
 
     if (datos := iniciar_sesion(nombre_usuario, contrasenia, token)) != -1:
-        cliente_redis.hset(f'usuario:{cliente_redis.get(datos["token"])}', mapping=nuevos_datos)
+        usuario = usuario_token(datos['token'])
+
+        # Actualiza el usuario y avisa a las caches locales en una sola petición
+        pipeline = cliente_redis.pipeline()
+        pipeline.hset(f'usuario:{usuario}', mapping=nuevos_datos)
+        if 'privilegios' in nuevos_datos: pipeline.publish(CANAL_TOKENS, f'usuario:{usuario}')
+        pipeline.execute()
+
+        if 'privilegios' in nuevos_datos: invalidar_token_local({'data': f'usuario:{usuario}'})
 
 
 # Función para registrar una petición de ayuda con prioridad
 def registrar_peticion(nombre_usuario, prioridad):
     """
     Guarda una petición de ayuda en la cola de peticiones de ayuda
+    Si la cola está repartida en shards, se guarda en el shard del usuario
 
     Parameters
     ----------
@@ -149,20 +661,483 @@ def registrar_peticion(nombre_usuario, prioridad):
 
     """
 
-    cliente_redis.zadd('peticiones', {nombre_usuario: prioridad})
+    if cola_peticiones is None: cliente_redis.zadd('peticiones', {nombre_usuario: prioridad})
+    else: cola_peticiones.registrar(nombre_usuario, prioridad)
 
 
 # Función para atender a usuarios
 def atender_usuarios():
     """
     Itera sobre la cola de peticiones de ayuda y atiende a los usuarios según su prioridad (mayor a menor)
+    Si la cola está repartida en shards, reclama la petición con mayor prioridad de todos ellos
 
     Returns
     -------
 
     """
 
-    return cliente_redis.bzpopmax('peticiones', 0)[1]
+    if cola_peticiones is None or cola_peticiones.shards == 1:
+        return cliente_redis.bzpopmax('peticiones', 0)[1]
+
+    # BZPOPMAX con varias claves no elige la mayor prioridad entre ellas
+    while not (reclamadas := cola_peticiones.reclamar(1, 30)): time.sleep(0.1)
+    cola_peticiones.confirmar(reclamadas[0][0])
+    return reclamadas[0][0]
+
+
+# Posición de un texto en el anillo de hashing consistente
+def hash_consistente(texto: str) -> int:
+    return int.from_bytes(hashlib.md5(texto.encode()).digest()[:8], 'big')
+
+
+# Clase para repartir la cola de peticiones de ayuda entre varias claves
+class ColaPeticiones:
+    """
+    Cola de peticiones de ayuda repartida entre varias claves (shards), opcionalmente en
+    varias instancias de Redis
+    Cada usuario se asigna a un shard con hashing consistente, así sus peticiones siempre van
+    al mismo shard y al añadir shards solo cambia de shard una parte de los usuarios
+    Con un solo shard se usa la clave original, compatible con atender_usuarios
+    Las peticiones se reclaman por orden de prioridad entre todos los shards
+    Si se indica un envejecimiento, la prioridad efectiva de una petición sube esa cantidad por
+    cada segundo que espera. Redis guarda la prioridad menos el envejecimiento por el instante de
+    llegada, calculado en el servidor, de modo que el orden de la cola ya tiene en cuenta la
+    espera sin tener que recalcular la puntuación de cada petición
+
+    Parameters
+    ----------
+    shards
+        número de claves en las que se reparte la cola
+    clientes
+        instancias de Redis, el shard i va a la instancia i % len(clientes)
+    envejecimiento
+        prioridad que gana una petición por cada segundo de espera
+    clave
+        prefijo de las claves de la cola
+    nodos_virtuales
+        puntos de cada shard en el anillo de hashing consistente
+
+    """
+
+    def __init__(self, shards: int = 1, clientes: list[redis.Redis] | None = None, envejecimiento: float = 0.0,
+                 clave: str = 'peticiones', nodos_virtuales: int = 64):
+        if shards < 1: raise ValueError(f'Número de shards "{shards}" no válido')
+
+        self.shards = shards
+        self.clientes = clientes or [cliente_redis]
+        self.envejecimiento = envejecimiento
+        self.clave = clave
+
+        # Anillo de hashing consistente con varios puntos por shard
+        self.anillo = sorted((hash_consistente(f'{clave}:{shard}:{nodo}'), shard) for shard in range(shards) for nodo in range(nodos_virtuales))
+        self.posiciones = [posicion for posicion, _ in self.anillo]
+
+        # Los scripts se registran en cada instancia
+        self.scripts = [{
+            'registrar': cliente.register_script(REGISTRAR_PETICION),
+            'reclamar': cliente.register_script(RECLAMAR_PETICIONES),
+            'reclamar_usuarios': cliente.register_script(RECLAMAR_USUARIOS),
+            'reentregar': cliente.register_script(REENTREGAR_PETICIONES),
+            'fallar': cliente.register_script(FALLAR_PETICION)
+        } for cliente in self.clientes]
+
+    # Claves de la cola, la lista de procesamiento, las prioridades, los intentos y las fallidas de un shard
+    # Las llaves del hash tag mantienen todas las claves en el mismo nodo de un Redis Cluster
+    def claves(self, shard: int) -> list[str]:
+        cola = self.clave if self.shards == 1 else f'{self.clave}:{{{shard}}}'
+        return [cola, f'{cola}:procesando', f'{cola}:prioridades', f'{cola}:intentos', f'{cola}:fallidas']
+
+    # Shard que corresponde a un usuario
+    def shard(self, nombre_usuario: str) -> int:
+        indice = bisect.bisect(self.posiciones, hash_consistente(nombre_usuario)) % len(self.anillo)
+        return self.anillo[indice][1]
+
+    def cliente(self, shard: int) -> redis.Redis:
+        return self.clientes[shard % len(self.clientes)]
+
+    def script(self, shard: int, nombre: str):
+        return self.scripts[shard % len(self.clientes)][nombre]
+
+    # Prioridades efectivas de las peticiones reclamadas por un script
+    # Los scripts devuelven primero el instante del servidor
+    def _reclamadas(self, respuesta: list) -> list[tuple[str, float]]:
+        ahora = int(respuesta[0]) + int(respuesta[1]) / 1000000
+        return [(respuesta[i], float(respuesta[i + 1]) + self.envejecimiento * ahora) for i in range(2, len(respuesta), 2)]
+
+    def registrar(self, nombre_usuario: str, prioridad: float) -> None:
+        """
+        Guarda una petición de ayuda en el shard del usuario
+
+        Parameters
+        ----------
+        nombre_usuario
+        prioridad
+
+        Returns
+        -------
+
+        """
+
+        shard = self.shard(nombre_usuario)
+        if self.envejecimiento == 0: self.cliente(shard).zadd(self.claves(shard)[0], {nombre_usuario: prioridad})
+        else: self.script(shard, 'registrar')(keys=self.claves(shard)[:1], args=[nombre_usuario, prioridad, self.envejecimiento])
+
+    def reclamar(self, n: int, tiempo_reclamacion: float) -> list[tuple[str, float]]:
+        """
+        Reclama las n peticiones con mayor prioridad efectiva de entre todos los shards y las
+        mueve a la lista de procesamiento de su shard
+
+        Parameters
+        ----------
+        n
+        tiempo_reclamacion
+            segundos hasta que la reclamación caduca y la petición vuelve a la cola
+
+        Returns
+        -------
+        pares de nombre de usuario y prioridad efectiva, de mayor a menor prioridad
+
+        """
+
+        if self.shards == 1: return self._reclamadas(self.script(0, 'reclamar')(keys=self.claves(0), args=[n, tiempo_reclamacion]))
+
+        # Lee las n primeras de cada shard con un pipeline por instancia
+        candidatas = []
+        for indice, cliente in enumerate(self.clientes):
+            shards = range(indice, self.shards, len(self.clientes))
+            pipeline = cliente.pipeline(transaction=False)
+            for shard in shards: pipeline.zrevrange(self.claves(shard)[0], 0, n - 1, withscores=True)
+            for shard, primeras in zip(shards, pipeline.execute()):
+                candidatas += [(puntuacion, nombre_usuario, shard) for nombre_usuario, puntuacion in primeras]
+
+        # Reclama las n mejores, las que ya haya reclamado otro consumidor se ignoran
+        elegidas: dict[int, list[str]] = collections.defaultdict(list)
+        for _, nombre_usuario, shard in sorted(candidatas, reverse=True)[:n]: elegidas[shard].append(nombre_usuario)
+
+        reclamadas = []
+        for shard, usuarios in elegidas.items():
+            reclamadas += self._reclamadas(self.script(shard, 'reclamar_usuarios')(keys=self.claves(shard), args=[tiempo_reclamacion, *usuarios]))
+
+        return sorted(reclamadas, key=lambda reclamada: reclamada[1], reverse=True)
+
+    def confirmar(self, nombre_usuario: str) -> None:
+        """
+        Confirma que una petición se ha atendido y la elimina de la lista de procesamiento
+
+        Parameters
+        ----------
+        nombre_usuario
+
+        Returns
+        -------
+
+        """
+
+        shard = self.shard(nombre_usuario)
+        _, procesando, prioridades, intentos, _ = self.claves(shard)
+
+        pipeline = self.cliente(shard).pipeline()
+        pipeline.zrem(procesando, nombre_usuario)
+        pipeline.hdel(prioridades, nombre_usuario)
+        pipeline.hdel(intentos, nombre_usuario)
+        pipeline.execute()
+
+    def fallar(self, nombre_usuario: str, espera: float, max_intentos: int) -> int:
+        """
+        Anota que no se ha podido atender una petición reclamada
+        La petición sigue en la lista de procesamiento hasta que pasa la espera, que se duplica en
+        cada intento, y después reentregar la devuelve a la cola
+        Tras max_intentos fallos pasa a la cola de fallidas y no se vuelve a entregar
+
+        Parameters
+        ----------
+        nombre_usuario
+        espera
+            segundos de espera del primer reintento
+        max_intentos
+
+        Returns
+        -------
+        número de intentos, 0 si ha pasado a fallidas o -1 si ya no estaba reclamada
+
+        """
+
+        shard = self.shard(nombre_usuario)
+        return self.script(shard, 'fallar')(keys=self.claves(shard), args=[nombre_usuario, espera, max_intentos])
+
+    def reentregar(self, *nombres_usuario: str) -> int:
+        """
+        Devuelve a la cola las peticiones indicadas o, si no se indica ninguna, las de todos los
+        shards cuya reclamación ha caducado
+
+        Parameters
+        ----------
+        nombres_usuario
+
+        Returns
+        -------
+        número de peticiones devueltas a la cola
+
+        """
+
+        usuarios: dict[int, list[str]] = collections.defaultdict(list)
+        if nombres_usuario:
+            for nombre_usuario in nombres_usuario: usuarios[self.shard(nombre_usuario)].append(nombre_usuario)
+        else: usuarios = {shard: [] for shard in range(self.shards)}
+
+        return sum(self.script(shard, 'reentregar')(keys=self.claves(shard), args=lista) for shard, lista in usuarios.items())
+
+    def profundidad(self) -> (int, int, int):
+        """
+        Devuelve el número de peticiones en la cola, en la lista de procesamiento y en la cola de
+        fallidas de todos los shards
+
+        Returns
+        -------
+
+        """
+
+        en_cola = procesando = fallidas = 0
+        for indice, cliente in enumerate(self.clientes):
+            pipeline = cliente.pipeline(transaction=False)
+            for shard in range(indice, self.shards, len(self.clientes)):
+                pipeline.zcard(self.claves(shard)[0])
+                pipeline.zcard(self.claves(shard)[1])
+                pipeline.zcard(self.claves(shard)[4])
+            respuestas = pipeline.execute()
+            en_cola += sum(respuestas[::3])
+            procesando += sum(respuestas[1::3])
+            fallidas += sum(respuestas[2::3])
+
+        return en_cola, procesando, fallidas
+
+
+# Cola de peticiones que usan registrar_peticion y atender_usuarios
+cola_peticiones: ColaPeticiones | None = None
+
+
+# Función para configurar la cola de peticiones
+def configurar_cola(shards: int = 1, clientes: list[redis.Redis] | None = None, envejecimiento: float = 0.0) -> ColaPeticiones:
+    """
+    Reparte la cola de peticiones entre varios shards y activa el envejecimiento de las peticiones
+    Por defecto se usa una sola clave sin envejecimiento
+
+    Parameters
+    ----------
+    shards
+    clientes
+    envejecimiento
+
+    Returns
+    -------
+
+    """
+
+    global cola_peticiones
+
+    cola_peticiones = ColaPeticiones(shards, clientes, envejecimiento)
+    return cola_peticiones
+
+
+# Clase para atender las peticiones de ayuda por lotes con un conjunto de trabajadores
+class ConsumidorPeticiones:
+    """
+    Atiende las peticiones de ayuda de la cola por lotes con un conjunto de trabajadores
+    Reclama las peticiones con ZPOPMAX count y las mueve en la misma operación a la lista de
+    procesamiento, un sorted set con el instante en que caduca cada reclamación
+    Cuando un trabajador atiende una petición, se confirma y sale de la lista de procesamiento
+    Si el trabajador falla, la petición vuelve a la cola tras una espera que se duplica en cada
+    intento, y tras max_intentos fallos pasa a la cola de fallidas, así una petición que siempre
+    falla no vuelve una y otra vez a la cabeza de la cola
+    Si el proceso termina sin confirmarla, vuelve a la cola cuando caduca su reclamación
+    Los trabajadores pueden ser hilos o tareas de asyncio
+
+    Parameters
+    ----------
+    atender
+        función que atiende una petición, recibe el nombre de usuario y la prioridad
+        en modo asyncio debe ser una corrutina
+    trabajadores
+        número de peticiones que se atienden a la vez
+    tamanio_lote
+        número máximo de peticiones que se reclaman en cada petición a Redis
+    modo
+        'hilos' o 'asyncio'
+    tiempo_reclamacion
+        segundos que tiene un trabajador para atender una petición antes de que se vuelva a entregar
+    espera
+        segundos que se espera cuando la cola está vacía
+    cola
+        cola de peticiones, por defecto la de registrar_peticion
+    max_intentos
+        fallos tras los que una petición pasa a la cola de fallidas
+    espera_reintento
+        segundos que espera una petición fallida antes de su primer reintento
+
+    """
+
+    def __init__(self, atender, trabajadores: int = 8, tamanio_lote: int = 32, modo: str = 'hilos',
+                 tiempo_reclamacion: float = 30, espera: float = 0.1, cola: ColaPeticiones | None = None,
+                 max_intentos: int = 5, espera_reintento: float = 1):
+        if modo not in ('hilos', 'asyncio'): raise ValueError(f'Modo "{modo}" no válido')
+
+        self.atender = atender
+        self.trabajadores = trabajadores
+        self.tamanio_lote = tamanio_lote
+        self.modo = modo
+        self.tiempo_reclamacion = tiempo_reclamacion
+        self.espera = espera
+        self.cola = cola or cola_peticiones or ColaPeticiones()
+        self.max_intentos = max_intentos
+        self.espera_reintento = espera_reintento
+
+        self.parar = threading.Event()
+        self.hilo: threading.Thread | None = None
+        self.cerrojo = threading.Lock()
+        self.en_curso = 0
+        self.atendidas = 0
+        self.fallidas = 0
+        self.reentregadas = 0
+        self.descartadas = 0
+        self.inicio = time.monotonic()
+
+    # Reclama hasta n peticiones de la cola
+    def reclamar(self, n: int) -> list[tuple[str, float]]:
+        return self.cola.reclamar(n, self.tiempo_reclamacion)
+
+    # Confirma que una petición se ha atendido
+    def confirmar(self, nombre_usuario: str) -> None:
+        self.cola.confirmar(nombre_usuario)
+
+    # Devuelve a la cola las peticiones indicadas o, si no se indica ninguna, las que han caducado
+    def reentregar(self, *nombres_usuario: str) -> int:
+        reentregadas = self.cola.reentregar(*nombres_usuario)
+        with self.cerrojo: self.reentregadas += reentregadas
+        return reentregadas
+
+    # Anota el resultado de una petición atendida
+    # Las fallidas esperan en la lista de procesamiento hasta que las devuelve la revisión de caducadas
+    def _terminada(self, nombre_usuario: str, error: BaseException | None) -> None:
+        intentos = None
+        try:
+            if error is None: self.confirmar(nombre_usuario)
+            else: intentos = self.cola.fallar(nombre_usuario, self.espera_reintento, self.max_intentos)
+        except Exception:
+            # Si no se puede anotar, la reclamación caduca y la revisión de caducadas la vuelve a entregar
+            logger.exception('Error al anotar la petición de %s', nombre_usuario)
+        finally:
+            # El trabajador queda libre aunque falle redis
+            with self.cerrojo:
+                self.en_curso -= 1
+                if error is None: self.atendidas += 1
+                else:
+                    self.fallidas += 1
+                    if intentos == 0: self.descartadas += 1
+
+    def metricas(self) -> {str: int | float}:
+        """
+        Devuelve las métricas del consumidor y la profundidad de la cola
+
+        Returns
+        -------
+        peticiones atendidas, fallidas, reentregadas y descartadas tras max_intentos, atendidas por
+        segundo desde el inicio, peticiones en curso en este consumidor, en la cola, en la lista de
+        procesamiento y en la cola de fallidas
+
+        """
+
+        en_cola, procesando, en_fallidas = self.cola.profundidad()
+
+        with self.cerrojo:
+            return {
+                'atendidas': self.atendidas,
+                'fallidas': self.fallidas,
+                'reentregadas': self.reentregadas,
+                'descartadas': self.descartadas,
+                'por_segundo': self.atendidas / (time.monotonic() - self.inicio),
+                'en_curso': self.en_curso,
+                'en_cola': en_cola,
+                'procesando': procesando,
+                'en_fallidas': en_fallidas
+            }
+
+    def start(self) -> None:
+        """
+        Arranca el hilo que reclama y reparte las peticiones
+        """
+
+        if self.hilo is not None and self.hilo.is_alive(): return
+
+        self.parar.clear()
+        self.inicio = time.monotonic()
+        objetivo = self._bucle_hilos if self.modo == 'hilos' else lambda: asyncio.run(self._bucle_asyncio())
+        self.hilo = threading.Thread(target=objetivo, name='consumidor-peticiones', daemon=True)
+        self.hilo.start()
+
+    def stop(self) -> None:
+        """
+        Deja de reclamar peticiones y espera a que terminen las que están en curso
+        """
+
+        self.parar.set()
+        if self.hilo is not None: self.hilo.join()
+        self.hilo = None
+
+    # Segundos entre cada revisión de las reclamaciones caducadas
+    def _intervalo_revision(self) -> float:
+        return min(self.tiempo_reclamacion, self.espera_reintento) / 2
+
+    # Número de peticiones que se pueden reclamar sin superar el número de trabajadores
+    def _libres(self) -> int:
+        with self.cerrojo: return min(self.tamanio_lote, self.trabajadores - self.en_curso)
+
+    def _bucle_hilos(self) -> None:
+        with concurrent.futures.ThreadPoolExecutor(self.trabajadores, thread_name_prefix='trabajador-peticiones') as ejecutor:
+            ultima_revision = 0.0
+            while not self.parar.is_set():
+                # Devuelve a la cola las reclamaciones caducadas de consumidores que han terminado
+                # y las peticiones fallidas cuya espera ha terminado
+                if time.monotonic() - ultima_revision > self._intervalo_revision():
+                    self.reentregar()
+                    ultima_revision = time.monotonic()
+
+                if (libres := self._libres()) <= 0 or not (reclamadas := self.reclamar(libres)):
+                    self.parar.wait(self.espera)
+                    continue
+
+                with self.cerrojo: self.en_curso += len(reclamadas)
+                for nombre_usuario, prioridad in reclamadas:
+                    futuro = ejecutor.submit(self.atender, nombre_usuario, prioridad)
+                    futuro.add_done_callback(lambda futuro, nombre_usuario=nombre_usuario: self._terminada(nombre_usuario, futuro.exception()))
+
+    async def _bucle_asyncio(self) -> None:
+        tareas = set()
+
+        async def atender(nombre_usuario: str, prioridad: float) -> None:
+            try:
+                await self.atender(nombre_usuario, prioridad)
+                error = None
+            except Exception as excepcion:
+                error = excepcion
+            await asyncio.to_thread(self._terminada, nombre_usuario, error)
+
+        ultima_revision = 0.0
+        while not self.parar.is_set():
+            if time.monotonic() - ultima_revision > self._intervalo_revision():
+                await asyncio.to_thread(self.reentregar)
+                ultima_revision = time.monotonic()
+
+            if (libres := self._libres()) <= 0 or not (reclamadas := await asyncio.to_thread(self.reclamar, libres)):
+                await asyncio.sleep(self.espera)
+                continue
+
+            with self.cerrojo: self.en_curso += len(reclamadas)
+            for nombre_usuario, prioridad in reclamadas:
+                tarea = asyncio.create_task(atender(nombre_usuario, prioridad))
+                tareas.add(tarea)
+                tarea.add_done_callback(tareas.discard)
+
+        if tareas: await asyncio.gather(*tareas)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import fakeredis
+import mongomock
+import pytest
+
+# Las pruebas no necesitan servidores, redis y mongo se sustituyen por fakeredis y mongomock
+# Los scripts de lua necesitan fakeredis[lua]: pip install "fakeredis[lua]" mongomock pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'odm'))
+
+import practica1
+
+
+@pytest.fixture
+def redis_cliente():
+    cliente = fakeredis.FakeRedis()
+    yield cliente
+    cliente.flushall()
+
+
+@pytest.fixture
+def Persona(redis_cliente):
+    """
+    Modelo de pruebas con una cache vacia y una coleccion nueva
+    """
+
+    modelo = type('Persona', (practica1.Model,), {'__slots__': ('nombre', 'apellido', 'dni', '_id', 'edad')})
+    modelo.init_class(mongomock.MongoClient().pruebas.Persona, redis_cliente, {'nombre', 'apellido', 'dni'}, {'_id', 'edad'})
+    yield modelo
+
+    for hilo in (modelo.write_behind, modelo.change_stream):
+        if hilo is not None: hilo.stop()
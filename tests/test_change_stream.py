@@ -0,0 +1,63 @@
+import pytest
+
+import practica1
+
+
+@pytest.fixture
+def vigilante(Persona):
+    # Sin arrancar el hilo, las pruebas aplican los cambios con apply
+    return practica1.ChangeStreamWatcher(Persona, 'evict')
+
+
+@pytest.fixture
+def persona(Persona):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+    Persona.find_by_id(str(persona._id))
+    return persona
+
+
+def cambio(token, operacion, identificador, **datos):
+    return {'_id': {'_data': token}, 'operationType': operacion, 'documentKey': {'_id': identificador}, **datos}
+
+
+def test_cambio_propio_no_expulsa(Persona, vigilante, persona):
+    persona.edad = 2
+    persona.save()
+
+    vigilante.apply([cambio('1', 'update', persona._id, updateDescription={'updatedFields': {'edad': 2}, 'removedFields': []})])
+
+    assert Persona.redis.exists(Persona._clave(persona._id))
+    assert vigilante._token() == {'_data': '1'}
+
+
+def test_cambio_ajeno_expulsa(Persona, vigilante, persona):
+    Persona.db.update_one({'_id': persona._id}, {'$set': {'edad': 3}})
+
+    vigilante.apply([cambio('1', 'update', persona._id, updateDescription={'updatedFields': {'edad': 3}, 'removedFields': []})])
+
+    assert not Persona.redis.exists(Persona._clave(persona._id))
+    assert Persona.find_by_id(str(persona._id)).edad == 3
+
+
+def test_replace_compara_el_documento_completo(Persona, vigilante, persona):
+    documento = Persona.db.find_one({'_id': persona._id})
+    vigilante.apply([cambio('1', 'replace', persona._id, fullDocument=documento)])
+    assert Persona.redis.exists(Persona._clave(persona._id))
+
+    # Una variable de menos tambien es un cambio
+    del documento['edad']
+    vigilante.apply([cambio('2', 'replace', persona._id, fullDocument=documento)])
+    assert not Persona.redis.exists(Persona._clave(persona._id))
+
+
+def test_variables_eliminadas_expulsan(Persona, vigilante, persona):
+    vigilante.apply([cambio('1', 'update', persona._id, updateDescription={'updatedFields': {}, 'removedFields': ['edad']})])
+
+    assert not Persona.redis.exists(Persona._clave(persona._id))
+
+
+def test_delete_expulsa(Persona, vigilante, persona):
+    vigilante.apply([cambio('1', 'delete', persona._id)])
+
+    assert not Persona.redis.exists(Persona._clave(persona._id))
@@ -0,0 +1,84 @@
+import importlib
+import sys
+import time
+
+import fakeredis
+import pytest
+import redis
+
+servidor = fakeredis.FakeServer()
+
+
+@pytest.fixture(scope='module')
+def practica2():
+    # practica2 se conecta a redis al importarse
+    class Redis(fakeredis.FakeRedis):
+        def __init__(self, **kwargs):
+            super().__init__(server=servidor, decode_responses=kwargs.get('decode_responses', False))
+
+    original = redis.Redis
+    redis.Redis = Redis
+    try:
+        sys.modules.pop('practica2', None)
+        yield importlib.import_module('practica2')
+    finally:
+        redis.Redis = original
+
+
+@pytest.fixture(params=[False, True], ids=['sin-hexpire', 'hexpire'])
+def sesiones(request, practica2):
+    sesiones = practica2.activar_sesiones_compactas(buckets=4, expiracion_campos=request.param, cliente=fakeredis.FakeRedis(server=servidor))
+    practica2.registrar_usuario('Ana Ruiz', 'ana', 'secreta', 1)
+    yield sesiones
+
+    practica2.sesiones_compactas = None
+    practica2.cliente_redis.flushall()
+
+
+def test_inicio_con_credenciales_reutiliza_el_token(practica2, sesiones):
+    primera = practica2.iniciar_sesion('ana', 'secreta')
+    segunda = practica2.iniciar_sesion('ana', 'secreta')
+
+    assert primera == segunda == {'token': primera['token'], 'privilegios': 1}
+    assert practica2.usuario_token(primera['token']) == 'ana'
+
+
+def test_inicio_con_token(practica2, sesiones):
+    token = practica2.iniciar_sesion('ana', 'secreta')['token']
+
+    assert practica2.iniciar_sesion(token=token) == {'token': token, 'privilegios': 1}
+
+
+def test_credenciales_incorrectas(practica2, sesiones):
+    assert practica2.iniciar_sesion('ana', 'otra') == -1
+    assert practica2.iniciar_sesion('nadie', 'secreta') == -1
+    assert practica2.iniciar_sesion(token='no-es-un-uuid') == -1
+
+
+def test_revocar_emite_un_token_nuevo(practica2, sesiones):
+    token = practica2.iniciar_sesion('ana', 'secreta')['token']
+
+    assert sesiones.revocar(token)
+    assert not sesiones.revocar(token)
+    assert practica2.usuario_token(token) is None
+    assert practica2.iniciar_sesion(token=token) == -1
+    assert practica2.iniciar_sesion('ana', 'secreta')['token'] != token
+
+
+def test_sesion_caducada(practica2, sesiones, monkeypatch):
+    monkeypatch.setattr(practica2, 'TTL_TOKEN', 1)
+    token = practica2.iniciar_sesion('ana', 'secreta')['token']
+
+    time.sleep(2.1)
+    assert practica2.usuario_token(token) is None
+    assert practica2.iniciar_sesion(token=token) == -1
+    assert practica2.iniciar_sesion('ana', 'secreta')['token'] != token
+
+
+def test_sesiones_en_buckets(practica2, sesiones):
+    for indice in range(20):
+        practica2.registrar_usuario(f'Usuario {indice}', f'u{indice}', 'secreta', 0)
+        practica2.iniciar_sesion(f'u{indice}', 'secreta')
+
+    # Dos tipos de bucket, sin claves por sesion
+    assert len(sesiones.cliente.keys(f'{sesiones.prefijo}:*')) <= 2 * sesiones.buckets
@@ -0,0 +1,126 @@
+import time
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import practica1
+
+
+@pytest.fixture
+def escritura(Persona):
+    # Sin arrancar el hilo, las pruebas escriben en mongo con flush
+    Persona.write_behind = practica1.WriteBehind(Persona, max_lag=60, claim_timeout=0.2)
+    return Persona.write_behind
+
+
+def reclamar(escritura):
+    """
+    Reclama los pendientes como un flush que termina antes de confirmarlos
+    """
+
+    return escritura.script_reclamar(keys=[escritura._clave_pendientes(), escritura._clave_reclamados()],
+                                     args=[escritura.batch_size, escritura._clave_cambios(), int(escritura.claim_timeout * 1000)],
+                                     client=escritura.model.redis)
+
+
+def test_save_se_escribe_una_vez(Persona, escritura):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+    for edad in range(2, 6):
+        persona.edad = edad
+        persona.save()
+
+    assert Persona.db.count_documents({}) == 0
+    assert escritura.flush() == 1
+    assert Persona.db.find_one({'_id': persona._id})['edad'] == 5
+    assert not escritura.model.redis.keys('write-behind:*')
+
+
+def test_reclamacion_caducada_se_vuelve_a_reclamar(Persona, escritura):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+
+    _, *reclamados = reclamar(escritura)
+    assert reclamados[::2] == [str(persona._id).encode()]
+
+    # Mientras no caduca, nadie mas la reclama
+    assert escritura.flush() == 0
+    assert Persona.db.count_documents({}) == 0
+
+    time.sleep(escritura.claim_timeout + 0.1)
+    assert escritura.flush() == 1
+    assert Persona.db.find_one({'_id': persona._id})['edad'] == 1
+    assert not escritura.model.redis.keys('write-behind:*')
+
+
+def test_reclamacion_caducada_no_pisa_cambios_nuevos(Persona, escritura):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+    reclamar(escritura)
+
+    persona.edad = 2
+    persona.save()
+    time.sleep(escritura.claim_timeout + 0.1)
+
+    escritura.flush()
+    assert Persona.db.find_one({'_id': persona._id})['edad'] == 2
+    assert not escritura.model.redis.keys('write-behind:*')
+
+
+def test_bulk_write_error_parcial_libera_solo_los_fallidos(Persona, escritura, monkeypatch):
+    buena = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    mala = Persona(nombre='Luis', apellido='Gil', dni='2', edad=1)
+    buena.save()
+    mala.save()
+    escritura.flush()
+
+    buena.edad = 2
+    buena.save()
+    mala.edad = 3
+    mala.save()
+
+    bulk_write = Persona.db.bulk_write
+
+    def parcial(operaciones, ordered):
+        indice = next(indice for indice, operacion in enumerate(operaciones) if operacion._filter['_id'] == mala._id)
+        bulk_write([operacion for posicion, operacion in enumerate(operaciones) if posicion != indice], ordered=ordered)
+        raise BulkWriteError({'writeErrors': [{'index': indice, 'code': 11000, 'errmsg': 'duplicado'}]})
+
+    monkeypatch.setattr(Persona.db, 'bulk_write', parcial)
+    with pytest.raises(BulkWriteError):
+        escritura.flush()
+
+    assert Persona.db.find_one({'_id': buena._id})['edad'] == 2
+    assert Persona.db.find_one({'_id': mala._id})['edad'] == 1
+    # Solo el fallido sigue reclamado, con la reclamacion ya caducada
+    assert escritura.model.redis.zrange(escritura._clave_reclamados(), 0, -1, withscores=True) == [(str(mala._id).encode(), 0)]
+    assert escritura.pending([mala._id]) == {str(mala._id): {'edad': 3}}
+
+    monkeypatch.setattr(Persona.db, 'bulk_write', bulk_write)
+    assert escritura.flush() == 1
+    assert Persona.db.find_one({'_id': mala._id})['edad'] == 3
+
+
+def test_backfill_incluye_cambios_pendientes(Persona, escritura):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+    escritura.flush()
+
+    persona.edad = 2
+    persona.save()
+    Persona.redis.delete(Persona._clave(persona._id))
+
+    assert Persona.find_by_id(str(persona._id)).edad == 2
+
+
+def test_delete_descarta_cambios_pendientes(Persona, escritura):
+    persona = Persona(nombre='Ana', apellido='Ruiz', dni='1', edad=1)
+    persona.save()
+    escritura.flush()
+
+    persona.edad = 2
+    persona.save()
+    persona.delete()
+
+    assert escritura.flush() == 0
+    assert Persona.db.count_documents({}) == 0